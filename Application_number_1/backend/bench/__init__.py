@@ -0,0 +1,8 @@
+"""Load-test and benchmark harness for the ENT backend.
+
+Usage (from Application_number_1/backend, with a local Postgres reachable
+through the usual DB_* variables):
+
+    python -m bench.run --requests 500 --concurrency 16 --output results.json
+    python -m bench.run compare baseline.json results.json
+"""
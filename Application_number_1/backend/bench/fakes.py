@@ -0,0 +1,362 @@
+"""Local stand-ins for the services the ENT backend talks to.
+
+- FakeKeycloak: token endpoints, JWKS and the admin API calls used by main.py
+- FakeOllama: /api/generate returning a canned answer
+- SmtpSink: SMTP server with STARTTLS and AUTH PLAIN that counts messages
+- InMemoryMinio: the subset of the Minio client API used by main.py
+"""
+import base64
+import datetime
+import io
+import json
+import re
+import socketserver
+import ssl
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import jwt
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from minio.error import S3Error
+
+
+def _rsa_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+
+class _JsonHandler(BaseHTTPRequestHandler):
+    routes = []  # (method, regex, callable(handler, match) -> (status, body, headers))
+
+    def log_message(self, format, *args):
+        pass
+
+    def _dispatch(self, method):
+        path = self.path.split("?", 1)[0]
+        for route_method, pattern, func in self.routes:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                status, body, headers = func(self, match)
+                break
+        else:
+            status, body, headers = 404, {"error": "not found"}, {}
+        payload = b"" if body is None else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PUT(self):
+        self._dispatch("PUT")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+
+class _HttpService:
+    """Threaded HTTP server running on an ephemeral port"""
+
+    def __init__(self, routes):
+        handler = type("Handler", (_JsonHandler,), {"routes": routes})
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeKeycloak(_HttpService):
+    def __init__(self, realm="ENT", student_count=50):
+        self.realm = realm
+        self.kid = "bench-key"
+        self.private_key = _rsa_key()
+        self.student_count = student_count
+        public_jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(self.private_key.public_key()))
+        public_jwk.update({"kid": self.kid, "use": "sig", "alg": "RS256"})
+        self.jwks = {"keys": [public_jwk]}
+        realm_path = re.escape(realm)
+        super().__init__([
+            ("GET", rf"/realms/{realm_path}/protocol/openid-connect/certs", self._certs),
+            ("POST", r"/realms/master/protocol/openid-connect/token", self._admin_token),
+            ("POST", rf"/realms/{realm_path}/protocol/openid-connect/token", self._password_grant),
+            ("GET", rf"/admin/realms/{realm_path}/roles/([^/]+)", self._role),
+            ("GET", rf"/admin/realms/{realm_path}/roles/([^/]+)/users", self._role_users),
+            ("POST", rf"/admin/realms/{realm_path}/users", self._create_user),
+            ("PUT", rf"/admin/realms/{realm_path}/users/([^/]+)", self._update_user),
+            ("DELETE", rf"/admin/realms/{realm_path}/users/([^/]+)", self._delete_user),
+            ("POST", rf"/admin/realms/{realm_path}/users/([^/]+)/role-mappings/realm", self._role_mapping),
+        ])
+
+    def issue_token(self, username="bench-user", roles=("etudiant",), lifetime=3600):
+        now = int(time.time())
+        payload = {
+            "sub": str(uuid.uuid5(uuid.NAMESPACE_URL, username)),
+            "preferred_username": username,
+            "name": username,
+            "realm_access": {"roles": list(roles)},
+            "iat": now,
+            "exp": now + lifetime,
+            "iss": f"{self.url}/realms/{self.realm}",
+        }
+        return jwt.encode(payload, self.private_key, algorithm="RS256", headers={"kid": self.kid})
+
+    def _certs(self, handler, match):
+        return 200, self.jwks, {}
+
+    def _token_response(self, token):
+        return 200, {"access_token": token, "expires_in": 3600, "token_type": "Bearer"}, {}
+
+    def _admin_token(self, handler, match):
+        handler.read_body()
+        return self._token_response(self.issue_token("admin", roles=("admin",)))
+
+    def _password_grant(self, handler, match):
+        form = dict(pair.split("=", 1) for pair in handler.read_body().decode().split("&") if "=" in pair)
+        return self._token_response(self.issue_token(form.get("username", "bench-user")))
+
+    def _role(self, handler, match):
+        return 200, {"id": f"role-{match.group(1)}", "name": match.group(1)}, {}
+
+    def _role_users(self, handler, match):
+        users = [{"id": f"user-{i}", "email": f"student{i}@bench.local"} for i in range(self.student_count)]
+        return 200, users, {}
+
+    def _create_user(self, handler, match):
+        handler.read_body()
+        user_id = str(uuid.uuid4())
+        return 201, None, {"Location": f"{self.url}/admin/realms/{self.realm}/users/{user_id}"}
+
+    def _update_user(self, handler, match):
+        handler.read_body()
+        return 204, None, {}
+
+    def _delete_user(self, handler, match):
+        return 204, None, {}
+
+    def _role_mapping(self, handler, match):
+        handler.read_body()
+        return 204, None, {}
+
+
+class FakeOllama(_HttpService):
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        super().__init__([("POST", r"/api/generate", self._generate)])
+
+    def _generate(self, handler, match):
+        handler.read_body()
+        if self.latency:
+            time.sleep(self.latency)
+        return 200, {"response": "Réponse de test.", "done": True}, {}
+
+
+def _self_signed_certificate():
+    """Write a throwaway certificate/key pair for the SMTP sink's STARTTLS"""
+    key = _rsa_key()
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+    cert_file = tempfile.NamedTemporaryFile(suffix=".pem", delete=False)
+    cert_file.write(certificate.public_bytes(serialization.Encoding.PEM))
+    cert_file.write(key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.TraditionalOpenSSL,
+        serialization.NoEncryption()
+    ))
+    cert_file.close()
+    return cert_file.name
+
+
+class _SmtpHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+        self.wfile.flush()
+
+    def handle(self):
+        self.reply("220 bench SMTP sink")
+        while True:
+            raw = self.rfile.readline()
+            if not raw:
+                return
+            command = raw.decode(errors="replace").strip()
+            verb = command.split(" ", 1)[0].upper()
+            if verb in ("EHLO", "HELO"):
+                self.wfile.write(b"250-bench\r\n250-STARTTLS\r\n250-AUTH PLAIN\r\n250 8BITMIME\r\n")
+                self.wfile.flush()
+            elif verb == "STARTTLS":
+                self.reply("220 Ready to start TLS")
+                self.request = self.server.tls_context.wrap_socket(self.request, server_side=True)
+                self.rfile = self.request.makefile("rb")
+                self.wfile = self.request.makefile("wb")
+            elif verb == "AUTH":
+                self.reply("235 Authentication successful")
+            elif verb == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                while True:
+                    line = self.rfile.readline()
+                    if not line or line in (b".\r\n", b".\n"):
+                        break
+                    size += len(line)
+                self.server.record_message(size)
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                # MAIL, RCPT, RSET, NOOP...
+                self.reply("250 OK")
+
+
+class SmtpSink:
+    def __init__(self):
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), _SmtpHandler)
+        self.server.daemon_threads = True
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(_self_signed_certificate())
+        self.server.tls_context = context
+        self.messages = 0
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self.server.record_message = self._record_message
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def _record_message(self, size):
+        with self._lock:
+            self.messages += 1
+            self.bytes += size
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _StoredObject:
+    def __init__(self, object_name, data=b"", content_type=None, is_dir=False):
+        self.object_name = object_name
+        self.bucket_name = "my-bucket"
+        self.data = data
+        self.size = len(data)
+        self.content_type = content_type
+        self.is_dir = is_dir
+        self.last_modified = datetime.datetime.now(datetime.timezone.utc)
+        self.etag = uuid.uuid4().hex
+
+
+class _ObjectResponse(io.BytesIO):
+    def release_conn(self):
+        pass
+
+
+class InMemoryMinio:
+    """Drop-in replacement for the Minio client methods used by main.py"""
+
+    def __init__(self):
+        self._objects = {}
+        self._lock = threading.Lock()
+
+    def _missing(self, object_name):
+        return S3Error(
+            code="NoSuchKey", message="Object does not exist", resource=f"/my-bucket/{object_name}",
+            request_id="", host_id="", response=None, bucket_name="my-bucket", object_name=object_name
+        )
+
+    def put_object(self, bucket_name, object_name, data, length, content_type="application/octet-stream", **kwargs):
+        stored = _StoredObject(object_name, data.read(length), content_type)
+        with self._lock:
+            self._objects[object_name] = stored
+        return stored
+
+    def get_object(self, bucket_name, object_name, **kwargs):
+        with self._lock:
+            stored = self._objects.get(object_name)
+        if stored is None:
+            raise self._missing(object_name)
+        return _ObjectResponse(stored.data)
+
+    def stat_object(self, bucket_name, object_name, **kwargs):
+        with self._lock:
+            stored = self._objects.get(object_name)
+        if stored is None:
+            raise self._missing(object_name)
+        return stored
+
+    def remove_object(self, bucket_name, object_name, **kwargs):
+        with self._lock:
+            self._objects.pop(object_name, None)
+
+    def remove_objects(self, bucket_name, delete_object_list, **kwargs):
+        with self._lock:
+            for delete_object in delete_object_list:
+                self._objects.pop(delete_object._name, None)
+        return iter(())
+
+    def list_objects(self, bucket_name, prefix=None, recursive=False, start_after=None, **kwargs):
+        prefix = prefix or ""
+        with self._lock:
+            names = sorted(name for name in self._objects if name.startswith(prefix))
+        seen_dirs = set()
+        for name in names:
+            if start_after is not None and name <= start_after:
+                continue
+            rest = name[len(prefix):]
+            if not recursive and "/" in rest:
+                directory = prefix + rest.split("/", 1)[0] + "/"
+                if directory not in seen_dirs:
+                    seen_dirs.add(directory)
+                    yield _StoredObject(directory, is_dir=True)
+                continue
+            with self._lock:
+                stored = self._objects.get(name)
+            if stored is not None:
+                yield stored
+
+    def get_presigned_url(self, method, bucket_name, object_name, expires=None, response_headers=None, **kwargs):
+        token = base64.urlsafe_b64encode(uuid.uuid4().bytes).decode().rstrip("=")
+        return f"http://127.0.0.1:9000/{bucket_name}/{object_name}?X-Bench-Signature={token}"
@@ -0,0 +1,316 @@
+"""Drive scripted workloads against the ENT backend and store the results as JSON.
+
+    python -m bench.run [--requests N] [--concurrency C] [--workloads courses,upload,...] [--output FILE]
+    python -m bench.run compare BASELINE.json CANDIDATE.json
+
+Postgres is not faked: DB_HOST, DB_NAME, DB_NAME2, DB_USER and DB_PASSWORD
+must point at a local instance (the databases are created by the usual
+initialization steps).
+"""
+import argparse
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import requests
+
+from bench.fakes import FakeKeycloak, FakeOllama, SmtpSink
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SEED_FOLDER = "bench/cours-1"
+SEED_FILES = 20
+BULK_SIGNUP_USERS = 20  # Comptes par requête /signup/bulk
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _read_status_kb(pid, field):
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss(pid):
+    # Remet VmHWM à la valeur courante (Linux >= 4.0), pour un pic par workload
+    try:
+        with open(f"/proc/{pid}/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+    except OSError:
+        pass
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+class Workload:
+    def __init__(self, name, request_factory):
+        self.name = name
+        self.request_factory = request_factory  # (session, base_url, i) -> requests.Response
+
+
+def build_workloads(prof_token, student_token):
+    prof = {"Authorization": f"Bearer {prof_token}"}
+    student = {"Authorization": f"Bearer {student_token}"}
+    seeded = []
+
+    def upload(session, base_url, i):
+        response = session.post(
+            f"{base_url}/upload",
+            headers=prof,
+            data={"folder": SEED_FOLDER, "description": f"document de test {i}"},
+            files={"file": (f"doc-{i}.txt", b"x" * 4096, "text/plain")},
+        )
+        if response.ok and len(seeded) < SEED_FILES:
+            seeded.append(response.json()["path"])
+        return response
+
+    def download(session, base_url, i):
+        path = seeded[i % len(seeded)] if seeded else f"{SEED_FOLDER}/missing"
+        return session.get(f"{base_url}/download/{path}")
+
+    def new_user(name):
+        return {
+            "username": name, "email": f"{name}@bench.local", "firstName": "Bench", "lastName": name,
+            "password": "bench-password", "role": "etudiant",
+        }
+
+    def signup(session, base_url, i):
+        return session.post(f"{base_url}/signup", json=new_user(f"signup-{i}"))
+
+    def signup_bulk(session, base_url, i):
+        users = [new_user(f"bulk-{i}-{j}") for j in range(BULK_SIGNUP_USERS)]
+        return session.post(f"{base_url}/signup/bulk", headers=prof, json={"users": users, "enable": True})
+
+    return [
+        Workload("upload", upload),
+        Workload("courses", lambda s, url, i: s.get(f"{url}/courses")),
+        Workload("files", lambda s, url, i: s.get(f"{url}/courses/{SEED_FOLDER}/files")),
+        Workload("download", download),
+        Workload("announcements", lambda s, url, i: s.get(f"{url}/announcements", headers=student)),
+        Workload("chat", lambda s, url, i: s.post(f"{url}/chat", headers=student, json={"message": f"Bonjour {i}"})),
+        Workload("signup", signup),
+        Workload("signup_bulk", signup_bulk),
+    ]
+
+
+def run_workload(workload, base_url, total_requests, concurrency, server_pid):
+    local = threading.local()
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def one(i):
+        nonlocal errors
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        start = time.perf_counter()
+        try:
+            ok = workload.request_factory(session, base_url, i).status_code < 400
+        except requests.RequestException:
+            ok = False
+        elapsed = time.perf_counter() - start
+        with lock:
+            # Latences des seules réponses réussies : les échecs rapides fausseraient les percentiles
+            if ok:
+                latencies.append(elapsed)
+            else:
+                errors += 1
+
+    _reset_peak_rss(server_pid)
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, range(total_requests)))
+    duration = time.perf_counter() - started
+
+    latencies.sort()
+
+    def ms(seconds):
+        return round(seconds * 1000, 2) if seconds is not None else None
+
+    return {
+        "requests": total_requests,
+        "errors": errors,
+        "concurrency": concurrency,
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(total_requests / duration, 2) if duration else None,
+        # Toutes les valeurs valent None si aucune requête n'a réussi
+        "latency_ms": {
+            "p50": ms(percentile(latencies, 0.50)),
+            "p95": ms(percentile(latencies, 0.95)),
+            "p99": ms(percentile(latencies, 0.99)),
+            "mean": ms(sum(latencies) / len(latencies) if latencies else None),
+            "max": ms(latencies[-1] if latencies else None),
+        },
+        "peak_rss_kb": _read_status_kb(server_pid, "VmHWM"),
+    }
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _wait_until_ready(base_url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("Le serveur de benchmark s'est arrêté au démarrage")
+        try:
+            requests.get(f"{base_url}/metrics", timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError("Le serveur de benchmark n'a pas démarré à temps")
+
+
+def run(args):
+    keycloak = FakeKeycloak().start()
+    ollama = FakeOllama(latency=args.ollama_latency).start()
+    smtp = SmtpSink().start()
+    port = _free_port()
+    base_url = f"http://127.0.0.1:{port}"
+
+    env = dict(os.environ)
+    env.update({
+        "KEYCLOAK_URL": keycloak.url,
+        "KEYCLOAK_REALM": keycloak.realm,
+        "KEYCLOAK_ADMIN": "admin",
+        "KEYCLOAK_ADMIN_PASSWORD": "admin",
+        "KEYCLOAK_CLIENT_SECRET": "bench",
+        "OLLAMA_URL": ollama.url,
+        "EMAIL_HOST": "127.0.0.1",
+        "EMAIL_PORT": str(smtp.port),
+        "EMAIL_USERNAME": "bench@bench.local",
+        "EMAIL_PASSWORD": "bench",
+        # Un seul jeton et une seule IP pour tout le trafic : sans cela on mesure surtout des 429
+        "RATE_LIMITS_ENABLED": "true" if args.rate_limits else "false",
+    })
+    process = subprocess.Popen(
+        [sys.executable, "-m", "bench.server", "--port", str(port), "--storage", args.storage],
+        cwd=BACKEND_DIR,
+        env=env,
+    )
+    try:
+        _wait_until_ready(base_url, process)
+        workloads = build_workloads(
+            keycloak.issue_token("bench-prof", roles=("prof",)),
+            keycloak.issue_token("bench-student", roles=("etudiant",)),
+        )
+        selected = set(args.workloads.split(",")) if args.workloads else None
+        results = {}
+        for workload in workloads:
+            if selected and workload.name not in selected:
+                continue
+            print(f"Running {workload.name}...", file=sys.stderr)
+            results[workload.name] = run_workload(
+                workload, base_url, args.requests, args.concurrency, process.pid
+            )
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+        keycloak.stop()
+        ollama.stop()
+        smtp.stop()
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "git_revision": _git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "storage": args.storage,
+            "requests_per_workload": args.requests,
+            "concurrency": args.concurrency,
+            "emails_received": smtp.messages,
+        },
+        "workloads": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    print(output)
+
+
+def compare(baseline_path, candidate_path):
+    with open(baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)["workloads"]
+    with open(candidate_path) as candidate_file:
+        candidate = json.load(candidate_file)["workloads"]
+
+    def delta(old, new):
+        if not old or new is None:
+            return "n/a"
+        return f"{(new - old) / old * 100:+.1f}%"
+
+    header = f"{'workload':<15}{'rps':>22}{'p50 ms':>22}{'p99 ms':>22}{'peak RSS kB':>26}"
+    print(header)
+    print("-" * len(header))
+    for name in sorted(set(baseline) | set(candidate)):
+        old, new = baseline.get(name), candidate.get(name)
+        if not old or not new:
+            print(f"{name:<15}{'(missing in one run)':>22}")
+            continue
+        columns = [
+            (old["throughput_rps"], new["throughput_rps"]),
+            (old["latency_ms"]["p50"], new["latency_ms"]["p50"]),
+            (old["latency_ms"]["p99"], new["latency_ms"]["p99"]),
+        ]
+        row = f"{name:<15}"
+        for before, after in columns:
+            row += f"{f'{before} -> {after} ({delta(before, after)})':>22}"
+        rss = f"{old.get('peak_rss_kb')} -> {new.get('peak_rss_kb')}"
+        row += f"{rss:>26}"
+        print(row)
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "compare":
+        parser = argparse.ArgumentParser(prog="bench.run compare")
+        parser.add_argument("baseline")
+        parser.add_argument("candidate")
+        args = parser.parse_args(sys.argv[2:])
+        compare(args.baseline, args.candidate)
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="requests per workload")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--workloads", help="comma-separated subset of: upload,courses,files,download,announcements,chat,"
+                             "signup,signup_bulk")
+    parser.add_argument("--storage", choices=["memory", "minio"], default="memory",
+                        help="in-memory object store, or the local MinIO configured in main.py")
+    parser.add_argument("--ollama-latency", type=float, default=0.0, help="simulated generation time (s)")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="keep the per-user/per-IP rate limits enabled (off by default)")
+    parser.add_argument("--output", help="write the JSON report to this file")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
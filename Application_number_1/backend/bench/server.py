@@ -0,0 +1,56 @@
+"""Boot the ENT FastAPI app for a benchmark run (started by bench.run in a subprocess).
+
+The Keycloak, Ollama and SMTP stand-ins run in the driver process and are
+reached through the environment variables it sets; object storage is swapped
+for InMemoryMinio unless --storage minio is given.
+"""
+import argparse
+import os
+import sys
+
+import uvicorn
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FILES_METADATA_DDL = """
+    CREATE TABLE IF NOT EXISTS files_metadata (
+        id SERIAL PRIMARY KEY,
+        file_uuid VARCHAR(8) NOT NULL,
+        original_filename VARCHAR(255) NOT NULL,
+        storage_path VARCHAR(255) NOT NULL,
+        file_size BIGINT NOT NULL,
+        content_type VARCHAR(100) NOT NULL,
+        uploaded_by VARCHAR(100) NOT NULL,
+        upload_date TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        folder_path VARCHAR(255) NOT NULL,
+        description TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_files_metadata_file_uuid ON files_metadata(file_uuid);
+    CREATE INDEX IF NOT EXISTS idx_files_metadata_folder_path ON files_metadata(folder_path);
+    CREATE INDEX IF NOT EXISTS idx_files_metadata_upload_date ON files_metadata(upload_date);
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, required=True)
+    parser.add_argument("--storage", choices=["memory", "minio"], default="memory")
+    args = parser.parse_args()
+
+    sys.path.insert(0, BACKEND_DIR)
+    import main as ent
+    from bench.fakes import InMemoryMinio
+
+    # files_metadata n'est pas créée par le backend (voir sql_metadata.txt)
+    with ent.get_metadata_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(FILES_METADATA_DDL)
+
+    if args.storage == "memory":
+        ent.minio_client = InMemoryMinio()
+
+    uvicorn.run(ent.app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
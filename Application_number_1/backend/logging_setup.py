@@ -0,0 +1,99 @@
+"""Logging pipeline of the backend.
+
+Both backends carry the same copy of this module (each backend directory is
+deployable on its own); keep Application_number_1/backend/logging_setup.py and
+Application_number_2/backend/logging_setup.py identical.
+
+Les handlers tournent sur un thread d'arrière-plan derrière une file, les
+enregistrements sont en JSON et les DEBUG sont échantillonnés par point d'appel.
+"""
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+from datetime import datetime
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "thread": record.threadName,
+        }
+        if record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class DebugSampler(logging.Filter):
+    """Let at most `per_second` DEBUG records through per call site and per second"""
+
+    def __init__(self, per_second: int):
+        super().__init__()
+        self.per_second = per_second
+        self._windows = {}  # (pathname, lineno) -> [second, count]
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        second = int(record.created)
+        window = self._windows.get((record.pathname, record.lineno))
+        if window is None or window[0] != second:
+            self._windows[(record.pathname, record.lineno)] = [second, 1]
+            return True
+        window[1] += 1
+        return window[1] <= self.per_second
+
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that renders the message and traceback on the calling thread.
+
+    The arguments may be mutated by the caller once the call returns, so only
+    the JSON serialization is left to the QueueListener thread.
+    """
+
+    _exception_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self._exception_formatter.formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+def configure_logging():
+    """Install the queue handler on the root logger.
+
+    Reads LOG_LEVEL (root, default INFO), LOG_LEVELS (per-logger overrides,
+    ex: "main=DEBUG,minio=WARNING") and LOG_DEBUG_PER_SECOND at call time, so
+    call it after load_dotenv().
+    """
+    log_level = os.getenv("LOG_LEVEL", "INFO").upper()
+    log_levels = os.getenv("LOG_LEVELS", "urllib3=WARNING")
+    debug_per_second = int(os.getenv("LOG_DEBUG_PER_SECOND", "20"))
+
+    log_queue = queue.SimpleQueue()
+    output_handler = logging.StreamHandler()
+    output_handler.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(log_queue, output_handler, respect_handler_level=True)
+
+    queue_handler = BackgroundQueueHandler(log_queue)
+    queue_handler.addFilter(DebugSampler(debug_per_second))
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(log_level)
+    for item in filter(None, (part.strip() for part in log_levels.split(","))):
+        name, _, level = item.partition("=")
+        logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+    listener.start()
+    atexit.register(listener.stop)
@@ -1,22 +1,40 @@
 from fastapi import FastAPI, HTTPException, Response, Depends, Request, File, UploadFile, Form
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 import requests
 import io
+import json
+import time
+import bisect
+import asyncio
+import threading
+import urllib3
+import random
+import re
+import math
+import ipaddress
+import gzip
+import csv
+import secrets
+import hmac
+import hashlib
 import uuid
 import shortuuid
 import os
 from minio import Minio
 from minio.error import S3Error
 from minio.commonconfig import REPLACE
-from datetime import timedelta, datetime
+from minio.deleteobjects import DeleteObject
+from datetime import timedelta, datetime, timezone
 from jose import JWTError
 import jwt
 from jwt import PyJWKClient, get_unverified_header
 import logging
 from fastapi import BackgroundTasks
+from fastapi.concurrency import run_in_threadpool
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -24,22 +42,211 @@ from typing import List, Optional
 import psycopg2
 from psycopg2.extras import RealDictCursor
 from contextlib import contextmanager
-
-app = FastAPI()
+from concurrent.futures import ThreadPoolExecutor
+from logging_setup import configure_logging
+
+# Dépendances optionnelles pour la génération des aperçus
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+try:
+    import fitz  # PyMuPDF
+except ImportError:
+    fitz = None
+# Dépendance optionnelle pour la compression brotli
+try:
+    import brotli
+except ImportError:
+    brotli = None
+# Dépendance optionnelle pour le profilage à la demande
+try:
+    from pyinstrument import Profiler
+    from pyinstrument.renderers import SpeedscopeRenderer
+except ImportError:
+    Profiler = None
+
+# orjson encode nativement les datetime et les lignes RealDictCursor (sous-classes de dict)
+app = FastAPI(default_response_class=ORJSONResponse)
 load_dotenv()
 security = HTTPBearer()
 
+
+# Métriques au format Prometheus : latence par route et temps passé dans les dépendances
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    __slots__ = ("bucket_counts", "count", "total")
+
+    def __init__(self):
+        self.bucket_counts = [0] * (len(LATENCY_BUCKETS) + 1)  # Dernier seau = +Inf
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float):
+        self.bucket_counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+
+
+class MetricsRegistry:
+    """Minimal thread-safe histogram and counter store rendered in Prometheus text format"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}  # (name, labels) -> Histogram
+        self._counters = {}  # (name, labels) -> int
+        self._help = {}
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._help[name] = (kind, help_text)
+
+    def observe(self, name: str, labels: tuple, value: float):
+        with self._lock:
+            histogram = self._histograms.get((name, labels))
+            if histogram is None:
+                histogram = self._histograms[(name, labels)] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name: str, labels: tuple, amount: int = 1):
+        with self._lock:
+            self._counters[(name, labels)] = self._counters.get((name, labels), 0) + amount
+
+    @staticmethod
+    def _format_labels(labels: tuple, extra: str = "") -> str:
+        parts = [f'{key}="{value}"' for key, value in labels]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        with self._lock:
+            histograms = {key: (list(h.bucket_counts), h.count, h.total) for key, h in self._histograms.items()}
+            counters = dict(self._counters)
+        lines = []
+        for name, (kind, help_text) in self._help.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "histogram":
+                for (metric, labels), (bucket_counts, count, total) in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, bucket_count in zip(LATENCY_BUCKETS + ("+Inf",), bucket_counts):
+                        cumulative += bucket_count
+                        bucket_labels = self._format_labels(labels, 'le="%s"' % bound)
+                        lines.append(f"{name}_bucket{bucket_labels} {cumulative}")
+                    lines.append(f"{name}_sum{self._format_labels(labels)} {total}")
+                    lines.append(f"{name}_count{self._format_labels(labels)} {count}")
+            else:
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f"{name}{self._format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+metrics.describe("ent_http_request_duration_seconds", "histogram", "HTTP request latency by route")
+metrics.describe("ent_http_requests_total", "counter", "HTTP requests by route and status")
+metrics.describe("ent_dependency_duration_seconds", "histogram", "Time spent in downstream dependencies")
+metrics.describe("ent_dependency_errors_total", "counter", "Failed downstream dependency calls")
+
+
+@contextmanager
+def dependency_span(dependency: str, operation: str):
+    """Time a call to Keycloak, Postgres, MinIO, SMTP or Ollama"""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        metrics.inc("ent_dependency_errors_total", (("dependency", dependency), ("operation", operation)))
+        raise
+    finally:
+        metrics.observe(
+            "ent_dependency_duration_seconds",
+            (("dependency", dependency), ("operation", operation)),
+            time.perf_counter() - start
+        )
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware: records latency and status per route template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # Le gabarit de route (ex: /courses/{folder:path}/files) évite l'explosion des labels
+            route = scope.get("route")
+            labels = (("method", scope["method"]), ("route", route.path if route else "unmatched"))
+            metrics.observe("ent_http_request_duration_seconds", labels, time.perf_counter() - start)
+            metrics.inc("ent_http_requests_total", labels + (("status", str(status_code)),))
+
+
+_timed_cursor_classes = {}
+
+
+def timed_cursor_class(base):
+    """Subclass of a psycopg2 cursor class whose queries are timed"""
+    cursor_class = _timed_cursor_classes.get(base)
+    if cursor_class is None:
+        class TimedCursor(base):
+            def execute(self, query, vars=None):
+                with dependency_span("postgres", "query"):
+                    return super().execute(query, vars)
+
+            def executemany(self, query, vars_list):
+                with dependency_span("postgres", "query"):
+                    return super().executemany(query, vars_list)
+
+        cursor_class = _timed_cursor_classes[base] = TimedCursor
+    return cursor_class
+
+
+class InstrumentedConnection(psycopg2.extensions.connection):
+    def cursor(self, *args, **kwargs):
+        base = kwargs.get("cursor_factory") or self.cursor_factory or psycopg2.extensions.cursor
+        kwargs["cursor_factory"] = timed_cursor_class(base)
+        return super().cursor(*args, **kwargs)
+
+
+class InstrumentedPoolManager(urllib3.PoolManager):
+    """HTTP client for MinIO that times every S3 request"""
+
+    def urlopen(self, method, url, *args, **kwargs):
+        with dependency_span("minio", method.lower()):
+            return super().urlopen(method, url, *args, **kwargs)
+
 @contextmanager
 def get_db_connection():
     """Context manager for database connections"""
     conn = None
     try:
-        conn = psycopg2.connect(
-            host=os.getenv("DB_HOST"),
-            database=os.getenv("DB_NAME"),
-            user=os.getenv("DB_USER"),
-            password=os.getenv("DB_PASSWORD")
-        )
+        with dependency_span("postgres", "connect"):
+            conn = psycopg2.connect(
+                host=os.getenv("DB_HOST"),
+                database=os.getenv("DB_NAME"),
+                user=os.getenv("DB_USER"),
+                password=os.getenv("DB_PASSWORD"),
+                connection_factory=InstrumentedConnection
+            )
         conn.autocommit = True
         yield conn
     except Exception as e:
@@ -54,12 +261,14 @@ def get_metadata_db_connection():
     """Context manager for metadata database connections"""
     conn = None
     try:
-        conn = psycopg2.connect(
-            host=os.getenv("DB_HOST"),
-            database=os.getenv("DB_NAME2"),  # Using the metadata database
-            user=os.getenv("DB_USER"),
-            password=os.getenv("DB_PASSWORD")
-        )
+        with dependency_span("postgres", "connect"):
+            conn = psycopg2.connect(
+                host=os.getenv("DB_HOST"),
+                database=os.getenv("DB_NAME2"),  # Using the metadata database
+                user=os.getenv("DB_USER"),
+                password=os.getenv("DB_PASSWORD"),
+                connection_factory=InstrumentedConnection
+            )
         conn.autocommit = True
         yield conn
     except Exception as e:
@@ -70,8 +279,8 @@ def get_metadata_db_connection():
             conn.close()
 
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Configure logging (file d'attente, JSON, échantillonnage des DEBUG : voir logging_setup.py)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 # Configuration CORS (à ajouter avant les routes)
@@ -82,6 +291,382 @@ app.add_middleware(
     allow_methods=["*"],  # Autoriser toutes les méthodes (POST, GET, etc.)
     allow_headers=["*"],  # Autoriser tous les headers
 )
+app.add_middleware(MetricsMiddleware)
+
+
+# Compression négociée (brotli puis gzip) des réponses au-delà d'un seuil
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+COMPRESSIBLE_TYPES = (b"application/json", b"text/", b"application/javascript", b"application/xml")
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    accepted = {}
+    for part in accept_encoding.split(","):
+        coding, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+    if brotli is not None and accepted.get("br", 0) > 0:
+        return "br"
+    if accepted.get("gzip", 0) > 0:
+        return "gzip"
+    return None
+
+
+class CompressionMiddleware:
+    """Pure ASGI middleware compressing single-chunk responses; streamed bodies pass through"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accept_encoding = ""
+        for name, value in scope["headers"]:
+            if name == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+                break
+        encoding = choose_encoding(accept_encoding) if accept_encoding else None
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start_message = None
+
+        async def send_wrapper(message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if start_message is None:
+                await send(message)
+                return
+
+            headers = dict(start_message.get("headers", []))
+            body = message.get("body", b"")
+            content_type = headers.get(b"content-type", b"")
+            if (
+                message.get("more_body", False)
+                or len(body) < COMPRESSION_MIN_SIZE
+                or b"content-encoding" in headers
+                or not content_type.startswith(COMPRESSIBLE_TYPES)
+            ):
+                await send(start_message)
+                start_message = None
+                await send(message)
+                return
+
+            if encoding == "br":
+                body = brotli.compress(body, quality=4)
+            else:
+                body = gzip.compress(body, compresslevel=5)
+            raw_headers = [
+                (name, value) for name, value in start_message.get("headers", [])
+                if name not in (b"content-length", b"vary")
+            ]
+            vary = headers.get(b"vary")
+            raw_headers += [
+                (b"content-encoding", encoding.encode()),
+                (b"content-length", str(len(body)).encode()),
+                (b"vary", vary + b", Accept-Encoding" if vary else b"Accept-Encoding"),
+            ]
+            await send({**start_message, "headers": raw_headers})
+            start_message = None
+            await send({**message, "body": body})
+
+        await self.app(scope, receive, send_wrapper)
+
+
+app.add_middleware(CompressionMiddleware)
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+# Profilage à la demande : une requête portant X-Profile-Token (ou tirée au sort)
+# est profilée et le résultat écrit au format speedscope dans PROFILE_DIR.
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.001"))
+PROFILE_SUFFIX = ".speedscope.json"
+
+
+def is_profile_token_valid(token: Optional[str]) -> bool:
+    return bool(PROFILE_TOKEN) and token is not None and secrets.compare_digest(token, PROFILE_TOKEN)
+
+
+def write_profile(file_name: str, content: str):
+    """Write one profile and keep only the PROFILE_KEEP most recent ones"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    with open(os.path.join(PROFILE_DIR, file_name), "w") as profile_file:
+        profile_file.write(content)
+    profiles = sorted(
+        (entry for entry in os.scandir(PROFILE_DIR) if entry.name.endswith(PROFILE_SUFFIX)),
+        key=lambda entry: entry.stat().st_mtime
+    )
+    for entry in profiles[:-PROFILE_KEEP] if PROFILE_KEEP > 0 else profiles:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+
+
+class ProfilingMiddleware:
+    """Pure ASGI middleware; only registered when profiling is configured"""
+
+    def __init__(self, app):
+        self.app = app
+
+    def _should_profile(self, scope) -> bool:
+        if PROFILE_TOKEN:
+            for name, value in scope["headers"]:
+                if name == b"x-profile-token":
+                    return is_profile_token_valid(value.decode("latin-1"))
+        return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profiler = Profiler(interval=PROFILE_INTERVAL, async_mode="enabled")
+        try:
+            profiler.start()
+        except RuntimeError as e:
+            logger.warning(f"Profiler unavailable for this request: {str(e)}")
+            await self.app(scope, receive, send)
+            return
+
+        slug = re.sub(r"[^A-Za-z0-9]+", "-", scope["path"]).strip("-")[:60] or "root"
+        file_name = f"{datetime.now().strftime('%Y%m%dT%H%M%S%f')}_{scope['method']}_{slug}{PROFILE_SUFFIX}"
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", file_name.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            profiler.stop()
+            try:
+                content = profiler.output(renderer=SpeedscopeRenderer())
+                await asyncio.get_running_loop().run_in_executor(None, write_profile, file_name, content)
+            except Exception as e:
+                logger.error(f"Could not write profile {file_name}: {str(e)}")
+
+
+if Profiler is not None and (PROFILE_TOKEN or PROFILE_SAMPLE_RATE > 0):
+    app.add_middleware(ProfilingMiddleware)
+elif PROFILE_TOKEN or PROFILE_SAMPLE_RATE > 0:
+    logger.warning("Profiling requested but pyinstrument is not installed")
+
+
+def require_profile_token(request: Request):
+    if not is_profile_token_valid(request.headers.get("X-Profile-Token")):
+        raise HTTPException(status_code=403, detail="Accès refusé")
+
+
+@app.get("/admin/profiles", dependencies=[Depends(require_profile_token)])
+async def list_profiles():
+    if not os.path.isdir(PROFILE_DIR):
+        return {"profiles": []}
+    profiles = [
+        {
+            "name": entry.name,
+            "size": entry.stat().st_size,
+            "created_at": datetime.fromtimestamp(entry.stat().st_mtime).isoformat()
+        }
+        for entry in os.scandir(PROFILE_DIR) if entry.name.endswith(PROFILE_SUFFIX)
+    ]
+    profiles.sort(key=lambda profile: profile["created_at"], reverse=True)
+    return {"profiles": profiles}
+
+
+@app.get("/admin/profiles/{name}", dependencies=[Depends(require_profile_token)])
+async def get_profile(name: str):
+    path = os.path.join(PROFILE_DIR, os.path.basename(name))
+    if not name.endswith(PROFILE_SUFFIX) or not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Profil non trouvé")
+    with open(path, "rb") as profile_file:
+        return Response(content=profile_file.read(), media_type="application/json")
+
+
+# Cache local au worker, invalidé entre workers via Postgres LISTEN/NOTIFY
+CACHE_TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "300"))  # Filet de sécurité si un événement est perdu
+INVALIDATION_CHANNEL = "ent_invalidation"
+WORKER_ID = uuid.uuid4().hex
+
+
+class LocalCache:
+    """Thread-safe TTL cache keyed by (namespace, key).
+
+    Every invalidation bumps a version: a loader takes version() before
+    reading the source and passes it to set(), which drops the value if an
+    invalidation happened in between (the value may predate the write).
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries = {}
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def version(self) -> int:
+        with self._lock:
+            return self._version
+
+    def get(self, namespace: str, key: Optional[str] = None):
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[(namespace, key)]
+                return None
+            return value
+
+    def set(self, namespace: str, key: Optional[str], value, version: Optional[int] = None):
+        with self._lock:
+            if version is not None and version != self._version:
+                return  # Invalidé pendant le chargement
+            self._entries[(namespace, key)] = (value, time.monotonic() + self.ttl)
+
+    def invalidate(self, namespace: str, key: Optional[str] = None):
+        """Drop one entry, or the whole namespace when key is None"""
+        with self._lock:
+            self._version += 1
+            if key is not None:
+                self._entries.pop((namespace, key), None)
+            else:
+                for cache_key in [k for k in self._entries if k[0] == namespace]:
+                    del self._entries[cache_key]
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._entries.clear()
+
+
+local_cache = LocalCache(CACHE_TTL_SECONDS)
+
+
+def publish_invalidation(*events, cur=None):
+    """Evict locally, then NOTIFY the other workers. Each event is (namespace, key or None).
+
+    Pass the cursor of the write when it targets the main database so the
+    notification reuses that connection instead of opening a new one.
+    """
+    for namespace, key in events:
+        local_cache.invalidate(namespace, key)
+    payload = json.dumps({"origin": WORKER_ID, "events": [list(event) for event in events]})
+    try:
+        if cur is not None:
+            cur.execute("SELECT pg_notify(%s, %s)", (INVALIDATION_CHANNEL, payload))
+        else:
+            with get_db_connection() as conn:
+                with conn.cursor() as notify_cur:
+                    notify_cur.execute("SELECT pg_notify(%s, %s)", (INVALIDATION_CHANNEL, payload))
+    except Exception as e:
+        # Les autres workers retomberont sur le TTL
+        logger.error(f"Invalidation publish error: {str(e)}")
+
+
+def handle_invalidation(payload: str):
+    try:
+        message = json.loads(payload)
+    except ValueError:
+        logger.warning(f"Ignoring malformed invalidation payload: {payload}")
+        return
+    if message.get("origin") == WORKER_ID:
+        return  # Déjà évincé localement par publish_invalidation
+    for namespace, key in message.get("events", []):
+        local_cache.invalidate(namespace, key)
+
+
+def connect_invalidation_listener():
+    conn = psycopg2.connect(
+        host=os.getenv("DB_HOST"),
+        database=os.getenv("DB_NAME"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD")
+    )
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute(f"LISTEN {INVALIDATION_CHANNEL}")
+    return conn
+
+
+def ping_connection(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT 1")
+
+
+async def invalidation_listener():
+    """LISTEN for invalidation events and evict local entries, reconnecting with backoff"""
+    loop = asyncio.get_running_loop()
+    backoff = 1
+    while True:
+        conn = None
+        try:
+            # Connexion et ping dans le pool de threads : la boucle n'attend jamais Postgres
+            conn = await run_in_threadpool(connect_invalidation_listener)
+            # Des événements ont pu être manqués pendant la déconnexion
+            local_cache.clear()
+            backoff = 1
+            logger.info("Invalidation listener connected")
+
+            readable = asyncio.Event()
+            loop.add_reader(conn.fileno(), readable.set)
+            try:
+                while True:
+                    try:
+                        await asyncio.wait_for(readable.wait(), timeout=60)
+                    except asyncio.TimeoutError:
+                        # Vérifie que la connexion est toujours vivante
+                        await run_in_threadpool(ping_connection, conn)
+                    readable.clear()
+                    conn.poll()
+                    while conn.notifies:
+                        handle_invalidation(conn.notifies.pop(0).payload)
+            finally:
+                loop.remove_reader(conn.fileno())
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Invalidation listener error: {str(e)}, reconnecting in {backoff}s")
+            local_cache.clear()
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+        finally:
+            if conn is not None:
+                conn.close()
+
+
+invalidation_task = None
+
+
+@app.on_event("startup")
+async def start_invalidation_listener():
+    global invalidation_task
+    invalidation_task = asyncio.create_task(invalidation_listener())
+
+
+@app.on_event("shutdown")
+async def stop_invalidation_listener():
+    if invalidation_task is not None:
+        invalidation_task.cancel()
 
 
 # Définir le modèle d'annonce
@@ -116,32 +701,25 @@ async def get_admin_token():
         "username": ADMIN_USER,
         "password": ADMIN_PASSWORD
     }
-    response = requests.post(
-        f"{KEYCLOAK_URL}/realms/master/protocol/openid-connect/token",
-        data=data
-    )
+    with dependency_span("keycloak", "admin_token"):
+        response = requests.post(
+            f"{KEYCLOAK_URL}/realms/master/protocol/openid-connect/token",
+            data=data
+        )
     return response.json()["access_token"]
 
 
 async def get_current_user_roles(request: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
     try:
         token = credentials.credentials
-        logger.debug(f"Processing token: {token[:10]}...")
-        
-        # Try to extract roles directly from JWT without verification (for debugging)
-        try:
-            unverified_payload = jwt.decode(token, options={"verify_signature": False})
-            logger.debug(f"Unverified payload: {unverified_payload}")
-        except Exception as e:
-            logger.debug(f"Could not decode unverified token: {str(e)}")
         
         # Now perform the real verification
         try:
             jwks_url = f"{KEYCLOAK_URL}/realms/{REALM}/protocol/openid-connect/certs"
-            logger.debug(f"JWKS URL: {jwks_url}")
             
             jwks_client = PyJWKClient(jwks_url)
-            signing_key = jwks_client.get_signing_key_from_jwt(token)
+            with dependency_span("keycloak", "jwks"):
+                signing_key = jwks_client.get_signing_key_from_jwt(token)
             
             payload = jwt.decode(
                 token,
@@ -155,7 +733,9 @@ async def get_current_user_roles(request: Request, credentials: HTTPAuthorizatio
             )
             
             roles = payload.get("realm_access", {}).get("roles", [])
-            logger.debug(f"Extracted roles: {roles}")
+            logger.debug("Extracted roles: %s", roles)
+            # Identité vérifiée, réutilisée par la limitation de débit
+            request.state.user_id = payload.get("sub")
             return roles
         except Exception as e:
             logger.error(f"JWT verification error: {str(e)}")
@@ -169,6 +749,234 @@ async def get_current_user_roles(request: Request, credentials: HTTPAuthorizatio
         raise HTTPException(status_code=401, detail=f"Not authenticated: {str(e)}")
 
 
+# Limitation de débit (token bucket) par utilisateur ou par IP, et plafond de requêtes simultanées
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")  # "memory" ou "postgres" (partagé entre workers)
+RATE_LIMITS_ENABLED = os.getenv("RATE_LIMITS_ENABLED", "true").lower() == "true"
+# Proxys de confiance (IP ou CIDR, séparés par des virgules) dont on lit X-Forwarded-For
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(item.strip(), strict=False)
+    for item in os.getenv("TRUSTED_PROXIES", "").split(",") if item.strip()
+]
+
+
+def rate_limit_setting(route: str, default: tuple) -> tuple:
+    """RATE_LIMIT_<ROUTE>="jetons/s,capacité,simultanées" remplace la valeur par défaut"""
+    value = os.getenv(f"RATE_LIMIT_{route.upper()}")
+    if not value:
+        return default
+    rate, burst, max_concurrent = (part.strip() for part in value.split(","))
+    return float(rate), float(burst), int(max_concurrent)
+
+
+RATE_LIMITS = {
+    # route: (jetons par seconde, capacité du seau, requêtes simultanées max par client)
+    "upload": rate_limit_setting("upload", (0.5, 10, 2)),
+    "chat": rate_limit_setting("chat", (0.2, 5, 1)),
+    "signup": rate_limit_setting("signup", (0.05, 5, 1)),
+    "login": rate_limit_setting("login", (0.2, 10, 2)),
+}
+
+
+class MemoryTokenBuckets:
+    """Per-worker token buckets"""
+
+    MAX_KEYS = 50000
+
+    def __init__(self):
+        self._buckets = {}  # key -> [tokens, updated_at]
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, burst: float) -> float:
+        """Consume one token; return 0 if allowed, else the seconds to wait"""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= self.MAX_KEYS:
+                    self._buckets.clear()  # Des seaux pleins ne portent aucune information
+                bucket = self._buckets[key] = [burst, now]
+            tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if tokens >= 1:
+                bucket[0] = tokens - 1
+                return 0
+            bucket[0] = tokens
+            return (1 - tokens) / rate
+
+
+class PostgresTokenBuckets:
+    """Token buckets shared by every worker, one atomic upsert per check.
+
+    Each threadpool thread keeps its own connection across checks; rows idle
+    long enough to have refilled completely carry no information and are
+    purged periodically.
+    """
+
+    PURGE_INTERVAL = 300
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._next_purge = 0.0
+        # Au-delà, n'importe quel seau est de nouveau plein
+        self.idle_seconds = max(burst / rate for rate, burst, _ in RATE_LIMITS.values())
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or conn.closed:
+            with dependency_span("postgres", "connect"):
+                conn = psycopg2.connect(
+                    host=os.getenv("DB_HOST"),
+                    database=os.getenv("DB_NAME"),
+                    user=os.getenv("DB_USER"),
+                    password=os.getenv("DB_PASSWORD"),
+                    connection_factory=InstrumentedConnection
+                )
+            conn.autocommit = True
+            self._local.conn = conn
+        return conn
+
+    def take(self, key: str, rate: float, burst: float) -> float:
+        conn = self._connection()
+        try:
+            retry_after = self._take(conn, key, rate, burst)
+            self._purge(conn)
+        except psycopg2.Error:
+            # Connexion recréée au prochain appel
+            conn.close()
+            self._local.conn = None
+            raise
+        return retry_after
+
+    def _purge(self, conn):
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next_purge:
+                return
+            self._next_purge = now + self.PURGE_INTERVAL
+        with conn.cursor() as cur:
+            cur.execute(
+                "DELETE FROM rate_limit_buckets WHERE updated_at < clock_timestamp() - make_interval(secs => %s)",
+                (self.idle_seconds,)
+            )
+
+    def _take(self, conn, key: str, rate: float, burst: float) -> float:
+        params = {"key": key, "rate": rate, "burst": burst}
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO rate_limit_buckets AS b (bucket_key, tokens, updated_at)
+                VALUES (%(key)s, %(burst)s - 1, clock_timestamp())
+                ON CONFLICT (bucket_key) DO UPDATE SET
+                    tokens = LEAST(%(burst)s, b.tokens + EXTRACT(EPOCH FROM clock_timestamp() - b.updated_at) * %(rate)s) - 1,
+                    updated_at = clock_timestamp()
+                WHERE LEAST(%(burst)s, b.tokens + EXTRACT(EPOCH FROM clock_timestamp() - b.updated_at) * %(rate)s) >= 1
+                RETURNING tokens
+            """, params)
+            if cur.fetchone() is not None:
+                return 0
+            cur.execute("""
+                SELECT LEAST(%(burst)s, tokens + EXTRACT(EPOCH FROM clock_timestamp() - updated_at) * %(rate)s)
+                FROM rate_limit_buckets WHERE bucket_key = %(key)s
+            """, params)
+            row = cur.fetchone()
+            tokens = float(row[0]) if row else 0.0
+            return max(0.0, (1 - tokens) / rate)
+
+
+token_buckets = PostgresTokenBuckets() if RATE_LIMIT_BACKEND == "postgres" else MemoryTokenBuckets()
+in_flight_requests = {}  # (route, identité) -> nombre de requêtes en cours dans ce worker
+
+
+def is_trusted_proxy(address: str) -> bool:
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return any(ip in network for network in TRUSTED_PROXIES)
+
+
+def client_ip(request: Request) -> str:
+    """Client address, taken from X-Forwarded-For only when the peer is a trusted proxy"""
+    host = request.client.host if request.client else "unknown"
+    if not is_trusted_proxy(host):
+        return host
+    forwarded = [part.strip() for part in request.headers.get("x-forwarded-for", "").split(",") if part.strip()]
+    # De droite à gauche : la première adresse qui n'est pas un de nos proxys est le client
+    for address in reversed(forwarded):
+        if not is_trusted_proxy(address):
+            return address
+    return forwarded[0] if forwarded else host
+
+
+class RateLimit:
+    """Dependency enforcing RATE_LIMITS[route] for anonymous routes (keyed by client IP)"""
+
+    def __init__(self, route: str):
+        self.route = route
+        self.rate, self.burst, self.max_concurrent = RATE_LIMITS[route]
+
+    def identity(self, request: Request) -> str:
+        user_id = getattr(request.state, "user_id", None)
+        if user_id:
+            return f"user:{user_id}"
+        return f"ip:{client_ip(request)}"
+
+    async def acquire(self, request: Request) -> Optional[tuple]:
+        """Take a token and an in-flight slot, or raise 429"""
+        if not RATE_LIMITS_ENABLED:
+            return None
+        identity = self.identity(request)
+        key = f"{self.route}:{identity}"
+        if RATE_LIMIT_BACKEND == "postgres":
+            retry_after = await run_in_threadpool(token_buckets.take, key, self.rate, self.burst)
+        else:
+            retry_after = token_buckets.take(key, self.rate, self.burst)
+        if retry_after:
+            logger.warning(f"Rate limit exceeded on {self.route} for {identity}")
+            raise HTTPException(
+                status_code=429,
+                detail="Trop de requêtes, veuillez réessayer plus tard",
+                headers={"Retry-After": str(math.ceil(retry_after))}
+            )
+
+        in_flight_key = (self.route, identity)
+        if in_flight_requests.get(in_flight_key, 0) >= self.max_concurrent:
+            raise HTTPException(
+                status_code=429,
+                detail="Trop de requêtes simultanées",
+                headers={"Retry-After": "1"}
+            )
+        in_flight_requests[in_flight_key] = in_flight_requests.get(in_flight_key, 0) + 1
+        return in_flight_key
+
+    def release(self, in_flight_key: Optional[tuple]):
+        if in_flight_key is None:
+            return
+        remaining = in_flight_requests[in_flight_key] - 1
+        if remaining:
+            in_flight_requests[in_flight_key] = remaining
+        else:
+            del in_flight_requests[in_flight_key]
+
+    async def __call__(self, request: Request):
+        in_flight_key = await self.acquire(request)
+        try:
+            yield
+        finally:
+            self.release(in_flight_key)
+
+
+class UserRateLimit(RateLimit):
+    """Same limits, keyed by the authenticated user (authentication runs first)"""
+
+    async def __call__(self, request: Request, roles: list = Depends(get_current_user_roles)):
+        in_flight_key = await self.acquire(request)
+        try:
+            yield
+        finally:
+            self.release(in_flight_key)
+
+
 
 # Configuration email
 EMAIL_HOST = os.getenv("EMAIL_HOST", "smtp.gmail.com")
@@ -176,6 +984,7 @@ EMAIL_PORT = int(os.getenv("EMAIL_PORT", "587"))
 EMAIL_USERNAME = os.getenv("EMAIL_USERNAME")
 EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD")
 EMAIL_FROM = os.getenv("EMAIL_FROM", EMAIL_USERNAME)
+SMTP_DEBUG = os.getenv("SMTP_DEBUG", "false").lower() == "true"
 
 
 async def get_student_emails():
@@ -186,10 +995,11 @@ async def get_student_emails():
         
         # Récupérer les utilisateurs avec le rôle "etudiant"
         # 1. D'abord, obtenez l'ID du rôle "etudiant"
-        role_response = requests.get(
-            f"{KEYCLOAK_URL}/admin/realms/{REALM}/roles/etudiant",
-            headers=headers
-        )
+        with dependency_span("keycloak", "get_role"):
+            role_response = requests.get(
+                f"{KEYCLOAK_URL}/admin/realms/{REALM}/roles/etudiant",
+                headers=headers
+            )
         if role_response.status_code != 200:
             logger.error("Impossible de récupérer le rôle 'etudiant'")
             return []
@@ -197,10 +1007,11 @@ async def get_student_emails():
         etudiant_role_id = role_response.json()["id"]
         
         # 2. Récupérer les utilisateurs qui ont ce rôle
-        users_response = requests.get(
-            f"{KEYCLOAK_URL}/admin/realms/{REALM}/roles/etudiant/users",
-            headers=headers
-        )
+        with dependency_span("keycloak", "role_users"):
+            users_response = requests.get(
+                f"{KEYCLOAK_URL}/admin/realms/{REALM}/roles/etudiant/users",
+                headers=headers
+            )
         
         if users_response.status_code != 200:
             logger.error("Impossible de récupérer les utilisateurs avec le rôle 'etudiant'")
@@ -237,9 +1048,10 @@ async def send_notification_email(background_tasks: BackgroundTasks, folder: str
 async def send_emails_to_students(recipients: list, folder: str, file_name: str):
     try:
         # Configuration du serveur SMTP
-        server = smtplib.SMTP(EMAIL_HOST, EMAIL_PORT)
-        server.starttls()
-        server.login(EMAIL_USERNAME, EMAIL_PASSWORD)
+        with dependency_span("smtp", "connect"):
+            server = smtplib.SMTP(EMAIL_HOST, EMAIL_PORT)
+            server.starttls()
+            server.login(EMAIL_USERNAME, EMAIL_PASSWORD)
         
         # Création du message
         subject = f"Nouveau document disponible : {file_name}"
@@ -262,8 +1074,9 @@ async def send_emails_to_students(recipients: list, folder: str, file_name: str)
         
         msg.attach(MIMEText(body, 'html'))
         
-        server.send_message(msg)
-        server.quit()
+        with dependency_span("smtp", "send"):
+            server.send_message(msg)
+            server.quit()
         
         logger.info(f"Notification envoyée à {len(recipients)} étudiants")
         
@@ -281,21 +1094,22 @@ async def check_role(required_role: str, roles: list = Depends(get_current_user_
 
 
 # Endpoint de login
-@app.post("/login")
+@app.post("/login", dependencies=[Depends(RateLimit("login"))])
 async def login(credentials: LoginRequest, response:Response):
     try:
         # Appel à Keycloak
-        keycloak_response = requests.post(
-            f"{os.getenv('KEYCLOAK_URL')}/realms/{os.getenv('KEYCLOAK_REALM')}/protocol/openid-connect/token",
-            data={
-                "grant_type": "password",
-                "client_id": "ENT",
-                "client_secret": os.getenv("KEYCLOAK_CLIENT_SECRET"),
-                "username": credentials.username,
-                "password": credentials.password
-            },
-            headers={"Content-Type": "application/x-www-form-urlencoded"}
-        )
+        with dependency_span("keycloak", "password_grant"):
+            keycloak_response = requests.post(
+                f"{os.getenv('KEYCLOAK_URL')}/realms/{os.getenv('KEYCLOAK_REALM')}/protocol/openid-connect/token",
+                data={
+                    "grant_type": "password",
+                    "client_id": "ENT",
+                    "client_secret": os.getenv("KEYCLOAK_CLIENT_SECRET"),
+                    "username": credentials.username,
+                    "password": credentials.password
+                },
+                headers={"Content-Type": "application/x-www-form-urlencoded"}
+            )
         keycloak_response.raise_for_status()
         token_data=keycloak_response.json()
 
@@ -329,79 +1143,134 @@ async def login(credentials: LoginRequest, response:Response):
 
 
 
-@app.post("/signup")
-async def signup(user_data: dict):
-    try:
-        # 1. Création de l'utilisateur
-        admin_token = await get_admin_token()
-        headers = {
-            "Authorization": f"Bearer {admin_token}",
-            "Content-Type": "application/json"
-        }
-        
-        # Validation des données
-        required_fields = ["username", "email", "firstName", "lastName", "password", "role"]
-        for field in required_fields:
-            if field not in user_data:
-                raise HTTPException(status_code=400, detail=f"Champ manquant: {field}")
-
-        # 2. Création du payload utilisateur
-        user_payload = {
-            "username": user_data["username"],
-            "email": user_data["email"],
-            "firstName": user_data["firstName"],
-            "lastName": user_data["lastName"],
-            "enabled": user_data.get("enabled", False),
-            "emailVerified": user_data.get("emailVerified", False),
-            "credentials": [{
-                "type": "password",
-                "value": user_data["password"],
-                "temporary": False
-            }]
-        }
+# Client de l'API d'administration Keycloak : un seul token admin réutilisé
+# (renouvelé avant expiration) et rôles mis en cache
+class KeycloakAdmin:
+    TOKEN_MARGIN_SECONDS = 30
+
+    def __init__(self):
+        self.http = requests.Session()
+        self.http.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=32))
+        self.http.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=32))
+        self._token = None
+        self._expires_at = 0.0
+        self._roles = {}
+        self._lock = threading.Lock()
+
+    def token(self, force_refresh: bool = False) -> str:
+        with self._lock:
+            if force_refresh or self._token is None or time.monotonic() >= self._expires_at:
+                with dependency_span("keycloak", "admin_token"):
+                    response = self.http.post(
+                        f"{KEYCLOAK_URL}/realms/master/protocol/openid-connect/token",
+                        data={
+                            "grant_type": "password",
+                            "client_id": "admin-cli",
+                            "username": ADMIN_USER,
+                            "password": ADMIN_PASSWORD
+                        }
+                    )
+                response.raise_for_status()
+                token_data = response.json()
+                self._token = token_data["access_token"]
+                self._expires_at = time.monotonic() + token_data.get("expires_in", 60) - self.TOKEN_MARGIN_SECONDS
+            return self._token
+
+    def request(self, method: str, path: str, operation: str, **kwargs):
+        """Call the realm admin API, retrying once with a fresh token on 401"""
+        for attempt in range(2):
+            headers = {"Authorization": f"Bearer {self.token(force_refresh=attempt > 0)}"}
+            with dependency_span("keycloak", operation):
+                response = self.http.request(
+                    method, f"{KEYCLOAK_URL}/admin/realms/{REALM}{path}", headers=headers, **kwargs
+                )
+            if response.status_code != 401:
+                return response
+        return response
+
+    def role(self, role_name: str) -> dict:
+        role_data = self._roles.get(role_name)
+        if role_data is None:
+            role_response = self.request("GET", f"/roles/{role_name}", "get_role")
+            if role_response.status_code != 200:
+                raise HTTPException(status_code=400, detail="Ce rôle n'existe pas dans Keycloak")
+            role_data = self._roles[role_name] = role_response.json()
+        return role_data
+
+
+keycloak_admin = KeycloakAdmin()
+
+SIGNUP_REQUIRED_FIELDS = ["username", "email", "firstName", "lastName", "password", "role"]
+SIGNUP_ALLOWED_ROLES = ["etudiant", "prof"]
+ADMIN_ROLE = "admin"
+
+
+def provision_user(user_data: dict, enabled: Optional[bool] = None, allowed_roles: list = SIGNUP_ALLOWED_ROLES) -> str:
+    """Create a Keycloak user and map its realm role; return the new user id"""
+    # Validation des données
+    for field in SIGNUP_REQUIRED_FIELDS:
+        if not user_data.get(field):
+            raise HTTPException(status_code=400, detail=f"Champ manquant: {field}")
+
+    role_name = user_data["role"]
+    if role_name not in allowed_roles:
+        raise HTTPException(status_code=400, detail=f"Rôle invalide. Choix possibles: {', '.join(allowed_roles)}")
+    # Récupération du rôle (en cache) avant de créer l'utilisateur
+    role_data = keycloak_admin.role(role_name)
+
+    # Création du payload utilisateur
+    user_payload = {
+        "username": user_data["username"],
+        "email": user_data["email"],
+        "firstName": user_data["firstName"],
+        "lastName": user_data["lastName"],
+        "enabled": enabled if enabled is not None else user_data.get("enabled", False),
+        "emailVerified": user_data.get("emailVerified", False),
+        "credentials": [{
+            "type": "password",
+            "value": user_data["password"],
+            "temporary": False
+        }]
+    }
 
-        # 3. Création de l'utilisateur dans Keycloak
-        response = requests.post(
-            f"{KEYCLOAK_URL}/admin/realms/{REALM}/users",
-            json=user_payload,
-            headers=headers
-        )
-        
-        if response.status_code != 201:
+    # Création de l'utilisateur dans Keycloak
+    response = keycloak_admin.request("POST", "/users", "create_user", json=user_payload)
+    if response.status_code != 201:
+        try:
             error = response.json().get("errorMessage", "Erreur inconnue de Keycloak")
-            raise HTTPException(status_code=400, detail=error)
+        except ValueError:
+            error = "Erreur inconnue de Keycloak"
+        raise HTTPException(status_code=400, detail=error)
 
-        # 4. Récupération de l'ID utilisateur
-        user_id = response.headers["Location"].split("/")[-1]
+    # Récupération de l'ID utilisateur
+    user_id = response.headers["Location"].split("/")[-1]
 
-        # 5. Gestion des rôles
-        role_name = user_data["role"]
-        allowed_roles = ["etudiant", "prof"]
-        
-        if role_name not in allowed_roles:
-            raise HTTPException(status_code=400, detail="Rôle invalide. Choix possibles: etudiant, prof")
-
-        # Récupération du rôle depuis Keycloak
-        role_response = requests.get(
-            f"{KEYCLOAK_URL}/admin/realms/{REALM}/roles/{role_name}",
-            headers=headers
+    # Assignation du rôle ; en cas d'échec l'utilisateur est supprimé pour ne pas laisser
+    # un compte sans rôle (et permettre de relancer l'import avec le même username)
+    try:
+        assignment_response = keycloak_admin.request(
+            "POST", f"/users/{user_id}/role-mappings/realm", "assign_role", json=[role_data]
         )
-        
-        if role_response.status_code != 200:
-            raise HTTPException(status_code=400, detail="Ce rôle n'existe pas dans Keycloak")
-
-        role_data = role_response.json()
+        assigned = assignment_response.status_code == 204
+    except requests.exceptions.RequestException as e:
+        logger.error(f"Keycloak role assignment error for {user_id}: {str(e)}")
+        assigned = False
+    if not assigned:
+        try:
+            delete_response = keycloak_admin.request("DELETE", f"/users/{user_id}", "delete_user")
+            if delete_response.status_code != 204:
+                logger.error(f"Rollback of user {user_id} failed: HTTP {delete_response.status_code}")
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Rollback of user {user_id} failed: {str(e)}")
+        raise HTTPException(status_code=500, detail="Échec de l'assignation du rôle")
 
-        # Assignation du rôle
-        assignment_response = requests.post(
-            f"{KEYCLOAK_URL}/admin/realms/{REALM}/users/{user_id}/role-mappings/realm",
-            json=[role_data],
-            headers=headers
-        )
+    return user_id
 
-        if assignment_response.status_code != 204:
-            raise HTTPException(status_code=500, detail="Échec de l'assignation du rôle")
 
+@app.post("/signup", dependencies=[Depends(RateLimit("signup"))])
+async def signup(user_data: dict):
+    try:
+        await run_in_threadpool(provision_user, user_data)
         return {"status": "success", "message": "Utilisateur créé avec succès"}
 
     except HTTPException as he:
@@ -409,26 +1278,233 @@ async def signup(user_data: dict):
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erreur serveur: {str(e)}")
 
+
+# Import en masse (CSV ou JSON) avec provisionnement concurrent borné
+BULK_IMPORT_CONCURRENCY = int(os.getenv("BULK_IMPORT_CONCURRENCY", "8"))
+BULK_IMPORT_MAX_ROWS = int(os.getenv("BULK_IMPORT_MAX_ROWS", "10000"))
+
+
+@app.post("/signup/bulk")
+async def bulk_signup(request: Request, roles: list = Depends(get_current_user_roles)):
+    """Provision many users at once.
+
+    Accepts either JSON ``{"users": [...], "enable": true}`` or a CSV file
+    (multipart field ``file``, optional form field ``enable``) with the columns
+    username,email,firstName,lastName,password,role. Returns one result per row.
+    Professors can only import students; admins can import any signup role.
+    """
+    if ADMIN_ROLE in roles:
+        allowed_roles = SIGNUP_ALLOWED_ROLES
+    elif "prof" in roles:
+        allowed_roles = ["etudiant"]
+    else:
+        raise HTTPException(status_code=403, detail="Seuls les professeurs peuvent importer des utilisateurs")
+
+    content_type = request.headers.get("content-type", "")
+    try:
+        if content_type.startswith("multipart/form-data"):
+            form = await request.form()
+            upload = form.get("file")
+            if upload is None:
+                raise HTTPException(status_code=400, detail="Fichier CSV manquant")
+            rows = list(csv.DictReader(io.StringIO((await upload.read()).decode("utf-8-sig"))))
+            enable = str(form.get("enable", "false")).lower() == "true"
+        elif content_type.startswith("text/csv"):
+            rows = list(csv.DictReader(io.StringIO((await request.body()).decode("utf-8-sig"))))
+            enable = request.query_params.get("enable", "false").lower() == "true"
+        else:
+            data = await request.json()
+            rows = data.get("users", [])
+            enable = bool(data.get("enable", False))
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Données d'import invalides: {str(e)}")
+
+    if not isinstance(rows, list):
+        raise HTTPException(status_code=400, detail="'users' doit être une liste")
+    if len(rows) > BULK_IMPORT_MAX_ROWS:
+        raise HTTPException(status_code=400, detail=f"Trop de lignes (maximum {BULK_IMPORT_MAX_ROWS})")
+
+    semaphore = asyncio.Semaphore(BULK_IMPORT_CONCURRENCY)
+
+    async def import_row(index: int, user_data: dict):
+        result = {"row": index + 1, "username": user_data.get("username") if isinstance(user_data, dict) else None}
+        async with semaphore:
+            try:
+                if not isinstance(user_data, dict):
+                    raise HTTPException(status_code=400, detail="Ligne invalide")
+                result["user_id"] = await run_in_threadpool(provision_user, user_data, enable, allowed_roles)
+                result["status"] = "created"
+            except HTTPException as he:
+                result["status"] = "error"
+                result["detail"] = he.detail
+            except Exception as e:
+                result["status"] = "error"
+                result["detail"] = f"Erreur serveur: {str(e)}"
+        return result
+
+    results = await asyncio.gather(*(import_row(index, row) for index, row in enumerate(rows)))
+    created = sum(1 for result in results if result["status"] == "created")
+    logger.info(f"Bulk import: {created}/{len(results)} utilisateurs créés")
+    return {
+        "status": "success" if created == len(results) else "partial",
+        "created": created,
+        "failed": len(results) - created,
+        "enabled": enable,
+        "results": results
+    }
+
 # Configuration MinIO
 minio_client = Minio(
     "localhost:9000",
     access_key=os.getenv("MINIO_ROOT_USER"),
     secret_key=os.getenv("MINIO_ROOT_PASSWORD"),
-    secure=False
+    secure=False,
+    http_client=InstrumentedPoolManager(
+        timeout=urllib3.Timeout(connect=300, read=300),
+        maxsize=10,
+        retries=urllib3.Retry(total=5, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504])
+    )
 )
 
+
+# Aperçus et vignettes, stockés à côté de l'original dans <dossier>/.previews/
+PREVIEW_DIR = ".previews"
+PREVIEW_SIZES = {"thumb": (200, 200), "preview": (800, 800)}
+PREVIEW_CACHE_CONTROL = "public, max-age=31536000, immutable"  # Les noms d'objets contiennent un uuid
+preview_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("PREVIEW_WORKERS", "2")),
+    thread_name_prefix="preview"
+)
+# Nombre maximal d'aperçus en attente ou en cours ; au-delà, l'upload n'en génère pas
+preview_slots = threading.BoundedSemaphore(int(os.getenv("PREVIEW_QUEUE_SIZE", "32")))
+
+
+def is_derived_object(object_name: str) -> bool:
+    """True for generated preview objects, which must not show up in listings"""
+    return object_name.startswith(f"{PREVIEW_DIR}/") or f"/{PREVIEW_DIR}/" in object_name
+
+
+def preview_object_name(file_path: str, size: str) -> str:
+    folder, _, file_name = file_path.rpartition('/')
+    if not folder:
+        # Objet à la racine du bucket
+        return f"{PREVIEW_DIR}/{file_name}.{size}.jpg"
+    return f"{folder}/{PREVIEW_DIR}/{file_name}.{size}.jpg"
+
+
+def is_previewable(content_type: Optional[str], file_name: str) -> bool:
+    content_type = content_type or ""
+    if content_type == "application/pdf" or file_name.lower().endswith(".pdf"):
+        return fitz is not None and Image is not None
+    return content_type.startswith("image/") and Image is not None
+
+
+def schedule_previews(file_path: str, content_type: Optional[str]):
+    """Queue preview generation unless the queue is full; only the object name is queued"""
+    if not preview_slots.acquire(blocking=False):
+        logger.warning("Preview queue full, skipping previews for %s", file_path)
+        return
+    try:
+        future = preview_executor.submit(generate_previews, file_path, content_type)
+    except RuntimeError:
+        preview_slots.release()
+        raise
+    future.add_done_callback(lambda _future: preview_slots.release())
+
+
+def generate_previews(file_path: str, content_type: Optional[str]):
+    """Render the first page (PDF) or the image itself into small JPEG derivatives"""
+    response = None
+    try:
+        # Relu depuis MinIO par le worker : la file d'attente ne retient pas le contenu des uploads
+        response = minio_client.get_object("my-bucket", file_path)
+        content = response.read()
+        if content_type == "application/pdf" or file_path.lower().endswith(".pdf"):
+            with fitz.open(stream=content, filetype="pdf") as document:
+                if document.page_count == 0:
+                    return
+                pixmap = document.load_page(0).get_pixmap(dpi=100)
+                image = Image.frombytes("RGB", (pixmap.width, pixmap.height), pixmap.samples)
+        else:
+            image = Image.open(io.BytesIO(content))
+            image.draft("RGB", PREVIEW_SIZES["preview"])  # Décodage JPEG réduit quand c'est possible
+
+        image = image.convert("RGB")
+        for size, dimensions in PREVIEW_SIZES.items():
+            derived = image.copy()
+            derived.thumbnail(dimensions)
+            buffer = io.BytesIO()
+            derived.save(buffer, format="JPEG", quality=80, optimize=True)
+            minio_client.put_object(
+                bucket_name="my-bucket",
+                object_name=preview_object_name(file_path, size),
+                data=io.BytesIO(buffer.getvalue()),
+                length=buffer.tell(),
+                content_type="image/jpeg"
+            )
+        logger.debug("Previews generated for %s", file_path)
+    except Exception as e:
+        logger.error(f"Preview generation error for {file_path}: {str(e)}")
+    finally:
+        if response is not None:
+            response.close()
+            response.release_conn()
+
+
+def delete_previews(file_path: str):
+    names = [DeleteObject(preview_object_name(file_path, size)) for size in PREVIEW_SIZES]
+    for error in minio_client.remove_objects("my-bucket", names):
+        logger.error(f"MinIO error deleting preview {error.name}: {error.message}")
+
+
+def load_folders() -> list:
+    """Folder list, served from the local cache when possible"""
+    cached = local_cache.get("folders")
+    if cached is not None:
+        return cached
+    version = local_cache.version()
+    folders = set()
+    objects = minio_client.list_objects("my-bucket", recursive=True)
+    for obj in objects:
+        if is_derived_object(obj.object_name):
+            continue
+        parts = obj.object_name.split('/')
+        if len(parts) > 1:
+            # Récupère le chemin complet du dossier parent
+            folder_path = '/'.join(parts[:-1])
+            folders.add(folder_path)
+    folders = list(folders)
+    local_cache.set("folders", None, folders, version)
+    return folders
+
+
+def load_folder_files(folder: str) -> list:
+    """Direct children of a folder, served from the local cache when possible"""
+    folder = folder.strip("/")  # Même clé de cache que les invalidations, même préfixe MinIO
+    cached = local_cache.get("files", folder)
+    if cached is not None:
+        return cached
+    version = local_cache.version()
+    files = []
+    objects = minio_client.list_objects("my-bucket", prefix=f"{folder}/")
+    for obj in objects:
+        if is_derived_object(obj.object_name):
+            continue
+        files.append({
+            "name": obj.object_name.split('/')[-1],
+            "size": obj.size,
+            "url": f"/download/{obj.object_name}"
+        })
+    local_cache.set("files", folder, files, version)
+    return files
+
+
 @app.get("/courses")
 async def list_courses():
     try:
-        folders = set()
-        objects = minio_client.list_objects("my-bucket", recursive=True)
-        for obj in objects:
-            parts = obj.object_name.split('/')
-            if len(parts) > 1:
-                # Récupère le chemin complet du dossier parent
-                folder_path = '/'.join(parts[:-1])
-                folders.add(folder_path)
-        return {"folders": list(folders)}
+        return ORJSONResponse({"folders": load_folders()})
     except S3Error as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -438,15 +1514,7 @@ async def list_courses():
 @app.get("/courses/{folder:path}/files")
 async def list_files(folder: str):
     try:
-        files = []
-        objects = minio_client.list_objects("my-bucket", prefix=f"{folder}/")
-        for obj in objects:
-            files.append({
-                "name": obj.object_name.split('/')[-1],
-                "size": obj.size,
-                "url": f"/download/{obj.object_name}"
-            })
-        return {"files": files}
+        return ORJSONResponse({"files": load_folder_files(folder)})
     except S3Error as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -463,12 +1531,36 @@ async def generate_download_url(file_path: str):
             },
             expires=timedelta(hours=1))
         return {"url": url}
-    except S3Error as e:
+    except S3Error:
         raise HTTPException(status_code=404, detail="File not found")
 
 
+# Endpoint pour servir l'aperçu ou la vignette d'un fichier
+@app.get("/previews/{file_path:path}")
+async def get_preview(file_path: str, size: str = "thumb", roles: list = Depends(get_current_user_roles)):
+    if not roles:
+        raise HTTPException(status_code=401, detail="Authentification requise")
+    if size not in PREVIEW_SIZES:
+        raise HTTPException(status_code=400, detail="Taille invalide. Choix possibles: thumb, preview")
+    response = None
+    try:
+        response = minio_client.get_object("my-bucket", preview_object_name(file_path, size))
+        data = response.read()
+        return Response(
+            content=data,
+            media_type="image/jpeg",
+            headers={"Cache-Control": PREVIEW_CACHE_CONTROL}
+        )
+    except S3Error:
+        raise HTTPException(status_code=404, detail="Aperçu non disponible")
+    finally:
+        if response is not None:
+            response.close()
+            response.release_conn()
+
+
 # Endpoint pour uploader un fichier
-@app.post("/upload")
+@app.post("/upload", dependencies=[Depends(UserRateLimit("upload"))])
 async def upload_file(
     request: Request,
     background_tasks: BackgroundTasks,
@@ -478,7 +1570,7 @@ async def upload_file(
     roles: list = Depends(get_current_user_roles)
 ):
     
-    logger.debug(f"Upload attempt: file={file.filename}, folder={folder}, roles={roles}")
+    logger.debug("Upload attempt: file=%s, folder=%s, roles=%s", file.filename, folder, roles)
 
     # Verify if user is a professor
     if "prof" not in roles:
@@ -516,7 +1608,7 @@ async def upload_file(
             try:
                 payload = jwt.decode(token, options={"verify_signature": False}, algorithms=["RS256"])
                 uploader = payload.get("name") or payload.get("sub") or "unknown"
-                logger.debug(f"Uploader extrait : {uploader}")
+                logger.debug("Uploader extrait : %s", uploader)
             except Exception as e:
                 logger.error(f"Erreur lors de l'extraction du nom d'utilisateur: {str(e)}")
             
@@ -545,12 +1637,23 @@ async def upload_file(
                     description
                 ))
                 metadata_id = cur.fetchone()[0]
-                logger.debug(f"File metadata stored with ID: {metadata_id}")
+                logger.debug("File metadata stored with ID: %s", metadata_id)
+
+        # Le listing de chaque parent change si l'upload crée un nouveau sous-dossier
+        folder_parts = folder.strip("/").split("/")
+        publish_invalidation(
+            ("folders", None),
+            *[("files", "/".join(folder_parts[:i])) for i in range(1, len(folder_parts) + 1)]
+        )
+
+        # Génération des aperçus en arrière-plan (pool de workers dédié)
+        if is_previewable(file.content_type, file.filename):
+            schedule_previews(file_path, file.content_type)
 
         # Send notification to students
         await send_notification_email(background_tasks, folder, file.filename)
         
-        logger.debug(f"File uploaded successfully: {file_path}")
+        logger.debug("File uploaded successfully: %s", file_path)
         return {"status": "success", "path": file_path, "metadata_id": metadata_id}
     
     except S3Error as e:
@@ -571,8 +1674,8 @@ async def upload_file(
 # Endpoint pour supprimer un fichier
 @app.delete("/files/{file_path:path}")
 async def delete_file(file_path: str, roles: list = Depends(get_current_user_roles)):
-    logger.debug(f"Delete request for file: {file_path}")
-    logger.debug(f"User roles: {roles}")
+    logger.debug("Delete request for file: %s", file_path)
+    logger.debug("User roles: %s", roles)
     
     # Check professor role
     if "prof" not in roles:
@@ -580,7 +1683,7 @@ async def delete_file(file_path: str, roles: list = Depends(get_current_user_rol
         raise HTTPException(status_code=403, detail="Seuls les professeurs peuvent supprimer des fichiers")
     
     try:
-        logger.debug(f"Checking if file exists: {file_path}")
+        logger.debug("Checking if file exists: %s", file_path)
         
         # Check if file exists first
         try:
@@ -598,7 +1701,7 @@ async def delete_file(file_path: str, roles: list = Depends(get_current_user_rol
             path_parts = file_path.split('/')
             file_name_parts = path_parts[-1].split('_', 1)
             file_uuid = file_name_parts[0]
-            logger.debug(f"Extracted file_uuid: {file_uuid}")
+            logger.debug("Extracted file_uuid: %s", file_uuid)
         except Exception as e:
             logger.error(f"Error extracting file_uuid: {str(e)}")
             file_uuid = None
@@ -616,7 +1719,7 @@ async def delete_file(file_path: str, roles: list = Depends(get_current_user_rol
                         
                         result = cur.fetchone()
                         if result:
-                            logger.debug(f"Deleted metadata with ID: {result[0]}")
+                            logger.debug("Deleted metadata with ID: %s", result[0])
                         else:
                             logger.warning(f"No metadata found for file_uuid: {file_uuid}")
             except Exception as e:
@@ -627,6 +1730,18 @@ async def delete_file(file_path: str, roles: list = Depends(get_current_user_rol
         logger.debug("Attempting to remove file from storage")
         minio_client.remove_object("my-bucket", file_path)
         logger.debug("File deleted successfully")
+
+        publish_invalidation(
+            ("folders", None),
+            ("files", file_path.rpartition('/')[0]),
+            ("metadata", file_path)
+        )
+
+        # Supprimer les aperçus dérivés (absents si le fichier n'était pas prévisualisable)
+        try:
+            delete_previews(file_path)
+        except Exception as e:
+            logger.error(f"Error deleting previews: {str(e)}")
         
         return {"status": "success", "message": "Fichier et métadonnées supprimés avec succès"}
     
@@ -639,6 +1754,164 @@ async def delete_file(file_path: str, roles: list = Depends(get_current_user_rol
         logger.error(f"Server error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Erreur serveur: {str(e)}")
 
+
+# Suppression récursive d'un dossier par lots (multi-object delete MinIO)
+FOLDER_DELETE_BATCH_SIZE = 1000  # Limite imposée par l'API S3 DeleteObjects
+FOLDER_DELETE_JOB_RETENTION_DAYS = int(os.getenv("FOLDER_DELETE_JOB_RETENTION_DAYS", "7"))
+FOLDER_DELETE_COUNTERS = ("listed_objects", "deleted_objects", "failed_objects", "deleted_metadata")
+folder_delete_jobs = {}  # job_id -> progression, seulement pendant l'exécution dans ce worker
+
+
+def save_folder_delete_job(job: dict):
+    """Persist the job state in folder_delete_jobs so any worker can report it, even after a restart"""
+    counters = {name: job[name] for name in FOLDER_DELETE_COUNTERS}
+    try:
+        with get_metadata_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO folder_delete_jobs
+                        (job_id, folder, status, counters, failed_paths, error, started_at, finished_at)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                    ON CONFLICT (job_id) DO UPDATE SET
+                        status = EXCLUDED.status,
+                        counters = EXCLUDED.counters,
+                        failed_paths = EXCLUDED.failed_paths,
+                        error = EXCLUDED.error,
+                        finished_at = EXCLUDED.finished_at,
+                        updated_at = CURRENT_TIMESTAMP
+                """, (
+                    job["job_id"], job["folder"], job["status"], json.dumps(counters),
+                    json.dumps(job.get("failed_paths", [])), job.get("error"),
+                    job["started_at"], job["finished_at"]
+                ))
+                if job["status"] == "pending":
+                    # Les tâches terminées ne sont conservées que pendant la période de rétention
+                    cur.execute(
+                        "DELETE FROM folder_delete_jobs WHERE finished_at < CURRENT_TIMESTAMP - make_interval(days => %s)",
+                        (FOLDER_DELETE_JOB_RETENTION_DAYS,)
+                    )
+    except Exception as e:
+        logger.error(f"Folder delete {job['job_id']}: state save error: {str(e)}")
+
+
+def escape_like(value: str) -> str:
+    """Escape LIKE wildcards so a folder name is matched literally"""
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def delete_folder_job(job_id: str, folder: str):
+    """Stream the folder listing, remove objects in batches, then drop metadata in one statement"""
+    job = folder_delete_jobs[job_id]
+    job["status"] = "running"
+    failed_paths = []
+
+    def remove_batch(batch):
+        # remove_objects est paresseux : il faut consommer l'itérateur d'erreurs
+        errors = list(minio_client.remove_objects("my-bucket", batch))
+        for error in errors:
+            logger.error(f"MinIO error deleting {error.name}: {error.message}")
+            failed_paths.append(error.name)
+        job["deleted_objects"] += len(batch) - len(errors)
+        job["failed_objects"] += len(errors)
+        save_folder_delete_job(job)
+        logger.info(
+            f"Folder delete {job_id}: {job['deleted_objects']} objets supprimés, "
+            f"{job['failed_objects']} échecs"
+        )
+
+    try:
+        batch = []
+        objects = minio_client.list_objects("my-bucket", prefix=f"{folder}/", recursive=True)
+        for obj in objects:
+            batch.append(DeleteObject(obj.object_name))
+            job["listed_objects"] += 1
+            if len(batch) >= FOLDER_DELETE_BATCH_SIZE:
+                remove_batch(batch)
+                batch = []
+        if batch:
+            remove_batch(batch)
+
+        # Une seule requête ensembliste pour toutes les métadonnées du dossier
+        with get_metadata_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    DELETE FROM files_metadata
+                    WHERE (folder_path = %s OR folder_path LIKE %s)
+                      AND NOT (storage_path = ANY(%s))
+                """, (folder, f"{escape_like(folder)}/%", failed_paths))
+                job["deleted_metadata"] = cur.rowcount
+
+        publish_invalidation(("folders", None), ("files", None), ("metadata", None))
+
+        job["status"] = "completed" if not failed_paths else "completed_with_errors"
+        job["failed_paths"] = failed_paths[:100]
+    except Exception as e:
+        logger.error(f"Folder delete {job_id} error: {str(e)}")
+        job["status"] = "failed"
+        job["error"] = str(e)
+    finally:
+        job["finished_at"] = datetime.now().isoformat()
+        save_folder_delete_job(job)
+        folder_delete_jobs.pop(job_id, None)
+
+
+@app.delete("/folders/{folder:path}")
+async def delete_folder(
+    folder: str,
+    background_tasks: BackgroundTasks,
+    roles: list = Depends(get_current_user_roles)
+):
+    # Vérifier si l'utilisateur est un professeur
+    if "prof" not in roles:
+        raise HTTPException(status_code=403, detail="Seuls les professeurs peuvent supprimer des dossiers")
+
+    folder = folder.strip("/")
+    if not folder:
+        raise HTTPException(status_code=400, detail="Chemin du dossier manquant")
+
+    job_id = shortuuid.uuid()
+    folder_delete_jobs[job_id] = {
+        "job_id": job_id,
+        "folder": folder,
+        "status": "pending",
+        "listed_objects": 0,
+        "deleted_objects": 0,
+        "failed_objects": 0,
+        "deleted_metadata": 0,
+        "started_at": datetime.now().isoformat(),
+        "finished_at": None,
+    }
+    await run_in_threadpool(save_folder_delete_job, folder_delete_jobs[job_id])
+    # La suppression tourne en arrière-plan, la progression est consultable via /folders/jobs/{job_id}
+    background_tasks.add_task(delete_folder_job, job_id, folder)
+    return {"status": "accepted", "job_id": job_id}
+
+
+@app.get("/folders/jobs/{job_id}")
+async def get_folder_delete_job(job_id: str, roles: list = Depends(get_current_user_roles)):
+    if "prof" not in roles:
+        raise HTTPException(status_code=403, detail="Accès refusé")
+    job = folder_delete_jobs.get(job_id)
+    if job:
+        return job
+    # Tâche terminée, ou lancée par un autre worker : état persistant
+    try:
+        with get_metadata_db_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("""
+                    SELECT job_id, folder, status, counters, failed_paths, error, started_at, finished_at
+                    FROM folder_delete_jobs WHERE job_id = %s
+                """, (job_id,))
+                row = cur.fetchone()
+    except Exception as e:
+        logger.error(f"Error retrieving folder delete job: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    if not row:
+        raise HTTPException(status_code=404, detail="Tâche non trouvée")
+    job = dict(row)
+    job.update(job.pop("counters"))
+    return job
+
 # Endpoint pour créer un nouveau dossier (optionnel mais utile)
 @app.post("/folders")
 async def create_folder(folder_data: dict, roles: list = Depends(get_current_user_roles)):
@@ -658,6 +1931,7 @@ async def create_folder(folder_data: dict, roles: list = Depends(get_current_use
             data=io.BytesIO(b""),
             length=0
         )
+        publish_invalidation(("folders", None), ("files", folder_path.strip("/").rpartition('/')[0]))
         
         return {"status": "success", "path": folder_path}
     
@@ -667,7 +1941,10 @@ async def create_folder(folder_data: dict, roles: list = Depends(get_current_use
         raise HTTPException(status_code=500, detail=f"Erreur serveur: {str(e)}")
 
 
-@app.post("/chat")
+OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434")
+
+
+@app.post("/chat", dependencies=[Depends(UserRateLimit("chat"))])
 async def chat_endpoint(
     request: dict, 
     roles: list = Depends(get_current_user_roles)
@@ -679,22 +1956,23 @@ async def chat_endpoint(
     # Optional: chat history management
     conversation_id = request.get("conversation_id", str(uuid.uuid4()))
     
-    logger.debug(f"Chat request from user with roles: {roles}")
+    logger.debug("Chat request from user with roles: %s", roles)
     
     try:
         # Send request to Ollama API
-        logger.debug(f"Sending request to Ollama API with model: tinyllama")
-        response = requests.post(
-            "http://localhost:11434/api/generate",
-            json={
-                "model": "tinyllama",
-                "prompt": message,
-                "stream": False
-                # You could add context here if implementing history
-                # "context": previous_context
-            },
-            timeout=30  # Add timeout to prevent hanging requests
-        )
+        logger.debug("Sending request to Ollama API with model: tinyllama")
+        with dependency_span("ollama", "generate"):
+            response = requests.post(
+                f"{OLLAMA_URL}/api/generate",
+                json={
+                    "model": "tinyllama",
+                    "prompt": message,
+                    "stream": False
+                    # You could add context here if implementing history
+                    # "context": previous_context
+                },
+                timeout=30  # Add timeout to prevent hanging requests
+            )
         
         if response.status_code != 200:
             logger.error(f"Ollama API error: {response.status_code} - {response.text}")
@@ -704,7 +1982,7 @@ async def chat_endpoint(
             )
             
         result = response.json()
-        logger.debug(f"Received response from Ollama API")
+        logger.debug("Received response from Ollama API")
         
         return {
             "response": result["response"],
@@ -745,12 +2023,243 @@ async def initialize_database():
                     
                     CREATE INDEX IF NOT EXISTS idx_announcements_created_at 
                     ON announcements(created_at);
+
+                    -- Événements à venir (examens), éventuellement filtrés par cours
+                    CREATE INDEX IF NOT EXISTS idx_announcements_event_date
+                    ON announcements(event_date) WHERE event_date IS NOT NULL;
+
+                    CREATE INDEX IF NOT EXISTS idx_announcements_folder_event_date
+                    ON announcements(target_folder, event_date) WHERE event_date IS NOT NULL;
+
+                    -- Recherche plein texte, maintenue à l'insertion (colonne générée)
+                    ALTER TABLE announcements ADD COLUMN IF NOT EXISTS search_vector tsvector
+                    GENERATED ALWAYS AS (
+                        setweight(to_tsvector('french', coalesce(title, '')), 'A') ||
+                        setweight(to_tsvector('french', coalesce(content, '')), 'B')
+                    ) STORED;
+
+                    CREATE INDEX IF NOT EXISTS idx_announcements_search
+                    ON announcements USING GIN (search_vector);
+
+                    -- État partagé de la limitation de débit (RATE_LIMIT_BACKEND=postgres)
+                    CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+                        bucket_key VARCHAR(255) PRIMARY KEY,
+                        tokens DOUBLE PRECISION NOT NULL,
+                        updated_at TIMESTAMPTZ NOT NULL
+                    );
+                    CREATE INDEX IF NOT EXISTS idx_rate_limit_buckets_updated_at
+                    ON rate_limit_buckets(updated_at);
+
+                    -- Sélection de cours du flux iCalendar de chaque utilisateur
+                    CREATE TABLE IF NOT EXISTS ics_subscriptions (
+                        user_id VARCHAR(255) PRIMARY KEY,
+                        folders TEXT[] NOT NULL DEFAULT '{}',
+                        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                    );
                 """)
         logger.info("Database initialized successfully")
     except Exception as e:
         logger.error(f"Database initialization error: {str(e)}")
 
 
+# Statistiques par dossier, maintenues par des triggers dans la même transaction
+# que l'INSERT/DELETE sur files_metadata. Chaque ligne agrège le dossier et tous
+# ses sous-dossiers (cumul vers les dossiers parents).
+FOLDER_STATS_SQL = """
+    CREATE TABLE IF NOT EXISTS folder_stats (
+        folder_path VARCHAR(255) PRIMARY KEY,
+        file_count BIGINT NOT NULL DEFAULT 0,
+        total_bytes BIGINT NOT NULL DEFAULT 0,
+        last_upload TIMESTAMP
+    );
+
+    CREATE TABLE IF NOT EXISTS folder_uploader_stats (
+        folder_path VARCHAR(255) NOT NULL,
+        uploaded_by VARCHAR(100) NOT NULL,
+        file_count BIGINT NOT NULL DEFAULT 0,
+        total_bytes BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (folder_path, uploaded_by)
+    );
+
+    -- 'a/b/c' -> 'a', 'a/b', 'a/b/c'
+    CREATE OR REPLACE FUNCTION folder_ancestors(path TEXT) RETURNS SETOF TEXT AS $$
+        SELECT array_to_string((string_to_array(path, '/'))[1:i], '/')
+        FROM generate_series(1, COALESCE(array_length(string_to_array(path, '/'), 1), 0)) AS i
+    $$ LANGUAGE sql IMMUTABLE;
+
+    CREATE OR REPLACE FUNCTION folder_stats_after_insert() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO folder_stats (folder_path, file_count, total_bytes, last_upload)
+        SELECT a.folder_path, COUNT(*), SUM(n.file_size), MAX(n.upload_date)
+        FROM new_rows n CROSS JOIN LATERAL folder_ancestors(n.folder_path) AS a(folder_path)
+        GROUP BY a.folder_path
+        ON CONFLICT (folder_path) DO UPDATE SET
+            file_count = folder_stats.file_count + EXCLUDED.file_count,
+            total_bytes = folder_stats.total_bytes + EXCLUDED.total_bytes,
+            last_upload = GREATEST(folder_stats.last_upload, EXCLUDED.last_upload);
+
+        INSERT INTO folder_uploader_stats (folder_path, uploaded_by, file_count, total_bytes)
+        SELECT a.folder_path, n.uploaded_by, COUNT(*), SUM(n.file_size)
+        FROM new_rows n CROSS JOIN LATERAL folder_ancestors(n.folder_path) AS a(folder_path)
+        GROUP BY a.folder_path, n.uploaded_by
+        ON CONFLICT (folder_path, uploaded_by) DO UPDATE SET
+            file_count = folder_uploader_stats.file_count + EXCLUDED.file_count,
+            total_bytes = folder_uploader_stats.total_bytes + EXCLUDED.total_bytes;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION folder_stats_after_delete() RETURNS trigger AS $$
+    BEGIN
+        -- last_upload n'est recalculé que si le fichier le plus récent du dossier a été supprimé
+        UPDATE folder_stats s SET
+            file_count = s.file_count - d.file_count,
+            total_bytes = s.total_bytes - d.total_bytes,
+            last_upload = CASE
+                WHEN d.last_deleted < s.last_upload THEN s.last_upload
+                ELSE (
+                    SELECT MAX(f.upload_date) FROM files_metadata f
+                    WHERE f.folder_path = s.folder_path
+                       OR left(f.folder_path, length(s.folder_path) + 1) = s.folder_path || '/'
+                )
+            END
+        FROM (
+            SELECT a.folder_path, COUNT(*) AS file_count, SUM(o.file_size) AS total_bytes,
+                   MAX(o.upload_date) AS last_deleted
+            FROM old_rows o CROSS JOIN LATERAL folder_ancestors(o.folder_path) AS a(folder_path)
+            GROUP BY a.folder_path
+        ) d
+        WHERE s.folder_path = d.folder_path;
+
+        UPDATE folder_uploader_stats s SET
+            file_count = s.file_count - d.file_count,
+            total_bytes = s.total_bytes - d.total_bytes
+        FROM (
+            SELECT a.folder_path, o.uploaded_by, COUNT(*) AS file_count, SUM(o.file_size) AS total_bytes
+            FROM old_rows o CROSS JOIN LATERAL folder_ancestors(o.folder_path) AS a(folder_path)
+            GROUP BY a.folder_path, o.uploaded_by
+        ) d
+        WHERE s.folder_path = d.folder_path AND s.uploaded_by = d.uploaded_by;
+
+        DELETE FROM folder_stats WHERE file_count <= 0;
+        DELETE FROM folder_uploader_stats WHERE file_count <= 0;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS trg_folder_stats_insert ON files_metadata;
+    CREATE TRIGGER trg_folder_stats_insert
+        AFTER INSERT ON files_metadata
+        REFERENCING NEW TABLE AS new_rows
+        FOR EACH STATEMENT EXECUTE PROCEDURE folder_stats_after_insert();
+
+    DROP TRIGGER IF EXISTS trg_folder_stats_delete ON files_metadata;
+    CREATE TRIGGER trg_folder_stats_delete
+        AFTER DELETE ON files_metadata
+        REFERENCING OLD TABLE AS old_rows
+        FOR EACH STATEMENT EXECUTE PROCEDURE folder_stats_after_delete();
+"""
+
+# Recherche plein texte sur les fichiers, maintenue à l'insertion (colonne générée)
+FILES_SEARCH_SQL = """
+    ALTER TABLE files_metadata ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('french', coalesce(original_filename, '')), 'A') ||
+        setweight(to_tsvector('french', coalesce(description, '')), 'B')
+    ) STORED;
+
+    CREATE INDEX IF NOT EXISTS idx_files_metadata_search
+    ON files_metadata USING GIN (search_vector);
+"""
+
+# Rapprochement MinIO / files_metadata : parcours trié par octets (même ordre que MinIO)
+RECONCILE_SQL = """
+    CREATE INDEX IF NOT EXISTS idx_files_metadata_storage_path_c
+    ON files_metadata (storage_path COLLATE "C");
+
+    CREATE TABLE IF NOT EXISTS reconcile_runs (
+        run_id VARCHAR(32) PRIMARY KEY,
+        prefix TEXT NOT NULL,
+        mode VARCHAR(10) NOT NULL,
+        status VARCHAR(30) NOT NULL,
+        last_key TEXT,
+        counters JSONB NOT NULL DEFAULT '{}'::jsonb,
+        started_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        finished_at TIMESTAMP,
+        error TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_reconcile_runs_prefix ON reconcile_runs(prefix, started_at);
+"""
+
+# Progression des suppressions de dossiers, lisible depuis n'importe quel worker
+FOLDER_DELETE_JOBS_SQL = """
+    CREATE TABLE IF NOT EXISTS folder_delete_jobs (
+        job_id VARCHAR(32) PRIMARY KEY,
+        folder TEXT NOT NULL,
+        status VARCHAR(30) NOT NULL,
+        counters JSONB NOT NULL DEFAULT '{}'::jsonb,
+        failed_paths JSONB NOT NULL DEFAULT '[]'::jsonb,
+        error TEXT,
+        started_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        finished_at TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_folder_delete_jobs_finished_at ON folder_delete_jobs(finished_at);
+"""
+
+
+@app.on_event("startup")
+async def initialize_metadata_database():
+    """Create the folder statistics, search, reconciliation and folder job structures if they don't exist"""
+    try:
+        with get_metadata_db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT to_regclass('folder_stats') IS NULL")
+                stats_created = cur.fetchone()[0]
+                cur.execute(FOLDER_STATS_SQL)
+                cur.execute(FILES_SEARCH_SQL)
+                cur.execute(RECONCILE_SQL)
+                cur.execute(FOLDER_DELETE_JOBS_SQL)
+        logger.info("Metadata database initialized successfully")
+    except Exception as e:
+        logger.error(f"Metadata database initialization error: {str(e)}")
+        return
+
+    if stats_created:
+        # Tables neuves : les fichiers déjà présents n'ont été vus par aucun trigger
+        await run_in_threadpool(rebuild_folder_stats)
+
+
+def rebuild_folder_stats():
+    """Recompute every folder aggregate from files_metadata to correct any drift"""
+    try:
+        with get_metadata_db_connection() as conn:
+            conn.autocommit = False
+            with conn:
+                with conn.cursor() as cur:
+                    # Verrou pour que les uploads concurrents attendent la fin du recalcul
+                    cur.execute("LOCK TABLE files_metadata IN SHARE MODE")
+                    cur.execute("TRUNCATE folder_stats, folder_uploader_stats")
+                    cur.execute("""
+                        INSERT INTO folder_stats (folder_path, file_count, total_bytes, last_upload)
+                        SELECT a.folder_path, COUNT(*), SUM(f.file_size), MAX(f.upload_date)
+                        FROM files_metadata f
+                        CROSS JOIN LATERAL folder_ancestors(f.folder_path) AS a(folder_path)
+                        GROUP BY a.folder_path
+                    """)
+                    cur.execute("""
+                        INSERT INTO folder_uploader_stats (folder_path, uploaded_by, file_count, total_bytes)
+                        SELECT a.folder_path, f.uploaded_by, COUNT(*), SUM(f.file_size)
+                        FROM files_metadata f
+                        CROSS JOIN LATERAL folder_ancestors(f.folder_path) AS a(folder_path)
+                        GROUP BY a.folder_path, f.uploaded_by
+                    """)
+        logger.info("Folder statistics rebuilt successfully")
+    except Exception as e:
+        logger.error(f"Folder statistics rebuild error: {str(e)}")
+
+
 # Replace the create_announcement function
 @app.post("/announcements")
 async def create_announcement(
@@ -790,6 +2299,7 @@ async def create_announcement(
                     target_folder, target_file, event_date
                 ))
                 new_announcement = cur.fetchone()
+                publish_invalidation(("announcements", None), cur=cur)
         
         # Envoyer des notifications par email aux étudiants
         background_tasks.add_task(
@@ -806,6 +2316,26 @@ async def create_announcement(
         logger.error(f"Erreur lors de la création d'une annonce: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Erreur serveur: {str(e)}")
 
+def load_announcements() -> list:
+    """All announcements, newest first, served from the local cache when possible"""
+    cached = local_cache.get("announcements")
+    if cached is not None:
+        return cached
+    version = local_cache.version()
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute("""
+                SELECT id, title, content, author, created_at, 
+                       target_folder, target_file, event_date
+                FROM announcements
+                ORDER BY created_at DESC
+            """)
+            announcements = cur.fetchall()
+    # Les RealDictRow sont sérialisées directement par orjson, sans copie ni jsonable_encoder
+    local_cache.set("announcements", None, announcements, version)
+    return announcements
+
+
 # Replace the get_announcements function
 @app.get("/announcements")
 async def get_announcements(
@@ -816,18 +2346,7 @@ async def get_announcements(
         raise HTTPException(status_code=401, detail="Authentification requise")
     
     try:
-        with get_db_connection() as conn:
-            with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute("""
-                    SELECT id, title, content, author, created_at, 
-                           target_folder, target_file, event_date
-                    FROM announcements
-                    ORDER BY created_at DESC
-                """)
-                announcements = cur.fetchall()
-        
-        # Convert to list of dictionaries
-        return {"announcements": [dict(announcement) for announcement in announcements]}
+        return ORJSONResponse({"announcements": load_announcements()})
     
     except Exception as e:
         logger.error(f"Error retrieving announcements: {str(e)}")
@@ -849,6 +2368,7 @@ async def delete_announcement(
                 cur.execute("DELETE FROM announcements WHERE id = %s", (announcement_id,))
                 if cur.rowcount == 0:
                     raise HTTPException(status_code=404, detail="Annonce non trouvée")
+                publish_invalidation(("announcements", None), cur=cur)
                 
         return {"status": "success", "message": "Annonce supprimée avec succès"}
     
@@ -858,6 +2378,193 @@ async def delete_announcement(
         logger.error(f"Error deleting announcement: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
+# Événements (annonces avec event_date) et flux iCalendar par utilisateur
+EVENTS_MAX_LIMIT = 500
+ICS_FEED_SECRET = os.getenv("ICS_FEED_SECRET")  # Dédié : une fuite ne doit pas compromettre un autre secret
+ICS_PUBLIC_BASE_URL = (os.getenv("ICS_PUBLIC_BASE_URL") or "").rstrip("/")  # ex: https://ent.example.org/api
+ICS_PAST_DAYS = 30  # Le flux garde les événements récents en plus des événements à venir
+ICS_CACHE_CONTROL = "private, max-age=300"
+
+
+def parse_folders(folders: Optional[str]) -> list:
+    return sorted({folder.strip("/") for folder in (folders or "").split(",") if folder.strip("/")})
+
+
+def load_events(start: datetime, end: Optional[datetime], folders: list, limit: int) -> list:
+    """Announcements with an event_date in [start, end), in date order"""
+    conditions = ["event_date IS NOT NULL", "event_date >= %s"]
+    params = [start]
+    if end is not None:
+        conditions.append("event_date < %s")
+        params.append(end)
+    if folders:
+        conditions.append("target_folder = ANY(%s)")
+        params.append(folders)
+    params.append(limit)
+    with get_db_connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor) as cur:
+            cur.execute(f"""
+                SELECT id, title, content, author, created_at,
+                       target_folder, target_file, event_date
+                FROM announcements
+                WHERE {" AND ".join(conditions)}
+                ORDER BY event_date
+                LIMIT %s
+            """, params)
+            return cur.fetchall()
+
+
+@app.get("/events")
+async def get_events(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    folder: Optional[str] = None,
+    limit: int = 100,
+    roles: list = Depends(get_current_user_roles)
+):
+    """Upcoming events (from now by default), optionally for a comma-separated list of folders"""
+    if not roles:
+        raise HTTPException(status_code=401, detail="Authentification requise")
+    limit = max(1, min(limit, EVENTS_MAX_LIMIT))
+    try:
+        events = await run_in_threadpool(load_events, start or datetime.now(), end, parse_folders(folder), limit)
+        return ORJSONResponse({"events": events})
+    except Exception as e:
+        logger.error(f"Error retrieving events: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+
+def ics_signature(user_id: str) -> str:
+    return hmac.new(ICS_FEED_SECRET.encode(), f"ics|{user_id}".encode(), hashlib.sha256).hexdigest()
+
+
+def save_ics_subscription(user_id: str, folders: list):
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO ics_subscriptions (user_id, folders)
+                VALUES (%s, %s)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    folders = EXCLUDED.folders,
+                    updated_at = CURRENT_TIMESTAMP
+            """, (user_id, folders))
+
+
+def load_ics_subscription(user_id: str) -> Optional[list]:
+    """Folders the user subscribed to ([] for every course), None if they never requested a feed"""
+    with get_db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT folders FROM ics_subscriptions WHERE user_id = %s", (user_id,))
+            row = cur.fetchone()
+    return row[0] if row else None
+
+
+def ics_escape(value: str) -> str:
+    return (value.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,")
+            .replace("\r\n", "\\n").replace("\n", "\\n"))
+
+
+def ics_fold(line: str) -> str:
+    """Fold content lines at 75 octets as required by RFC 5545"""
+    encoded = line.encode()
+    if len(encoded) <= 75:
+        return line
+    parts = []
+    while encoded:
+        size = 75 if not parts else 74
+        # Ne pas couper au milieu d'un caractère UTF-8
+        while size < len(encoded) and (encoded[size] & 0xC0) == 0x80:
+            size -= 1
+        parts.append(encoded[:size].decode())
+        encoded = encoded[size:]
+    return "\r\n ".join(parts)
+
+
+def render_ics(events: list) -> bytes:
+    lines = [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        "PRODID:-//ENT//Evenements//FR",
+        "CALSCALE:GREGORIAN",
+        "X-WR-CALNAME:ENT",
+    ]
+    for event in events:
+        lines += [
+            "BEGIN:VEVENT",
+            f"UID:{event['id']}@ent",
+            f"DTSTAMP:{event['created_at'].strftime('%Y%m%dT%H%M%S')}",
+            f"DTSTART:{event['event_date'].strftime('%Y%m%dT%H%M%S')}",
+            f"SUMMARY:{ics_escape(event['title'])}",
+            f"DESCRIPTION:{ics_escape(event['content'])}",
+        ]
+        if event.get("target_folder"):
+            lines.append(f"CATEGORIES:{ics_escape(event['target_folder'])}")
+        lines.append("END:VEVENT")
+    lines.append("END:VCALENDAR")
+    return ("\r\n".join(ics_fold(line) for line in lines) + "\r\n").encode()
+
+
+def load_ics_feed(folders: list) -> tuple:
+    """(body, etag) of the feed for a folder selection, cached until the next announcement change"""
+    key = f"ics:{','.join(folders)}"
+    cached = local_cache.get("announcements", key)
+    if cached is not None:
+        return cached
+    version = local_cache.version()
+    events = load_events(datetime.now() - timedelta(days=ICS_PAST_DAYS), None, folders, EVENTS_MAX_LIMIT)
+    body = render_ics(events)
+    feed = (body, f'"{hashlib.sha1(body).hexdigest()}"')
+    local_cache.set("announcements", key, feed, version)
+    return feed
+
+
+@app.get("/events/feed-url")
+async def get_events_feed_url(
+    request: Request,
+    folder: Optional[str] = None,
+    roles: list = Depends(get_current_user_roles)
+):
+    """Signed calendar subscription URL for the current user (calendar apps cannot send a Bearer token).
+
+    The folder selection is stored per user, so the URL stays the same when it changes.
+    """
+    if not ICS_FEED_SECRET or not ICS_PUBLIC_BASE_URL:
+        raise HTTPException(status_code=503, detail="Flux iCalendar non configuré")
+    user_id = request.state.user_id
+    folders = parse_folders(folder)
+    try:
+        await run_in_threadpool(save_ics_subscription, user_id, folders)
+    except Exception as e:
+        logger.error(f"Error saving calendar subscription: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    return {
+        "url": f"{ICS_PUBLIC_BASE_URL}/events/calendar/{user_id}.ics?sig={ics_signature(user_id)}",
+        "folders": folders
+    }
+
+
+@app.get("/events/calendar/{user_id}.ics")
+async def get_events_calendar(request: Request, user_id: str, sig: str):
+    if not ICS_FEED_SECRET:
+        raise HTTPException(status_code=503, detail="Flux iCalendar non configuré")
+    if not hmac.compare_digest(sig, ics_signature(user_id)):
+        raise HTTPException(status_code=403, detail="Signature invalide")
+    try:
+        folders = await run_in_threadpool(load_ics_subscription, user_id)
+        if folders is None:
+            raise HTTPException(status_code=404, detail="Abonnement non trouvé")
+        body, etag = await run_in_threadpool(load_ics_feed, folders)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error rendering calendar feed: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    headers = {"ETag": etag, "Cache-Control": ICS_CACHE_CONTROL}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="text/calendar; charset=utf-8", headers=headers)
+
+
 # Fonction pour envoyer des emails d'annonce aux étudiants
 def send_announcement_emails(title, content, author, event_date=None):
     try:
@@ -868,10 +2575,11 @@ def send_announcement_emails(title, content, author, event_date=None):
                 "username": ADMIN_USER,
                 "password": ADMIN_PASSWORD
             }
-            response = requests.post(
-                f"{KEYCLOAK_URL}/realms/master/protocol/openid-connect/token",
-                data=data
-            )
+            with dependency_span("keycloak", "admin_token"):
+                response = requests.post(
+                    f"{KEYCLOAK_URL}/realms/master/protocol/openid-connect/token",
+                    data=data
+                )
             return response.json()["access_token"]
             
         # Récupérer les emails des étudiants de manière synchrone
@@ -882,10 +2590,11 @@ def send_announcement_emails(title, content, author, event_date=None):
                 headers = {"Authorization": f"Bearer {admin_token}"}
                 
                 # Récupérer le rôle "etudiant"
-                role_response = requests.get(
-                    f"{KEYCLOAK_URL}/admin/realms/{REALM}/roles/etudiant",
-                    headers=headers
-                )
+                with dependency_span("keycloak", "get_role"):
+                    role_response = requests.get(
+                        f"{KEYCLOAK_URL}/admin/realms/{REALM}/roles/etudiant",
+                        headers=headers
+                    )
                 if role_response.status_code != 200:
                     logger.error("Impossible de récupérer le rôle 'etudiant'")
                     return []
@@ -893,10 +2602,11 @@ def send_announcement_emails(title, content, author, event_date=None):
                 etudiant_role_id = role_response.json()["id"]
                 
                 # Récupérer les utilisateurs avec ce rôle
-                users_response = requests.get(
-                    f"{KEYCLOAK_URL}/admin/realms/{REALM}/roles/etudiant/users",
-                    headers=headers
-                )
+                with dependency_span("keycloak", "role_users"):
+                    users_response = requests.get(
+                        f"{KEYCLOAK_URL}/admin/realms/{REALM}/roles/etudiant/users",
+                        headers=headers
+                    )
                 
                 if users_response.status_code != 200:
                     logger.error("Impossible de récupérer les utilisateurs avec le rôle 'etudiant'")
@@ -925,12 +2635,14 @@ def send_announcement_emails(title, content, author, event_date=None):
         logger.info(f"Tentative d'envoi d'emails à {len(student_emails)} étudiants")
         
         # Configuration du serveur SMTP avec plus de logs
-        logger.debug(f"Connexion SMTP à {EMAIL_HOST}:{EMAIL_PORT}")
-        server = smtplib.SMTP(EMAIL_HOST, EMAIL_PORT)
-        server.set_debuglevel(1)  # Active les logs SMTP détaillés
-        server.starttls()
-        logger.debug(f"Tentative de login avec {EMAIL_USERNAME}")
-        server.login(EMAIL_USERNAME, EMAIL_PASSWORD)
+        logger.debug("Connexion SMTP à %s:%s", EMAIL_HOST, EMAIL_PORT)
+        with dependency_span("smtp", "connect"):
+            server = smtplib.SMTP(EMAIL_HOST, EMAIL_PORT)
+            if SMTP_DEBUG:
+                server.set_debuglevel(1)  # Active les logs SMTP détaillés (écrits sur stderr)
+            server.starttls()
+            logger.debug("Tentative de login avec %s", EMAIL_USERNAME)
+            server.login(EMAIL_USERNAME, EMAIL_PASSWORD)
         
         # Création du message
         msg = MIMEMultipart()
@@ -974,8 +2686,9 @@ def send_announcement_emails(title, content, author, event_date=None):
         
         # Envoi de l'email avec plus de logs
         logger.debug("Envoi du message...")
-        server.send_message(msg)
-        server.quit()
+        with dependency_span("smtp", "send"):
+            server.send_message(msg)
+            server.quit()
         
         logger.info(f"Notification d'annonce envoyée à {len(student_emails)} étudiants")
         
@@ -990,6 +2703,11 @@ def send_announcement_emails(title, content, author, event_date=None):
 @app.api_route("/files/{file_path:path}/metadata", methods=["GET","POST"])
 async def get_file_metadata(file_path: str, roles: list = Depends(get_current_user_roles)):
     """Get metadata for a specific file"""
+
+    cached = local_cache.get("metadata", file_path)
+    if cached is not None:
+        return {"metadata": cached}
+    version = local_cache.version()
     
     try:
         path_parts = file_path.split('/')
@@ -1003,7 +2721,9 @@ async def get_file_metadata(file_path: str, roles: list = Depends(get_current_us
         with get_metadata_db_connection() as conn:
             with conn.cursor(cursor_factory=RealDictCursor) as cur:
                 cur.execute("""
-                    SELECT * FROM files_metadata 
+                    SELECT id, file_uuid, original_filename, storage_path, file_size,
+                           content_type, uploaded_by, upload_date, folder_path, description
+                    FROM files_metadata 
                     WHERE file_uuid = %s AND storage_path = %s
                 """, (file_uuid, file_path))
                 
@@ -1012,10 +2732,419 @@ async def get_file_metadata(file_path: str, roles: list = Depends(get_current_us
                 if not metadata:
                     raise HTTPException(status_code=404, detail="Metadata not found")
                 
-        return {"metadata": dict(metadata)}
+        metadata = dict(metadata)
+        local_cache.set("metadata", file_path, metadata, version)
+        return {"metadata": metadata}
     
     except HTTPException as e:
         raise e
     except Exception as e:
         logger.error(f"Error retrieving file metadata: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+# Endpoint pour les statistiques d'utilisation d'un dossier (servies depuis folder_stats)
+@app.get("/courses/{folder:path}/stats")
+async def get_folder_stats(folder: str, roles: list = Depends(get_current_user_roles)):
+    folder = folder.strip("/")
+    try:
+        with get_metadata_db_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("""
+                    SELECT folder_path, file_count, total_bytes, last_upload
+                    FROM folder_stats
+                    WHERE folder_path = %s
+                """, (folder,))
+                stats = cur.fetchone()
+                cur.execute("""
+                    SELECT uploaded_by, file_count, total_bytes
+                    FROM folder_uploader_stats
+                    WHERE folder_path = %s
+                    ORDER BY file_count DESC, total_bytes DESC
+                    LIMIT 5
+                """, (folder,))
+                top_uploaders = cur.fetchall()
+
+        if not stats:
+            stats = {"folder_path": folder, "file_count": 0, "total_bytes": 0, "last_upload": None}
+        return {"stats": dict(stats), "top_uploaders": [dict(row) for row in top_uploaders]}
+
+    except Exception as e:
+        logger.error(f"Error retrieving folder stats: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+
+# Recalcul complet des statistiques (en cas de dérive)
+@app.post("/stats/rebuild")
+async def rebuild_stats(background_tasks: BackgroundTasks, roles: list = Depends(get_current_user_roles)):
+    if "prof" not in roles:
+        raise HTTPException(status_code=403, detail="Accès refusé")
+    background_tasks.add_task(rebuild_folder_stats)
+    return {"status": "accepted"}
+
+
+# Rapprochement entre le bucket et files_metadata (objets orphelins, lignes sans objet)
+RECONCILE_BATCH_SIZE = 1000  # Taille des lots de réparation et fréquence des checkpoints
+RECONCILE_GRACE_SECONDS = int(os.getenv("RECONCILE_GRACE_SECONDS", "3600"))  # Uploads en cours
+RECONCILE_SAMPLE_SIZE = 100
+RECONCILE_STALE_MINUTES = 10  # Une exécution sans checkpoint depuis ce délai est considérée interrompue
+RECONCILE_COUNTERS = ("objects", "rows", "matched", "orphan_objects", "dangling_rows",
+                      "size_mismatches", "repaired_objects", "repaired_rows", "skipped_recent")
+
+
+def iter_bucket_objects(prefix: str, start_after: Optional[str]):
+    """Bucket listing in key order, without folder markers and derived previews"""
+    for obj in minio_client.list_objects("my-bucket", prefix=prefix or None,
+                                         recursive=True, start_after=start_after):
+        name = obj.object_name
+        if name.endswith("/.folder") or name == ".folder" or is_derived_object(name):
+            continue
+        yield obj
+
+
+def iter_metadata_rows(conn, prefix: str, start_after: Optional[str]):
+    """files_metadata rows in byte order through a server-side cursor"""
+    with conn.cursor(name=f"reconcile_{shortuuid.uuid()}") as cur:
+        cur.itersize = RECONCILE_BATCH_SIZE
+        cur.execute("""
+            SELECT storage_path, file_size
+            FROM files_metadata
+            WHERE storage_path COLLATE "C" LIKE %s
+              AND storage_path COLLATE "C" > %s
+            ORDER BY storage_path COLLATE "C"
+        """, (f"{escape_like(prefix)}%", start_after or ""))
+        for storage_path, file_size in cur:
+            yield storage_path, file_size
+
+
+def reconcile_storage(run_id: str, prefix: str, mode: str, start_after: Optional[str], counters: dict):
+    """Merge-diff the sorted bucket listing against the sorted metadata rows.
+
+    Both sides are consumed as streams, so memory stays bounded by the repair
+    batch size. Progress is checkpointed in reconcile_runs every batch; a
+    resumed run starts after the last checkpointed key.
+    """
+    repair = mode == "repair"
+    samples = {"orphan_objects": [], "dangling_rows": [], "size_mismatches": []}
+    orphan_batch, dangling_batch = [], []
+    grace_limit = datetime.now(timezone.utc) - timedelta(seconds=RECONCILE_GRACE_SECONDS)
+
+    def sample(kind, value):
+        if len(samples[kind]) < RECONCILE_SAMPLE_SIZE:
+            samples[kind].append(value)
+
+    def flush(state_cur, last_key, status="running"):
+        # Réparations du lot puis checkpoint : une reprise ne rejoue que le lot en cours
+        if orphan_batch:
+            errors = list(minio_client.remove_objects("my-bucket", [DeleteObject(n) for n in orphan_batch]))
+            for error in errors:
+                logger.error(f"Reconcile {run_id}: MinIO error deleting {error.name}: {error.message}")
+            counters["repaired_objects"] += len(orphan_batch) - len(errors)
+            orphan_batch.clear()
+        if dangling_batch:
+            state_cur.execute(
+                "DELETE FROM files_metadata WHERE storage_path = ANY(%s)", (list(dangling_batch),)
+            )
+            counters["repaired_rows"] += state_cur.rowcount
+            dangling_batch.clear()
+        state_cur.execute("""
+            UPDATE reconcile_runs
+            SET last_key = %s, counters = %s, status = %s, updated_at = CURRENT_TIMESTAMP
+            WHERE run_id = %s
+        """, (last_key, json.dumps(counters), status, run_id))
+
+    with get_metadata_db_connection() as scan_conn, get_metadata_db_connection() as state_conn:
+        # Le curseur nommé exige une transaction ouverte pendant tout le parcours
+        scan_conn.autocommit = False
+        with state_conn.cursor() as state_cur:
+            objects = iter_bucket_objects(prefix, start_after)
+            rows = iter_metadata_rows(scan_conn, prefix, start_after)
+            obj = next(objects, None)
+            row = next(rows, None)
+            last_key = start_after
+            pending = 0
+
+            while obj is not None or row is not None:
+                if row is None or (obj is not None and obj.object_name < row[0]):
+                    # Objet sans métadonnées
+                    counters["objects"] += 1
+                    last_key = obj.object_name
+                    if obj.last_modified is not None and obj.last_modified > grace_limit:
+                        counters["skipped_recent"] += 1
+                    else:
+                        counters["orphan_objects"] += 1
+                        sample("orphan_objects", obj.object_name)
+                        if repair:
+                            orphan_batch.append(obj.object_name)
+                    obj = next(objects, None)
+                elif obj is None or row[0] < obj.object_name:
+                    # Métadonnées sans objet
+                    counters["rows"] += 1
+                    last_key = row[0]
+                    counters["dangling_rows"] += 1
+                    sample("dangling_rows", row[0])
+                    if repair:
+                        dangling_batch.append(row[0])
+                    row = next(rows, None)
+                else:
+                    counters["objects"] += 1
+                    counters["rows"] += 1
+                    counters["matched"] += 1
+                    last_key = row[0]
+                    if obj.size is not None and row[1] != obj.size:
+                        counters["size_mismatches"] += 1
+                        sample("size_mismatches", {"path": row[0], "metadata": row[1], "object": obj.size})
+                    obj = next(objects, None)
+                    row = next(rows, None)
+
+                pending += 1
+                if pending >= RECONCILE_BATCH_SIZE:
+                    flush(state_cur, last_key)
+                    pending = 0
+
+            flush(state_cur, last_key, status="completed")
+        scan_conn.rollback()
+
+    if counters["repaired_objects"] or counters["repaired_rows"]:
+        publish_invalidation(("folders", None), ("files", None), ("metadata", None))
+    return samples
+
+
+def reconcile_job(run_id: str, prefix: str, mode: str, start_after: Optional[str], counters: dict):
+    job = reconcile_jobs[run_id]
+    job["status"] = "running"
+    try:
+        job["samples"] = reconcile_storage(run_id, prefix, mode, start_after, counters)
+        job["status"] = "completed"
+        logger.info(f"Reconcile {run_id} ({mode}) terminé: {counters}")
+    except Exception as e:
+        logger.error(f"Reconcile {run_id} error: {str(e)}")
+        job["status"] = "failed"
+        job["error"] = str(e)
+        try:
+            with get_metadata_db_connection() as conn:
+                with conn.cursor() as cur:
+                    cur.execute("""
+                        UPDATE reconcile_runs SET status = 'failed', error = %s, updated_at = CURRENT_TIMESTAMP
+                        WHERE run_id = %s
+                    """, (str(e), run_id))
+        except Exception:
+            pass
+    finally:
+        job["finished_at"] = datetime.now().isoformat()
+        if job["status"] == "completed":
+            try:
+                with get_metadata_db_connection() as conn:
+                    with conn.cursor() as cur:
+                        cur.execute(
+                            "UPDATE reconcile_runs SET finished_at = CURRENT_TIMESTAMP WHERE run_id = %s",
+                            (run_id,)
+                        )
+            except Exception:
+                pass
+
+
+reconcile_jobs = {}  # run_id -> progression (les compteurs sont partagés avec le job)
+
+
+@app.post("/storage/reconcile")
+async def start_reconcile(
+    background_tasks: BackgroundTasks,
+    mode: str = "report",
+    prefix: str = "",
+    resume: bool = True,
+    roles: list = Depends(get_current_user_roles)
+):
+    """Start a bucket/metadata reconciliation (mode=report or repair).
+
+    With resume=true, an interrupted run for the same prefix and mode carries
+    on from its last checkpoint instead of starting over.
+    """
+    if "prof" not in roles:
+        raise HTTPException(status_code=403, detail="Accès refusé")
+    if mode not in ("report", "repair"):
+        raise HTTPException(status_code=400, detail="Mode invalide. Choix possibles: report, repair")
+    prefix = prefix.lstrip("/")
+
+    if any(job["status"] in ("pending", "running") and job["prefix"] == prefix for job in reconcile_jobs.values()):
+        raise HTTPException(status_code=409, detail="Un rapprochement est déjà en cours pour ce préfixe")
+
+    try:
+        with get_metadata_db_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("""
+                    SELECT run_id, last_key, counters, status,
+                           updated_at > CURRENT_TIMESTAMP - make_interval(mins => %s) AS active
+                    FROM reconcile_runs
+                    WHERE prefix = %s AND mode = %s AND status IN ('running', 'failed')
+                    ORDER BY started_at DESC
+                    LIMIT 1
+                """, (RECONCILE_STALE_MINUTES, prefix, mode))
+                previous = cur.fetchone()
+                if previous and previous["status"] == "running" and previous["active"]:
+                    # Exécution en cours sur un autre worker
+                    raise HTTPException(status_code=409, detail="Un rapprochement est déjà en cours pour ce préfixe")
+                if not resume:
+                    previous = None
+
+                if previous:
+                    run_id = previous["run_id"]
+                    start_after = previous["last_key"]
+                    counters = {name: previous["counters"].get(name, 0) for name in RECONCILE_COUNTERS}
+                    cur.execute(
+                        "UPDATE reconcile_runs SET status = 'running', error = NULL, "
+                        "updated_at = CURRENT_TIMESTAMP WHERE run_id = %s", (run_id,)
+                    )
+                else:
+                    run_id = shortuuid.uuid()
+                    start_after = None
+                    counters = {name: 0 for name in RECONCILE_COUNTERS}
+                    cur.execute("""
+                        INSERT INTO reconcile_runs (run_id, prefix, mode, status, counters)
+                        VALUES (%s, %s, %s, 'running', %s)
+                    """, (run_id, prefix, mode, json.dumps(counters)))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error starting reconcile: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+    reconcile_jobs[run_id] = {
+        "run_id": run_id,
+        "prefix": prefix,
+        "mode": mode,
+        "status": "pending",
+        "resumed_from": start_after,
+        "counters": counters,
+        "started_at": datetime.now().isoformat(),
+        "finished_at": None,
+    }
+    background_tasks.add_task(reconcile_job, run_id, prefix, mode, start_after, counters)
+    return {"status": "accepted", "run_id": run_id, "resumed_from": start_after}
+
+
+@app.get("/storage/reconcile/{run_id}")
+async def get_reconcile(run_id: str, roles: list = Depends(get_current_user_roles)):
+    if "prof" not in roles:
+        raise HTTPException(status_code=403, detail="Accès refusé")
+    job = reconcile_jobs.get(run_id)
+    if job:
+        return job
+    # Exécution lancée par un autre worker ou avant un redémarrage : état persistant
+    try:
+        with get_metadata_db_connection() as conn:
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("""
+                    SELECT run_id, prefix, mode, status, last_key, counters,
+                           started_at, updated_at, finished_at, error
+                    FROM reconcile_runs WHERE run_id = %s
+                """, (run_id,))
+                run = cur.fetchone()
+    except Exception as e:
+        logger.error(f"Error retrieving reconcile run: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+    if not run:
+        raise HTTPException(status_code=404, detail="Tâche non trouvée")
+    return dict(run)
+
+
+# Recherche plein texte dans les fichiers et les annonces
+SEARCH_MAX_LIMIT = 100
+
+
+@app.get("/search")
+async def search(
+    q: str,
+    folder: Optional[str] = None,
+    kind: str = "all",
+    limit: int = 20,
+    offset: int = 0,
+    roles: list = Depends(get_current_user_roles)
+):
+    if not q.strip():
+        raise HTTPException(status_code=400, detail="Requête de recherche vide")
+    if kind not in ("all", "files", "announcements"):
+        raise HTTPException(status_code=400, detail="Type invalide. Choix possibles: all, files, announcements")
+    limit = max(1, min(limit, SEARCH_MAX_LIMIT))
+    offset = max(0, offset)
+
+    # Chaque base renvoie ses offset + limit meilleurs résultats (+1 pour savoir s'il y a une page suivante),
+    # la fusion par score se fait ici.
+    window = offset + limit + 1
+    folder = folder.strip("/") if folder else None
+    folder_like = f"{escape_like(folder)}/%" if folder else None
+    results = []
+
+    try:
+        if kind in ("all", "files"):
+            with get_metadata_db_connection() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute("""
+                        SELECT 'file' AS type, storage_path, original_filename, description,
+                               folder_path, uploaded_by, upload_date, file_size,
+                               ts_rank_cd(search_vector, query) AS rank
+                        FROM files_metadata, websearch_to_tsquery('french', %s) AS query
+                        WHERE search_vector @@ query
+                          AND (%s IS NULL OR folder_path = %s OR folder_path LIKE %s)
+                        ORDER BY rank DESC, upload_date DESC
+                        LIMIT %s
+                    """, (q, folder, folder, folder_like, window))
+                    results.extend(cur.fetchall())
+
+        if kind in ("all", "announcements"):
+            with get_db_connection() as conn:
+                with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                    cur.execute("""
+                        SELECT 'announcement' AS type, id, title, content, author, created_at,
+                               target_folder, event_date,
+                               ts_rank_cd(search_vector, query) AS rank
+                        FROM announcements, websearch_to_tsquery('french', %s) AS query
+                        WHERE search_vector @@ query
+                          AND (%s IS NULL OR target_folder = %s OR target_folder LIKE %s)
+                        ORDER BY rank DESC, created_at DESC
+                        LIMIT %s
+                    """, (q, folder, folder, folder_like, window))
+                    results.extend(cur.fetchall())
+
+        results.sort(key=lambda row: row["rank"], reverse=True)
+        page = results[offset:offset + limit]
+        return {
+            "results": [dict(row) for row in page],
+            "offset": offset,
+            "limit": limit,
+            "has_more": len(results) > offset + limit
+        }
+
+    except Exception as e:
+        logger.error(f"Search error: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
+
+
+
+# Endpoint agrégé pour le premier affichage des tableaux de bord étudiant et professeur
+@app.get("/dashboard/bootstrap")
+async def dashboard_bootstrap(
+    folder: Optional[str] = None,
+    roles: list = Depends(get_current_user_roles)
+):
+    """Roles, folders, one folder's files and announcements in a single round trip.
+
+    The sections are loaded concurrently and each one comes from its own cache
+    entry, so a change to announcements does not invalidate the folder listing.
+    """
+    sections = {
+        "folders": run_in_threadpool(load_folders),
+        "announcements": run_in_threadpool(load_announcements),
+    }
+    if folder:
+        sections["files"] = run_in_threadpool(load_folder_files, folder)
+
+    results = await asyncio.gather(*sections.values(), return_exceptions=True)
+    response = {"roles": roles, "folder": folder, "files": None, "errors": {}}
+    for name, result in zip(sections, results):
+        if isinstance(result, Exception):
+            logger.error(f"Dashboard bootstrap error in {name}: {str(result)}")
+            response[name] = None
+            response["errors"][name] = str(result)
+        else:
+            response[name] = result
+    return ORJSONResponse(response)
@@ -3,6 +3,15 @@ import api from "../api";
 import { useNavigate } from "react-router-dom";
 import "./Dashboard.css";
 
+// Dossier ouvert en dernier, rechargé avec le reste du tableau de bord en un seul appel
+const LAST_FOLDER_KEY = "dashboard_last_folder";
+
+const fetchDashboardBootstrap = async () => {
+  const folder = sessionStorage.getItem(LAST_FOLDER_KEY);
+  const res = await api.get("/dashboard/bootstrap", { params: folder ? { folder } : {} });
+  return res.data;
+};
+
 const Dashboard = () => {
   const [folders, setFolders] = useState([]);
   const [currentFolder, setCurrentFolder] = useState(null);
@@ -83,7 +92,14 @@ const Dashboard = () => {
         }
         
         setIsLoading(true);
-        await loadFolders();
+        // Dossiers, annonces et fichiers du dernier dossier ouvert en un aller-retour
+        const data = await fetchDashboardBootstrap();
+        setFolders(data.folders || []); // Ensure folders is always an array
+        setAnnouncements(data.announcements || []);
+        if (data.folder && data.files) {
+          setCurrentFolder(data.folder);
+          setFiles(data.files);
+        }
         setIsLoading(false);
       } catch (err) {
         console.error("Error during initialization:", err);
@@ -122,6 +138,7 @@ const Dashboard = () => {
       setIsLoading(true);
       const res = await api.get(`/courses/${folder}/files`);
       setCurrentFolder(folder);
+      sessionStorage.setItem(LAST_FOLDER_KEY, folder);
       setFiles(res.data.files || []); // Ensure files is always an array
     } catch (error) {
       console.error("Error opening folder:", error);
@@ -362,6 +379,7 @@ const Dashboard = () => {
   };
 
   useEffect(() => {
+    // Premier chargement via /dashboard/bootstrap, ici uniquement le rafraîchissement
     const fetchAnnouncements = async () => {
       try {
         const response = await api.get('/announcements');
@@ -371,8 +389,6 @@ const Dashboard = () => {
       }
     };
     
-    fetchAnnouncements();
-    
     // Rafraîchir les annonces toutes les 5 minutes
     const intervalId = setInterval(fetchAnnouncements, 5 * 60 * 1000);
     return () => clearInterval(intervalId);
@@ -1,26 +1,32 @@
 from fastapi import FastAPI, HTTPException, Response, Depends, Request, WebSocket, WebSocketDisconnect, Query
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 import requests
 import os
 import json
+import hashlib
 import asyncio
+import random
+import time
+import uuid
 from jose import jwt, JWTError
-from jwt import PyJWKClient
+from jwt import PyJWKSet
 import logging
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import asyncpg
+from contextlib import asynccontextmanager
 from datetime import datetime
 from typing import List, Optional
+from logging_setup import configure_logging
 
 app = FastAPI()
 load_dotenv()
 security = HTTPBearer()
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+# Configure logging (file d'attente, JSON, échantillonnage des DEBUG : voir logging_setup.py)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 # Configuration CORS
@@ -32,16 +38,141 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Database connection
-def get_db_connection():
-    conn = psycopg2.connect(
-        dbname=os.getenv("DB_NAME"),
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD"),
-        host=os.getenv("DB_HOST")
-    )
-    conn.autocommit = True
-    return conn
+# Database: pool asyncpg partagé par les routes, la présence et le bus. Les requêtes sont
+# préparées une fois puis réutilisées (cache par connexion) et bornées dans le temps : une
+# requête lente occupe une connexion du pool, jamais la boucle qui sert les WebSockets.
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_QUERY_TIMEOUT = float(os.getenv("DB_QUERY_TIMEOUT", "5"))  # Secondes par requête
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "5"))  # Attente maximale d'une connexion libre
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))  # Requêtes préparées par connexion
+DB_MIGRATION_TIMEOUT = 600
+DB_MIGRATION_LOCK_ID = 4621  # Verrou consultatif : un seul worker applique les migrations à la fois
+
+
+def db_connect_args() -> dict:
+    return {
+        "database": os.getenv("DB_NAME"),
+        "user": os.getenv("DB_USER"),
+        "password": os.getenv("DB_PASSWORD"),
+        "host": os.getenv("DB_HOST")
+    }
+
+
+async def init_db_connection(conn):
+    # json décodé en dict, comme le faisait RealDictCursor
+    await conn.set_type_codec("json", encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
+
+
+class Database:
+    """asyncpg pool with per-query timeouts and the counters served on /metrics/db"""
+
+    def __init__(self):
+        self.pool = None
+        self.stats = {
+            "queries": 0,
+            "errors": 0,
+            "timeouts": 0,
+            "query_seconds": 0.0,
+            "slowest_query_seconds": 0.0,
+            "acquires": 0,
+            "acquire_timeouts": 0,
+            "acquire_wait_seconds": 0.0,
+            "max_acquire_wait_seconds": 0.0
+        }
+
+    async def start(self):
+        self.pool = await asyncpg.create_pool(
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            command_timeout=DB_QUERY_TIMEOUT,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+            init=init_db_connection,
+            **db_connect_args()
+        )
+        logger.info(f"Database pool ready ({DB_POOL_MIN_SIZE}-{DB_POOL_MAX_SIZE} connections)")
+
+    async def stop(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    @asynccontextmanager
+    async def acquire(self):
+        """Borrow a connection for several queries (same session, optionally a transaction)"""
+        started = time.perf_counter()
+        try:
+            conn = await self.pool.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.stats["acquire_timeouts"] += 1
+            logger.warning(f"No database connection free after {DB_ACQUIRE_TIMEOUT}s")
+            raise
+        waited = time.perf_counter() - started
+        self.stats["acquires"] += 1
+        self.stats["acquire_wait_seconds"] += waited
+        self.stats["max_acquire_wait_seconds"] = max(self.stats["max_acquire_wait_seconds"], waited)
+        try:
+            yield conn
+        finally:
+            await self.pool.release(conn)
+
+    async def run(self, conn, method: str, query: str, *args, timeout: float = DB_QUERY_TIMEOUT):
+        """Run conn.<method>(query, *args) with a deadline; asyncpg cancels the query server-side on timeout"""
+        started = time.perf_counter()
+        try:
+            return await getattr(conn, method)(query, *args, timeout=timeout)
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            logger.warning(f"Query timed out after {timeout}s: {' '.join(query.split())[:120]}")
+            raise
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            self.stats["queries"] += 1
+            self.stats["query_seconds"] += elapsed
+            self.stats["slowest_query_seconds"] = max(self.stats["slowest_query_seconds"], elapsed)
+
+    async def fetch(self, query: str, *args, timeout: float = DB_QUERY_TIMEOUT) -> list:
+        async with self.acquire() as conn:
+            return await self.run(conn, "fetch", query, *args, timeout=timeout)
+
+    async def fetchrow(self, query: str, *args, timeout: float = DB_QUERY_TIMEOUT):
+        async with self.acquire() as conn:
+            return await self.run(conn, "fetchrow", query, *args, timeout=timeout)
+
+    async def fetchval(self, query: str, *args, timeout: float = DB_QUERY_TIMEOUT):
+        async with self.acquire() as conn:
+            return await self.run(conn, "fetchval", query, *args, timeout=timeout)
+
+    async def execute(self, query: str, *args, timeout: float = DB_QUERY_TIMEOUT) -> str:
+        async with self.acquire() as conn:
+            return await self.run(conn, "execute", query, *args, timeout=timeout)
+
+    def metrics(self) -> dict:
+        stats = dict(self.stats)
+        stats["avg_query_ms"] = round(stats["query_seconds"] / stats["queries"] * 1000, 3) if stats["queries"] else None
+        stats["avg_acquire_wait_ms"] = (
+            round(stats["acquire_wait_seconds"] / stats["acquires"] * 1000, 3) if stats["acquires"] else None
+        )
+        if self.pool is not None:
+            stats["pool"] = {
+                "size": self.pool.get_size(),
+                "idle": self.pool.get_idle_size(),
+                "min_size": self.pool.get_min_size(),
+                "max_size": self.pool.get_max_size()
+            }
+        return stats
+
+
+db = Database()
+
+
+@app.exception_handler(asyncio.TimeoutError)
+async def database_timeout_handler(request: Request, exc: asyncio.TimeoutError):
+    # Pool saturé ou requête trop longue : le client peut réessayer
+    return JSONResponse(status_code=503, content={"detail": "Database timeout"})
 
 # Pydantic models
 class LoginRequest(BaseModel):
@@ -51,6 +182,7 @@ class LoginRequest(BaseModel):
 class MessageCreate(BaseModel):
     receiver_id: str
     message_text: str
+    client_msg_id: Optional[str] = Field(None, max_length=64)  # Rend les renvois idempotents
 
 class Message(BaseModel):
     message_id: int
@@ -66,6 +198,8 @@ class Conversation(BaseModel):
     last_message_at: datetime
     unread_count: Optional[int] = 0
     last_message: Optional[str] = None
+    last_message_id: Optional[int] = None
+    last_sender_id: Optional[str] = None
 
 # Keycloak configuration
 KEYCLOAK_URL = os.getenv("KEYCLOAK_URL")
@@ -75,28 +209,668 @@ ADMIN_PASSWORD = os.getenv("KEYCLOAK_ADMIN_PASSWORD")
 KEYCLOAK_CLIENT_SECRET = os.getenv("KEYCLOAK_CLIENT_SECRET")
 
 # WebSocket connections manager
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "100"))  # Messages en attente par connexion
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "5"))  # Secondes avant d'évincer un client lent
+
+# La boucle ne garde qu'une référence faible aux tâches : sans celle-ci, une fermeture
+# lancée en arrière-plan peut être collectée avant d'avoir terminé
+background_tasks = set()
+
+
+def spawn(coro) -> asyncio.Task:
+    """create_task that keeps the task alive until it finishes"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+class ClientConnection:
+    """One socket of a user, with its own bounded outbound queue and writer task"""
+
+    def __init__(self, websocket: WebSocket, user_id: str):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.connection_id = uuid.uuid4().hex[:12]
+        self.queue = asyncio.Queue(maxsize=WS_SEND_QUEUE_SIZE)
+        self.closed = False
+        self.last_seen = time.monotonic()
+        self.writer = asyncio.create_task(self._write_loop())
+
+    def touch(self):
+        self.last_seen = time.monotonic()
+
+    def enqueue(self, message: dict) -> bool:
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            logger.warning(f"Evicting slow consumer {self.user_id}/{self.connection_id}: send queue full")
+            manager.disconnect(self)
+            spawn(self._close_socket(1013, "Client too slow"))
+            return False
+
+    async def _write_loop(self):
+        try:
+            while True:
+                message = await self.queue.get()
+                await asyncio.wait_for(self.websocket.send_json(message), timeout=WS_SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Evicting slow consumer {self.user_id}/{self.connection_id}: send timed out")
+            await self.close(code=1013, reason="Client too slow")
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.debug("Writer for %s/%s stopped: %s", self.user_id, self.connection_id, e)
+            await self.close(code=1011, reason="Send failed")
+
+    async def close(self, code: int = 1000, reason: str = ""):
+        """Stop the writer, drop the connection from the manager and close the socket"""
+        if self.closed:
+            return
+        manager.disconnect(self)
+        await self._close_socket(code, reason)
+
+    async def _close_socket(self, code: int, reason: str):
+        try:
+            # Une connexion à moitié ouverte peut bloquer l'envoi de la trame de fermeture
+            await asyncio.wait_for(self.websocket.close(code=code, reason=reason), timeout=WS_SEND_TIMEOUT)
+        except Exception:
+            pass  # Socket déjà fermée
+
+
 class ConnectionManager:
     def __init__(self):
-        self.active_connections = {}  # user_id -> WebSocket
+        self.active_connections = {}  # user_id -> set de ClientConnection (plusieurs onglets/appareils)
 
-    async def connect(self, websocket: WebSocket, user_id: str):
+    async def connect(self, websocket: WebSocket, user_id: str) -> ClientConnection:
         await websocket.accept()
-        self.active_connections[user_id] = websocket
-        logger.debug(f"User {user_id} connected. Total connections: {len(self.active_connections)}")
+        connection = ClientConnection(websocket, user_id)
+        if user_id not in self.active_connections:
+            presence.mark(user_id, True)
+        self.active_connections.setdefault(user_id, set()).add(connection)
+        logger.debug("User %s connected (%s sockets). Total users: %s",
+                     user_id, len(self.active_connections[user_id]), len(self.active_connections))
+        return connection
 
-    def disconnect(self, user_id: str):
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
-            logger.debug(f"User {user_id} disconnected. Total connections: {len(self.active_connections)}")
+    def disconnect(self, connection: ClientConnection):
+        if connection.closed:
+            return
+        connection.closed = True
+        if connection.writer is not asyncio.current_task():
+            connection.writer.cancel()
+        connections = self.active_connections.get(connection.user_id)
+        if connections is not None:
+            connections.discard(connection)
+            if not connections:
+                del self.active_connections[connection.user_id]
+                presence.mark(connection.user_id, False)
+        logger.debug("User %s disconnected a socket. Total users: %s", connection.user_id, len(self.active_connections))
 
     async def send_message(self, user_id: str, message: dict):
-        if user_id in self.active_connections:
-            await self.active_connections[user_id].send_json(message)
-            return True
-        return False
+        """Queue the message on every socket of the user; never waits on a slow client"""
+        delivered = False
+        for connection in list(self.active_connections.get(user_id, ())):
+            delivered = connection.enqueue(message) or delivered
+        return delivered
+
+    async def deliver(self, user_ids: list, message: dict):
+        """Deliver an event to the given users if they are connected to this worker"""
+        for user_id in user_ids:
+            await self.send_message(user_id, message)
 
 manager = ConnectionManager()
 
+# Bus de diffusion entre workers : chaque worker s'abonne et livre à ses propres sockets
+CHAT_BUS_BACKEND = os.getenv("CHAT_BUS_BACKEND", "postgres")  # "postgres" ou "memory" (un seul processus, tests)
+CHAT_BUS_CHANNEL = "chat_events"
+CHAT_BUS_MAX_PAYLOAD = 7900  # Limite NOTIFY de 8000 octets, marge pour l'enveloppe
+CHAT_BUS_PING_INTERVAL = 30  # Secondes sans notification avant de vérifier la connexion d'écoute
+CHAT_BUS_EVENT_TTL = 300  # Secondes de conservation des gros événements, largement au-delà de leur livraison
+WORKER_ID = uuid.uuid4().hex
+
+
+class MemoryBus:
+    """In-process bus: publish hands the event straight to the local handler"""
+
+    def __init__(self):
+        self.handler = None
+
+    async def start(self, handler):
+        self.handler = handler
+
+    async def stop(self):
+        self.handler = None
+
+    async def publish(self, user_ids: list, event: dict):
+        if self.handler is not None:
+            await self.handler(user_ids, event)
+
+    async def purge(self):
+        pass
+
+
+class PostgresBus:
+    """LISTEN/NOTIFY bus shared by every worker connected to the chat database.
+
+    Events too large for a NOTIFY payload are stored in chat_bus_events and
+    only their id is sent; listeners fetch the row.
+    """
+
+    def __init__(self, channel: str):
+        self.channel = channel
+        self.handler = None
+        self.task = None
+
+    async def start(self, handler):
+        self.handler = handler
+        self.task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    async def publish(self, user_ids: list, event: dict):
+        payload = json.dumps({"origin": WORKER_ID, "users": list(user_ids), "event": event}, default=str)
+        async with db.acquire() as conn:
+            if len(payload.encode()) > CHAT_BUS_MAX_PAYLOAD:
+                event_id = await db.run(
+                    conn, "fetchval", "INSERT INTO chat_bus_events (payload) VALUES ($1) RETURNING event_id", payload
+                )
+                payload = json.dumps({"ref": event_id})
+            await db.run(conn, "execute", "SELECT pg_notify($1, $2)", self.channel, payload)
+
+    async def purge(self):
+        """Drop stored events every listener has had time to fetch (called from heartbeat_loop)"""
+        try:
+            await db.execute(
+                "DELETE FROM chat_bus_events WHERE created_at < NOW() - make_interval(secs => $1)",
+                CHAT_BUS_EVENT_TTL
+            )
+        except Exception as e:
+            logger.error(f"Chat bus purge error: {str(e)}")
+
+    async def _resolve(self, payload: str) -> Optional[dict]:
+        envelope = json.loads(payload)
+        if "ref" in envelope:
+            row = await db.fetchval("SELECT payload FROM chat_bus_events WHERE event_id = $1", envelope["ref"])
+            if row is None:
+                return None
+            envelope = json.loads(row)
+        return envelope
+
+    async def _listen(self):
+        backoff = 1
+        while True:
+            conn = None
+            try:
+                # Connexion dédiée hors pool : elle reste abonnée tant que le worker tourne
+                notifications = asyncio.Queue()
+                conn = await asyncpg.connect(**db_connect_args())
+                conn.add_termination_listener(lambda _conn: notifications.put_nowait(None))
+                await conn.add_listener(
+                    self.channel, lambda _conn, _pid, _channel, payload: notifications.put_nowait(payload)
+                )
+                logger.info(f"Chat bus listening on {self.channel} (worker {WORKER_ID})")
+                backoff = 1
+                while True:
+                    try:
+                        payload = await asyncio.wait_for(notifications.get(), timeout=CHAT_BUS_PING_INTERVAL)
+                    except asyncio.TimeoutError:
+                        # Une connexion TCP à moitié ouverte ne déclenche pas le listener de
+                        # terminaison : sans réponse, on se reconnecte
+                        await conn.fetchval("SELECT 1", timeout=DB_QUERY_TIMEOUT)
+                        continue
+                    if payload is None:
+                        raise ConnectionError("listener connection closed")
+                    try:
+                        envelope = await self._resolve(payload)
+                    except ValueError:
+                        logger.warning(f"Ignoring malformed bus payload: {payload[:200]}")
+                        continue
+                    if envelope is not None:
+                        await self.handler(envelope["users"], envelope["event"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Chat bus listener error: {str(e)}, reconnecting in {backoff}s")
+                await asyncio.sleep(backoff + random.random())
+                backoff = min(backoff * 2, 30)
+            finally:
+                if conn is not None:
+                    conn.terminate()
+
+
+chat_bus = PostgresBus(CHAT_BUS_CHANNEL) if CHAT_BUS_BACKEND == "postgres" else MemoryBus()
+
+
+# Heartbeats : ping applicatif périodique, les sockets muettes au-delà du délai sont fermées
+WS_PING_INTERVAL = float(os.getenv("WS_PING_INTERVAL", "25"))
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", "60"))  # Sans aucune trame reçue (pong compris)
+PRESENCE_FLUSH_INTERVAL = float(os.getenv("PRESENCE_FLUSH_INTERVAL", "2"))
+PRESENCE_TTL = WS_PING_INTERVAL * 3  # Lignes d'un worker arrêté brutalement ignorées au-delà
+
+
+class PresenceService:
+    """Online/offline registry shared by the workers through the user_presence table.
+
+    Local connect/disconnect transitions are coalesced in memory and flushed in
+    batches; only users whose global state actually changed are pushed to the
+    counterparts of their conversations.
+    """
+
+    def __init__(self):
+        self.pending = {}  # user_id -> dernier état local (online)
+        self.task = None
+
+    def mark(self, user_id: str, online: bool):
+        self.pending[user_id] = online
+
+    async def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        try:
+            await db.execute("DELETE FROM user_presence WHERE worker_id = $1", WORKER_ID)
+        except Exception as e:
+            logger.error(f"Presence cleanup error: {str(e)}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(PRESENCE_FLUSH_INTERVAL)
+            if not self.pending:
+                continue
+            changes, self.pending = self.pending, {}
+            try:
+                notifications = await self._flush(changes)
+            except Exception as e:
+                logger.error(f"Presence flush error: {str(e)}")
+                # Réessayer au prochain tour sans écraser les changements plus récents
+                self.pending = {**changes, **self.pending}
+                continue
+            # Un seul événement par ensemble identique de changements
+            grouped = {}
+            for counterpart, updates in notifications.items():
+                key = json.dumps(sorted(updates, key=lambda update: update["user_id"]))
+                grouped.setdefault(key, []).append(counterpart)
+            for key, counterparts in grouped.items():
+                try:
+                    await chat_bus.publish(counterparts, {"type": "presence", "data": json.loads(key)})
+                except Exception as e:
+                    logger.error(f"Presence publish error: {str(e)}")
+
+    async def _online(self, conn, user_ids: list) -> set:
+        rows = await db.run(conn, "fetch", """
+            SELECT DISTINCT user_id FROM user_presence
+            WHERE user_id = ANY($1::varchar[]) AND updated_at > CURRENT_TIMESTAMP - make_interval(secs => $2)
+        """, user_ids, PRESENCE_TTL)
+        return {row["user_id"] for row in rows}
+
+    async def _flush(self, changes: dict) -> dict:
+        """Apply the batch; return {counterpart_id: [{"user_id", "online"}, ...]}"""
+        user_ids = list(changes)
+        online_ids = [user_id for user_id, online in changes.items() if online]
+        offline_ids = [user_id for user_id, online in changes.items() if not online]
+        async with db.acquire() as conn:
+            before = await self._online(conn, user_ids)
+            if online_ids:
+                await db.run(conn, "execute", """
+                    INSERT INTO user_presence (worker_id, user_id)
+                    SELECT $1::varchar, unnest($2::varchar[])
+                    ON CONFLICT (worker_id, user_id) DO UPDATE SET updated_at = CURRENT_TIMESTAMP
+                """, WORKER_ID, online_ids)
+            if offline_ids:
+                await db.run(
+                    conn, "execute",
+                    "DELETE FROM user_presence WHERE worker_id = $1 AND user_id = ANY($2::varchar[])",
+                    WORKER_ID, offline_ids
+                )
+            after = await self._online(conn, user_ids)
+            changed = {user_id: user_id in after for user_id in user_ids if (user_id in before) != (user_id in after)}
+            if not changed:
+                return {}
+            rows = await db.run(conn, "fetch", """
+                SELECT prof_id, student_id FROM conversations
+                WHERE prof_id = ANY($1::varchar[]) OR student_id = ANY($1::varchar[])
+            """, list(changed))
+        notifications = {}
+        for prof_id, student_id in rows:
+            for user_id, counterpart in ((prof_id, student_id), (student_id, prof_id)):
+                if user_id in changed:
+                    notifications.setdefault(counterpart, []).append(
+                        {"user_id": user_id, "online": changed[user_id]}
+                    )
+        return notifications
+
+    async def refresh(self):
+        """Keep this worker's rows fresh so they are not taken for a dead worker's"""
+        try:
+            async with db.acquire() as conn:
+                await db.run(
+                    conn, "execute", "UPDATE user_presence SET updated_at = CURRENT_TIMESTAMP WHERE worker_id = $1",
+                    WORKER_ID
+                )
+                # Lignes laissées par des workers disparus
+                await db.run(
+                    conn, "execute",
+                    "DELETE FROM user_presence WHERE updated_at < CURRENT_TIMESTAMP - make_interval(secs => $1)",
+                    PRESENCE_TTL * 10
+                )
+        except Exception as e:
+            logger.error(f"Presence refresh error: {str(e)}")
+
+
+presence = PresenceService()
+
+
+async def heartbeat_loop():
+    """Ping every socket and reap the ones that stopped answering"""
+    while True:
+        await asyncio.sleep(WS_PING_INTERVAL)
+        now = time.monotonic()
+        for connections in list(manager.active_connections.values()):
+            for connection in list(connections):
+                if now - connection.last_seen > WS_IDLE_TIMEOUT:
+                    logger.info(f"Reaping idle socket {connection.user_id}/{connection.connection_id}")
+                    spawn(connection.close(code=1001, reason="Idle timeout"))
+                else:
+                    connection.enqueue({"type": "ping"})
+        await presence.refresh()
+        await chat_bus.purge()
+
+
+heartbeat_task = None
+
+
+# Résumé dénormalisé des conversations (dernier message, non-lus et curseur de lecture par
+# participant), rattrapé pour les conversations existantes puis maintenu par persist_message
+# et advance_read_cursor
+CONVERSATION_SUMMARY_SQL = """
+    ALTER TABLE conversations
+        ADD COLUMN IF NOT EXISTS last_message_id INTEGER,
+        ADD COLUMN IF NOT EXISTS last_message_text TEXT,
+        ADD COLUMN IF NOT EXISTS last_sender_id VARCHAR(255),
+        ADD COLUMN IF NOT EXISTS prof_unread_count INTEGER NOT NULL DEFAULT 0,
+        ADD COLUMN IF NOT EXISTS student_unread_count INTEGER NOT NULL DEFAULT 0,
+        -- Curseurs de lecture par participant (remplacent la mise à jour de messages.is_read)
+        ADD COLUMN IF NOT EXISTS prof_last_read_message_id INTEGER,
+        ADD COLUMN IF NOT EXISTS student_last_read_message_id INTEGER;
+
+    CREATE INDEX IF NOT EXISTS idx_conversations_prof_last_message
+    ON conversations(prof_id, last_message_at DESC);
+    CREATE INDEX IF NOT EXISTS idx_conversations_student_last_message
+    ON conversations(student_id, last_message_at DESC);
+
+    -- Rattrapage des curseurs depuis is_read, une seule fois (les nouvelles lignes ont la
+    -- valeur par défaut 0) ; ensuite seuls les curseurs font foi, is_read n'est plus écrit
+    UPDATE conversations c
+    SET prof_last_read_message_id = COALESCE((
+            SELECT MAX(m.message_id) FROM messages m
+            WHERE m.conversation_id = c.conversation_id AND m.sender_id != c.prof_id AND m.is_read
+        ), 0),
+        student_last_read_message_id = COALESCE((
+            SELECT MAX(m.message_id) FROM messages m
+            WHERE m.conversation_id = c.conversation_id AND m.sender_id != c.student_id AND m.is_read
+        ), 0)
+    WHERE c.prof_last_read_message_id IS NULL OR c.student_last_read_message_id IS NULL;
+
+    ALTER TABLE conversations
+        ALTER COLUMN prof_last_read_message_id SET DEFAULT 0,
+        ALTER COLUMN student_last_read_message_id SET DEFAULT 0;
+
+    -- Une seule conversation par couple (prof, étudiant) : les doublons créés par l'ancienne
+    -- recherche puis création non atomique sont fusionnés avant d'ajouter la contrainte
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'conversations_prof_student_key') THEN
+            CREATE TEMP TABLE conversation_merge ON COMMIT DROP AS
+            SELECT conversation_id, keep_id FROM (
+                SELECT conversation_id, MIN(conversation_id) OVER (PARTITION BY prof_id, student_id) AS keep_id
+                FROM conversations
+            ) ranked
+            WHERE conversation_id != keep_id;
+
+            UPDATE messages m SET conversation_id = cm.keep_id
+            FROM conversation_merge cm WHERE m.conversation_id = cm.conversation_id;
+            -- Curseurs : le plus avancé des doublons ; résumé recalculé par le rattrapage ci-dessous
+            UPDATE conversations k
+            SET prof_last_read_message_id = merged.prof_last_read_message_id,
+                student_last_read_message_id = merged.student_last_read_message_id,
+                last_message_id = NULL
+            FROM (
+                SELECT g.keep_id,
+                       MAX(COALESCE(c.prof_last_read_message_id, 0)) AS prof_last_read_message_id,
+                       MAX(COALESCE(c.student_last_read_message_id, 0)) AS student_last_read_message_id
+                FROM (
+                    SELECT conversation_id, keep_id FROM conversation_merge
+                    UNION
+                    SELECT keep_id, keep_id FROM conversation_merge
+                ) g
+                JOIN conversations c ON c.conversation_id = g.conversation_id
+                GROUP BY g.keep_id
+            ) merged
+            WHERE k.conversation_id = merged.keep_id;
+            DELETE FROM conversations WHERE conversation_id IN (SELECT conversation_id FROM conversation_merge);
+
+            ALTER TABLE conversations
+                ADD CONSTRAINT conversations_prof_student_key UNIQUE (prof_id, student_id);
+        END IF;
+    END $$;
+
+    -- Rattrapage : seules les conversations sans résumé (dernier message cherché par conversation,
+    -- sans parcourir toute la table messages à chaque démarrage) ; les non-lus sont comptés
+    -- depuis les curseurs
+    UPDATE conversations c
+    SET last_message_id = last.message_id,
+        last_message_text = last.message_text,
+        last_sender_id = last.sender_id,
+        last_message_at = last.sent_at,
+        prof_unread_count = (
+            SELECT COUNT(*) FROM messages m
+            WHERE m.conversation_id = c.conversation_id
+              AND m.message_id > COALESCE(c.prof_last_read_message_id, 0) AND m.sender_id != c.prof_id
+        ),
+        student_unread_count = (
+            SELECT COUNT(*) FROM messages m
+            WHERE m.conversation_id = c.conversation_id
+              AND m.message_id > COALESCE(c.student_last_read_message_id, 0) AND m.sender_id != c.student_id
+        )
+    FROM conversations pending
+    CROSS JOIN LATERAL (
+        SELECT m.message_id, m.message_text, m.sender_id, m.sent_at
+        FROM messages m
+        WHERE m.conversation_id = pending.conversation_id
+        ORDER BY m.sent_at DESC, m.message_id DESC
+        LIMIT 1
+    ) last
+    WHERE pending.last_message_id IS NULL AND c.conversation_id = pending.conversation_id;
+
+    CREATE OR REPLACE VIEW unread_messages AS
+    SELECT conversation_id, (prof_unread_count + student_unread_count)::bigint AS unread_count
+    FROM conversations
+    WHERE prof_unread_count + student_unread_count > 0;
+"""
+
+# Envoi d'un message en un seul appel (une transaction, un aller-retour) : rôle du
+# destinataire, conversation trouvée ou créée (unique par couple), insertion idempotente,
+# mise à jour du résumé et nom de l'expéditeur
+SEND_MESSAGE_SQL = """
+    CREATE OR REPLACE FUNCTION send_chat_message(
+        p_sender_id VARCHAR, p_sender_role VARCHAR, p_receiver_id VARCHAR,
+        p_message_text TEXT, p_client_msg_id VARCHAR
+    ) RETURNS JSON AS $$
+    DECLARE
+        v_receiver_role VARCHAR;
+        v_prof_id VARCHAR;
+        v_student_id VARCHAR;
+        v_conversation_id INTEGER;
+        v_message messages%ROWTYPE;
+        v_created BOOLEAN := TRUE;
+    BEGIN
+        -- Renvoi d'un message déjà enregistré
+        IF p_client_msg_id IS NOT NULL THEN
+            SELECT * INTO v_message FROM messages
+            WHERE sender_id = p_sender_id AND client_msg_id = p_client_msg_id;
+            v_created := NOT FOUND;
+        END IF;
+
+        IF v_created THEN
+            SELECT role INTO v_receiver_role FROM users WHERE user_id = p_receiver_id;
+            IF NOT FOUND THEN
+                RETURN json_build_object('status', 'receiver_not_found');
+            END IF;
+
+            IF p_sender_role = 'prof' AND v_receiver_role = 'etudiant' THEN
+                v_prof_id := p_sender_id;
+                v_student_id := p_receiver_id;
+            ELSIF p_sender_role = 'etudiant' AND v_receiver_role = 'prof' THEN
+                v_prof_id := p_receiver_id;
+                v_student_id := p_sender_id;
+            ELSE
+                RETURN json_build_object('status', 'invalid_flow');
+            END IF;
+
+            SELECT conversation_id INTO v_conversation_id FROM conversations
+            WHERE prof_id = v_prof_id AND student_id = v_student_id;
+            IF NOT FOUND THEN
+                INSERT INTO conversations (prof_id, student_id) VALUES (v_prof_id, v_student_id)
+                ON CONFLICT (prof_id, student_id) DO NOTHING
+                RETURNING conversation_id INTO v_conversation_id;
+                IF v_conversation_id IS NULL THEN
+                    -- Créée entre-temps par un envoi concurrent
+                    SELECT conversation_id INTO v_conversation_id FROM conversations
+                    WHERE prof_id = v_prof_id AND student_id = v_student_id;
+                END IF;
+            END IF;
+
+            INSERT INTO messages (conversation_id, sender_id, message_text, client_msg_id)
+            VALUES (v_conversation_id, p_sender_id, p_message_text, p_client_msg_id)
+            ON CONFLICT (sender_id, client_msg_id) WHERE client_msg_id IS NOT NULL DO NOTHING
+            RETURNING * INTO v_message;
+
+            IF v_message.message_id IS NULL THEN
+                -- Doublon concurrent sur client_msg_id
+                SELECT * INTO v_message FROM messages
+                WHERE sender_id = p_sender_id AND client_msg_id = p_client_msg_id;
+                v_created := FALSE;
+            ELSE
+                -- Commits concurrents dans le désordre : le résumé ne recule jamais vers un message
+                -- plus ancien (les compteurs de non-lus, eux, sont toujours incrémentés)
+                UPDATE conversations c
+                SET last_message_at = CASE WHEN c.last_message_id IS NULL OR c.last_message_id < v_message.message_id
+                                           THEN v_message.sent_at ELSE c.last_message_at END,
+                    last_message_id = CASE WHEN c.last_message_id IS NULL OR c.last_message_id < v_message.message_id
+                                           THEN v_message.message_id ELSE c.last_message_id END,
+                    last_message_text = CASE WHEN c.last_message_id IS NULL OR c.last_message_id < v_message.message_id
+                                             THEN v_message.message_text ELSE c.last_message_text END,
+                    last_sender_id = CASE WHEN c.last_message_id IS NULL OR c.last_message_id < v_message.message_id
+                                          THEN v_message.sender_id ELSE c.last_sender_id END,
+                    prof_unread_count = c.prof_unread_count + CASE WHEN c.prof_id = p_sender_id THEN 0 ELSE 1 END,
+                    student_unread_count = c.student_unread_count + CASE WHEN c.student_id = p_sender_id THEN 0 ELSE 1 END
+                WHERE c.conversation_id = v_conversation_id;
+            END IF;
+        END IF;
+
+        RETURN (
+            SELECT json_build_object(
+                'status', 'ok',
+                'created', v_created,
+                'message_id', v_message.message_id,
+                'conversation_id', v_message.conversation_id,
+                'sender_id', v_message.sender_id,
+                'sender_username', u.username,
+                'message_text', v_message.message_text,
+                'sent_at', v_message.sent_at,
+                'is_read', v_message.message_id <= COALESCE(CASE WHEN v_message.sender_id = c.prof_id
+                                                                 THEN c.student_last_read_message_id
+                                                                 ELSE c.prof_last_read_message_id END, 0),
+                'client_msg_id', v_message.client_msg_id
+            )
+            FROM users u, conversations c
+            WHERE u.user_id = v_message.sender_id AND c.conversation_id = v_message.conversation_id
+        );
+    END;
+    $$ LANGUAGE plpgsql;
+"""
+
+
+@app.on_event("startup")
+async def initialize_database():
+    """Open the pool, then create the chat bus, presence, message and conversation summary structures.
+
+    The migration runs in one transaction under an advisory lock, so concurrent workers
+    apply it one after the other; a failure aborts the worker's startup.
+    """
+    await db.start()
+    try:
+        async with db.acquire() as conn, conn.transaction():
+            await db.run(conn, "execute", "SELECT pg_advisory_xact_lock($1)", DB_MIGRATION_LOCK_ID,
+                         timeout=DB_MIGRATION_TIMEOUT)
+            await db.run(conn, "execute", """
+                CREATE TABLE IF NOT EXISTS chat_bus_events (
+                    event_id BIGSERIAL PRIMARY KEY,
+                    payload TEXT NOT NULL,
+                    created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+                );
+                CREATE INDEX IF NOT EXISTS idx_chat_bus_events_created_at ON chat_bus_events(created_at);
+
+                CREATE TABLE IF NOT EXISTS user_presence (
+                    worker_id VARCHAR(32) NOT NULL,
+                    user_id VARCHAR(255) NOT NULL,
+                    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (worker_id, user_id)
+                );
+                CREATE INDEX IF NOT EXISTS idx_user_presence_user ON user_presence(user_id);
+
+                -- Identifiant fourni par le client : un renvoi ne crée pas de doublon
+                ALTER TABLE messages ADD COLUMN IF NOT EXISTS client_msg_id VARCHAR(64);
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_client_msg_id
+                ON messages(sender_id, client_msg_id) WHERE client_msg_id IS NOT NULL;
+
+                -- Pagination par curseur sur message_id
+                CREATE INDEX IF NOT EXISTS idx_messages_conversation_message
+                ON messages(conversation_id, message_id);
+            """, timeout=DB_MIGRATION_TIMEOUT)
+            await db.run(conn, "execute", CONVERSATION_SUMMARY_SQL, timeout=DB_MIGRATION_TIMEOUT)
+            await db.run(conn, "execute", SEND_MESSAGE_SQL, timeout=DB_MIGRATION_TIMEOUT)
+        logger.info("Database initialized successfully")
+    except Exception as e:
+        logger.error(f"Database initialization error: {str(e)}")
+        raise
+
+
+@app.on_event("startup")
+async def start_chat_bus():
+    await chat_bus.start(manager.deliver)
+
+
+@app.on_event("shutdown")
+async def stop_chat_bus():
+    await chat_bus.stop()
+
+
+@app.on_event("startup")
+async def start_presence():
+    global heartbeat_task
+    await presence.start()
+    heartbeat_task = asyncio.create_task(heartbeat_loop())
+
+
+@app.on_event("shutdown")
+async def stop_presence():
+    if heartbeat_task is not None:
+        heartbeat_task.cancel()
+    await presence.stop()
+
+
+@app.on_event("shutdown")
+async def close_database():
+    await db.stop()
+
 # Helper functions
 async def get_admin_token():
     data = {
@@ -111,15 +885,91 @@ async def get_admin_token():
     )
     return response.json()["access_token"]
 
+# Cache des clés JWKS : rechargées à l'expiration ou quand un kid inconnu apparaît (rotation)
+JWKS_CACHE_SECONDS = float(os.getenv("JWKS_CACHE_SECONDS", "3600"))
+JWKS_MIN_REFRESH_SECONDS = 10  # Un kid inconnu ne déclenche pas plus d'un rechargement par période
+CLAIMS_CACHE_SIZE = int(os.getenv("CLAIMS_CACHE_SIZE", "10000"))
+
+
+class JwksCache:
+    def __init__(self):
+        self.keys = {}  # kid -> clé publique
+        self.fetched_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def _fetch(self) -> dict:
+        jwks_url = f"{KEYCLOAK_URL}/realms/{REALM}/protocol/openid-connect/certs"
+        response = requests.get(jwks_url, timeout=10)
+        response.raise_for_status()
+        return {key.key_id: key.key for key in PyJWKSet.from_dict(response.json()).keys}
+
+    async def get(self, kid: str):
+        key = self.keys.get(kid)
+        if key is not None and time.monotonic() - self.fetched_at < JWKS_CACHE_SECONDS:
+            return key
+        async with self._lock:
+            # Un autre appel a peut-être rechargé pendant l'attente du verrou
+            key = self.keys.get(kid)
+            fresh = time.monotonic() - self.fetched_at < JWKS_MIN_REFRESH_SECONDS
+            if key is not None and time.monotonic() - self.fetched_at < JWKS_CACHE_SECONDS:
+                return key
+            if not fresh:
+                self.keys = await asyncio.get_running_loop().run_in_executor(None, self._fetch)
+                self.fetched_at = time.monotonic()
+                logger.info(f"JWKS refreshed ({len(self.keys)} keys)")
+            key = self.keys.get(kid)
+        if key is None:
+            raise JWTError(f"Unknown signing key: {kid}")
+        return key
+
+
+class ClaimsCache:
+    """Verified claims by token digest, kept until the token expires"""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.entries = {}  # sha256(token) -> (claims, exp)
+
+    def get(self, digest: str) -> Optional[dict]:
+        entry = self.entries.get(digest)
+        if entry is None:
+            return None
+        claims, exp = entry
+        if exp <= time.time():
+            del self.entries[digest]
+            return None
+        return claims
+
+    def set(self, digest: str, claims: dict):
+        exp = claims.get("exp")
+        if not exp:
+            return
+        if len(self.entries) >= self.max_size:
+            now = time.time()
+            self.entries = {k: v for k, v in self.entries.items() if v[1] > now}
+            if len(self.entries) >= self.max_size:
+                # Toujours plein : on retire les plus anciennes insertions
+                for k in list(self.entries)[:self.max_size // 10 or 1]:
+                    del self.entries[k]
+        self.entries[digest] = (claims, exp)
+
+
+jwks_cache = JwksCache()
+claims_cache = ClaimsCache(CLAIMS_CACHE_SIZE)
+known_user_ids = set()  # Utilisateurs déjà présents dans la table users
+
 async def decode_token(token: str):
     try:
-        jwks_url = f"{KEYCLOAK_URL}/realms/{REALM}/protocol/openid-connect/certs"
-        jwks_client = PyJWKClient(jwks_url)
-        signing_key = jwks_client.get_signing_key_from_jwt(token)
+        digest = hashlib.sha256(token.encode()).hexdigest()
+        payload = claims_cache.get(digest)
+        if payload is not None:
+            return payload
+        
+        signing_key = await jwks_cache.get(jwt.get_unverified_header(token).get("kid"))
         
         payload = jwt.decode(
             token,
-            key=signing_key.key,
+            key=signing_key,
             algorithms=["RS256"],
             options={
                 "verify_aud": False,
@@ -127,42 +977,41 @@ async def decode_token(token: str):
                 "verify_signature": True
             }
         )
+        claims_cache.set(digest, payload)
         return payload
     except Exception as e:
         logger.error(f"Token decode error: {str(e)}")
         raise
 
+def user_info_from_payload(payload: dict) -> dict:
+    return {
+        "user_id": payload.get("sub"),
+        "username": payload.get("preferred_username"),
+        "roles": payload.get("realm_access", {}).get("roles", [])
+    }
+
+async def ensure_user(user_info: dict):
+    """Store user in database if not exists (no query at all once the user is known)"""
+    if user_info["user_id"] in known_user_ids:
+        return
+    role = "prof" if "prof" in user_info["roles"] else "etudiant"
+    await db.execute(
+        "INSERT INTO users (user_id, username, role) VALUES ($1, $2, $3) ON CONFLICT (user_id) DO NOTHING",
+        user_info["user_id"], user_info["username"], role
+    )
+    known_user_ids.add(user_info["user_id"])
+
 async def get_current_user_info(credentials: HTTPAuthorizationCredentials = Depends(security)):
     try:
         token = credentials.credentials
         payload = await decode_token(token)
         
-        user_info = {
-            "user_id": payload.get("sub"),
-            "username": payload.get("preferred_username"),
-            "roles": payload.get("realm_access", {}).get("roles", [])
-        }
-        
-        # Store user in database if not exists
-        conn = get_db_connection()
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        
-        cursor.execute(
-            "SELECT user_id FROM users WHERE user_id = %s",
-            (user_info["user_id"],)
-        )
-        
-        if cursor.fetchone() is None:
-            role = "prof" if "prof" in user_info["roles"] else "etudiant"
-            cursor.execute(
-                "INSERT INTO users (user_id, username, role) VALUES (%s, %s, %s)",
-                (user_info["user_id"], user_info["username"], role)
-            )
-        
-        cursor.close()
-        conn.close()
-        
+        user_info = user_info_from_payload(payload)
+        await ensure_user(user_info)
+
         return user_info
+    except asyncio.TimeoutError:
+        raise  # Base indisponible, pas un problème d'authentification
     except Exception as e:
         logger.error(f"Authentication error: {str(e)}")
         raise HTTPException(status_code=401, detail=f"Not authenticated: {str(e)}")
@@ -211,23 +1060,19 @@ async def login(credentials: LoginRequest, response: Response):
         roles = payload.get("realm_access", {}).get("roles", [])
         
         # Store user in database
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
         role = "prof" if "prof" in roles else "etudiant"
-        
-        cursor.execute(
+
+        await db.execute(
             """
-            INSERT INTO users (user_id, username, role) 
-            VALUES (%s, %s, %s)
-            ON CONFLICT (user_id) DO UPDATE 
+            INSERT INTO users (user_id, username, role)
+            VALUES ($1, $2, $3)
+            ON CONFLICT (user_id) DO UPDATE
             SET username = EXCLUDED.username, role = EXCLUDED.role
             """,
-            (user_id, username, role)
+            user_id, username, role
         )
-        
-        cursor.close()
-        conn.close()
+
+        known_user_ids.add(user_id)
         
         return token_data
 
@@ -252,16 +1097,9 @@ async def get_professors(current_user: dict = Depends(get_current_user_info)):
     if "etudiant" not in current_user["roles"]:
         raise HTTPException(status_code=403, detail="Access forbidden")
     
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cursor.execute("SELECT user_id, username FROM users WHERE role = 'prof'")
-    professors = cursor.fetchall()
-    
-    cursor.close()
-    conn.close()
-    
-    return professors
+    professors = await db.fetch("SELECT user_id, username FROM users WHERE role = 'prof'")
+
+    return [dict(row) for row in professors]
 
 @app.get("/users/students")
 async def get_students(current_user: dict = Depends(get_current_user_info)):
@@ -270,16 +1108,9 @@ async def get_students(current_user: dict = Depends(get_current_user_info)):
     if "prof" not in current_user["roles"]:
         raise HTTPException(status_code=403, detail="Access forbidden")
     
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    
-    cursor.execute("SELECT user_id, username FROM users WHERE role = 'etudiant'")
-    students = cursor.fetchall()
-    
-    cursor.close()
-    conn.close()
-    
-    return students
+    students = await db.fetch("SELECT user_id, username FROM users WHERE role = 'etudiant'")
+
+    return [dict(row) for row in students]
 
 @app.get("/conversations")
 async def get_conversations(current_user: dict = Depends(get_current_user_info)):
@@ -287,97 +1118,229 @@ async def get_conversations(current_user: dict = Depends(get_current_user_info))
     user_id = current_user["user_id"]
     user_role = get_user_role(current_user["roles"])
     
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    
     # Different query based on user role
     if user_role == "prof":
-        role_condition = "c.prof_id = %s"
+        role_condition = "c.prof_id = $1"
     else:
-        role_condition = "c.student_id = %s"
+        role_condition = "c.student_id = $1"
     
+    # Résumé dénormalisé (maintenu à l'envoi et à la lecture) : un seul parcours d'index
     query = f"""
     SELECT 
         c.conversation_id, 
         c.prof_id, 
         c.student_id, 
         c.last_message_at,
-        COALESCE(um.unread_count, 0) as unread_count,
-        (SELECT message_text FROM messages 
-         WHERE conversation_id = c.conversation_id 
-         ORDER BY sent_at DESC LIMIT 1) as last_message,
+        CASE WHEN c.prof_id = $1 THEN c.prof_unread_count ELSE c.student_unread_count END as unread_count,
+        c.last_message_text as last_message,
+        c.last_message_id,
+        c.last_sender_id,
         p.username as prof_username,
         s.username as student_username
     FROM conversations c
-    LEFT JOIN (
-        SELECT conversation_id, COUNT(*) as unread_count
-        FROM messages
-        WHERE is_read = FALSE AND sender_id != %s
-        GROUP BY conversation_id
-    ) um ON c.conversation_id = um.conversation_id
     JOIN users p ON c.prof_id = p.user_id
     JOIN users s ON c.student_id = s.user_id
     WHERE {role_condition}
     ORDER BY c.last_message_at DESC
     """
     
-    cursor.execute(query, (user_id, user_id))
-    conversations = cursor.fetchall()
-    
-    cursor.close()
-    conn.close()
-    
-    return conversations
+    conversations = await db.fetch(query, user_id)
+
+    return [dict(row) for row in conversations]
+
+MESSAGES_PAGE_SIZE = 50
+MESSAGES_MAX_PAGE_SIZE = 200
 
 @app.get("/conversations/{conversation_id}/messages")
 async def get_messages(
     conversation_id: int,
+    before: Optional[int] = None,
+    after: Optional[int] = None,
+    limit: int = MESSAGES_PAGE_SIZE,
     current_user: dict = Depends(get_current_user_info)
 ):
-    """Get all messages for a specific conversation"""
+    """Get one page of messages for a conversation, oldest first.
+
+    Without a cursor this is the latest page; `before`/`after` take a
+    message_id and return the page just older/newer than it.
+    """
     user_id = current_user["user_id"]
+    limit = max(1, min(limit, MESSAGES_MAX_PAGE_SIZE))
+    if before is not None and after is not None:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
     
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    
-    # Verify the user is part of this conversation
-    cursor.execute(
-        "SELECT * FROM conversations WHERE conversation_id = %s AND (prof_id = %s OR student_id = %s)",
-        (conversation_id, user_id, user_id)
-    )
-    
-    if cursor.fetchone() is None:
-        cursor.close()
-        conn.close()
-        raise HTTPException(status_code=403, detail="Access forbidden")
-    
-    # Get messages
-    cursor.execute(
-        """
-        SELECT m.*, u.username as sender_username
-        FROM messages m
-        JOIN users u ON m.sender_id = u.user_id
-        WHERE m.conversation_id = %s
-        ORDER BY m.sent_at ASC
+    async with db.acquire() as conn:
+        # Verify the user is part of this conversation
+        conversation = await db.run(
+            conn, "fetchrow",
+            "SELECT * FROM conversations WHERE conversation_id = $1 AND (prof_id = $2 OR student_id = $2)",
+            conversation_id, user_id
+        )
+        if conversation is None:
+            raise HTTPException(status_code=403, detail="Access forbidden")
+
+        # Get messages: keyset sur (conversation_id, message_id), jamais d'OFFSET
+        if after is not None:
+            rows = await db.run(
+                conn, "fetch",
+                """
+                SELECT m.message_id, m.conversation_id, m.sender_id, m.message_text, m.sent_at, m.client_msg_id,
+                       m.message_id <= COALESCE(CASE WHEN m.sender_id = c.prof_id
+                                                     THEN c.student_last_read_message_id
+                                                     ELSE c.prof_last_read_message_id END, 0) as is_read,
+                       u.username as sender_username
+                FROM messages m
+                JOIN conversations c ON c.conversation_id = m.conversation_id
+                JOIN users u ON m.sender_id = u.user_id
+                WHERE m.conversation_id = $1 AND m.message_id > $2
+                ORDER BY m.message_id ASC
+                LIMIT $3
+                """,
+                conversation_id, after, limit
+            )
+            messages = [dict(row) for row in rows]
+        else:
+            rows = await db.run(
+                conn, "fetch",
+                """
+                SELECT m.message_id, m.conversation_id, m.sender_id, m.message_text, m.sent_at, m.client_msg_id,
+                       m.message_id <= COALESCE(CASE WHEN m.sender_id = c.prof_id
+                                                     THEN c.student_last_read_message_id
+                                                     ELSE c.prof_last_read_message_id END, 0) as is_read,
+                       u.username as sender_username
+                FROM messages m
+                JOIN conversations c ON c.conversation_id = m.conversation_id
+                JOIN users u ON m.sender_id = u.user_id
+                WHERE m.conversation_id = $1 AND ($2::integer IS NULL OR m.message_id < $2)
+                ORDER BY m.message_id DESC
+                LIMIT $3
+                """,
+                conversation_id, before, limit
+            )
+            messages = [dict(row) for row in reversed(rows)]
+
+        if before is not None or not messages:
+            # Pages plus anciennes : la conversation a déjà été marquée comme lue
+            return messages
+
+        # Mark as read up to the last message returned (a page is capped at `limit`, newer
+        # messages not sent to the client stay unread): one row, whatever the number of unread messages
+        receipt = await advance_read_cursor(conn, conversation, user_id, messages[-1]["message_id"])
+
+    await publish_read_receipt(receipt)
+
+    return messages
+
+async def advance_read_cursor(conn, conversation, user_id: str, up_to: Optional[int] = None) -> Optional[dict]:
+    """Move the reader's cursor (single-row update) and reset or recount their unread counter.
+
+    Without up_to everything up to the conversation's last message is read.
+    Returns the receipt to push to the counterpart, or None if the cursor did not move.
+    """
+    side = "prof" if conversation["prof_id"] == user_id else "student"
+    counterpart_id = conversation["student_id"] if side == "prof" else conversation["prof_id"]
+    read_to = f"""GREATEST(COALESCE(c.{side}_last_read_message_id, 0),
+                          LEAST(COALESCE(c.last_message_id, 0), COALESCE($1::integer, c.last_message_id, 0)))"""
+    row = await db.run(
+        conn, "fetchrow",
+        f"""
+        UPDATE conversations c
+        SET {side}_last_read_message_id = {read_to},
+            {side}_unread_count = CASE
+                WHEN {read_to} >= COALESCE(c.last_message_id, 0) THEN 0
+                ELSE (SELECT COUNT(*) FROM messages m
+                      WHERE m.conversation_id = c.conversation_id
+                        AND m.message_id > {read_to} AND m.sender_id != $2)
+            END
+        WHERE c.conversation_id = $3
+        RETURNING c.{side}_last_read_message_id AS last_read_message_id
         """,
-        (conversation_id,)
+        up_to, user_id, conversation["conversation_id"]
     )
-    messages = cursor.fetchall()
-    
-    # Mark messages as read
-    cursor.execute(
-        """
-        UPDATE messages
-        SET is_read = TRUE
-        WHERE conversation_id = %s AND sender_id != %s AND is_read = FALSE
-        """,
-        (conversation_id, user_id)
+    previous = conversation.get(f"{side}_last_read_message_id") or 0
+    if row is None or row["last_read_message_id"] <= previous:
+        return None
+    return {
+        "counterpart_id": counterpart_id,
+        "conversation_id": conversation["conversation_id"],
+        "reader_id": user_id,
+        "last_read_message_id": row["last_read_message_id"]
+    }
+
+async def mark_conversation_read(conversation_id: int, user_id: str, up_to: Optional[int] = None) -> Optional[dict]:
+    async with db.acquire() as conn:
+        conversation = await db.run(
+            conn, "fetchrow",
+            "SELECT * FROM conversations WHERE conversation_id = $1 AND (prof_id = $2 OR student_id = $2)",
+            conversation_id, user_id
+        )
+        if conversation is None:
+            raise HTTPException(status_code=403, detail="Access forbidden")
+        return await advance_read_cursor(conn, conversation, user_id, up_to)
+
+async def publish_read_receipt(receipt: Optional[dict]):
+    """Tell the sender's devices how far the reader has read"""
+    if receipt is None:
+        return
+    try:
+        await chat_bus.publish([receipt["counterpart_id"]], {
+            "type": "read",
+            "data": {
+                "conversation_id": receipt["conversation_id"],
+                "reader_id": receipt["reader_id"],
+                "last_read_message_id": receipt["last_read_message_id"]
+            }
+        })
+    except Exception as e:
+        logger.error(f"Chat bus publish error: {str(e)}")
+
+class ReadRequest(BaseModel):
+    message_id: Optional[int] = None  # Par défaut : jusqu'au dernier message
+
+@app.post("/conversations/{conversation_id}/read")
+async def mark_read(
+    conversation_id: int,
+    read: Optional[ReadRequest] = None,
+    current_user: dict = Depends(get_current_user_info)
+):
+    """Mark a conversation as read up to a message (or entirely)"""
+    receipt = await mark_conversation_read(conversation_id, current_user["user_id"], read.message_id if read else None)
+    await publish_read_receipt(receipt)
+    return {"status": "success", "last_read_message_id": receipt["last_read_message_id"] if receipt else None}
+
+async def persist_message(sender_id: str, sender_roles: list, receiver_id: str, message_text: str,
+                    client_msg_id: Optional[str] = None):
+    """Store a message and return (message_data, created).
+
+    Everything (role check, find-or-create conversation, insert, summary
+    update, sender username) runs in one send_chat_message() call, hence one
+    round trip and one transaction. A retry with the same client_msg_id
+    returns the message stored the first time with created=False, so the
+    caller does not notify the receiver twice.
+    """
+    result = await db.fetchval(
+        "SELECT send_chat_message($1, $2, $3, $4, $5)",
+        sender_id, get_user_role(sender_roles), receiver_id, message_text, client_msg_id
     )
     
-    cursor.close()
-    conn.close()
+    status = result.pop("status")
+    if status == "receiver_not_found":
+        raise HTTPException(status_code=404, detail="Receiver not found")
+    if status == "invalid_flow":
+        raise HTTPException(status_code=400, detail="Invalid message flow")
     
-    return messages
+    created = result.pop("created")
+    return result, created
+
+async def deliver_new_message(receiver_id: str, message_data: dict):
+    # Diffusion à tous les workers : celui qui détient la socket du destinataire la livre
+    try:
+        await chat_bus.publish([receiver_id], {
+            "type": "new_message",
+            "data": message_data
+        })
+    except Exception as e:
+        logger.error(f"Chat bus publish error: {str(e)}")
 
 @app.post("/messages")
 async def send_message(
@@ -385,126 +1348,135 @@ async def send_message(
     current_user: dict = Depends(get_current_user_info)
 ):
     """Send a new message"""
-    sender_id = current_user["user_id"]
-    receiver_id = message.receiver_id
-    sender_role = get_user_role(current_user["roles"])
-    
-    conn = get_db_connection()
-    cursor = conn.cursor(cursor_factory=RealDictCursor)
-    
-    # Get receiver role
-    cursor.execute("SELECT role FROM users WHERE user_id = %s", (receiver_id,))
-    receiver = cursor.fetchone()
-    
-    if not receiver:
-        cursor.close()
-        conn.close()
-        raise HTTPException(status_code=404, detail="Receiver not found")
-    
-    receiver_role = receiver["role"]
-    
-    # Different roles for proper conversation setup
-    if sender_role == "prof" and receiver_role == "etudiant":
-        prof_id = sender_id
-        student_id = receiver_id
-    elif sender_role == "etudiant" and receiver_role == "prof":
-        prof_id = receiver_id
-        student_id = sender_id
-    else:
-        cursor.close()
-        conn.close()
-        raise HTTPException(status_code=400, detail="Invalid message flow")
-    
-    # Find or create conversation
-    cursor.execute(
-        """
-        SELECT conversation_id FROM conversations 
-        WHERE prof_id = %s AND student_id = %s
-        """,
-        (prof_id, student_id)
+    message_data, created = await persist_message(
+        current_user["user_id"],
+        current_user["roles"],
+        message.receiver_id,
+        message.message_text,
+        message.client_msg_id
     )
     
-    conversation = cursor.fetchone()
-    
-    if conversation:
-        conversation_id = conversation["conversation_id"]
-    else:
-        cursor.execute(
-            """
-            INSERT INTO conversations (prof_id, student_id)
-            VALUES (%s, %s) RETURNING conversation_id
-            """,
-            (prof_id, student_id)
-        )
-        conversation_id = cursor.fetchone()["conversation_id"]
+    if created:
+        await deliver_new_message(message.receiver_id, message_data)
     
-    # Insert message
-    cursor.execute(
-        """
-        INSERT INTO messages (conversation_id, sender_id, message_text)
-        VALUES (%s, %s, %s) RETURNING message_id, sent_at
-        """,
-        (conversation_id, sender_id, message.message_text)
-    )
-    
-    new_message = cursor.fetchone()
+    return message_data
+
+@app.get("/presence")
+async def get_presence(current_user: dict = Depends(get_current_user_info)):
+    """Online status of the counterparts of the current user's conversations"""
+    user_id = current_user["user_id"]
     
-    # Update conversation last_message_at
-    cursor.execute(
+    statuses = await db.fetch(
         """
-        UPDATE conversations
-        SET last_message_at = CURRENT_TIMESTAMP
-        WHERE conversation_id = %s
+        SELECT c.counterpart_id AS user_id,
+               EXISTS (
+                   SELECT 1 FROM user_presence p
+                   WHERE p.user_id = c.counterpart_id
+                     AND p.updated_at > CURRENT_TIMESTAMP - make_interval(secs => $1)
+               ) AS online
+        FROM (
+            SELECT CASE WHEN prof_id = $2 THEN student_id ELSE prof_id END AS counterpart_id
+            FROM conversations
+            WHERE prof_id = $2 OR student_id = $2
+        ) c
         """,
-        (conversation_id,)
+        PRESENCE_TTL, user_id
     )
+
+    return [dict(row) for row in statuses]
+
+@app.get("/metrics/db")
+async def get_database_metrics():
+    """Pool occupancy, acquire waits, query latency and timeout counters of this worker"""
+    return db.metrics()
+
+async def handle_client_frame(connection: ClientConnection, user_info: dict, frame: str):
+    """Client frames: {"type": "pong"}, {"type": "read", "conversation_id", "message_id"} and
+    {"type": "send", "client_msg_id", "receiver_id", "message_text"}.
+
+    A send is answered on the same socket with {"type": "ack", "client_msg_id",
+    "data": message} or {"type": "error", "client_msg_id", "status", "detail"}.
+    """
+    try:
+        data = json.loads(frame)
+    except ValueError:
+        connection.enqueue({"type": "error", "status": 400, "detail": "Invalid frame"})
+        return
+    if isinstance(data, dict) and data.get("type") == "read":
+        await handle_read_frame(user_info, data)
+        return
+    if not isinstance(data, dict) or data.get("type") != "send":
+        return  # pong et trames inconnues : seule l'activité compte
     
-    # Get sender username
-    cursor.execute("SELECT username FROM users WHERE user_id = %s", (sender_id,))
-    sender_username = cursor.fetchone()["username"]
-    
-    conn.commit()
-    cursor.close()
-    conn.close()
-    
-    # Prepare message data
-    message_data = {
-        "message_id": new_message["message_id"],
-        "conversation_id": conversation_id,
-        "sender_id": sender_id,
-        "sender_username": sender_username,
-        "message_text": message.message_text,
-        "sent_at": new_message["sent_at"].isoformat(),
-        "is_read": False
-    }
+    client_msg_id = data.get("client_msg_id")
+    receiver_id = data.get("receiver_id")
+    message_text = data.get("message_text")
+    if (not isinstance(client_msg_id, str) or not client_msg_id or len(client_msg_id) > 64
+            or not isinstance(receiver_id, str) or not isinstance(message_text, str) or not message_text.strip()):
+        connection.enqueue({
+            "type": "error", "client_msg_id": client_msg_id,
+            "status": 400, "detail": "client_msg_id, receiver_id and message_text are required"
+        })
+        return
     
-    # Send WebSocket notification if receiver is connected
-    asyncio.create_task(manager.send_message(receiver_id, {
-        "type": "new_message",
-        "data": message_data
-    }))
+    try:
+        message_data, created = await persist_message(
+            user_info["user_id"], user_info["roles"], receiver_id, message_text, client_msg_id
+        )
+    except HTTPException as e:
+        connection.enqueue({"type": "error", "client_msg_id": client_msg_id, "status": e.status_code, "detail": e.detail})
+        return
+    except Exception as e:
+        logger.error(f"WebSocket send error: {str(e)}")
+        connection.enqueue({"type": "error", "client_msg_id": client_msg_id, "status": 500, "detail": "Internal error"})
+        return
     
-    return message_data
+    connection.enqueue({"type": "ack", "client_msg_id": client_msg_id, "data": message_data})
+    if created:
+        await deliver_new_message(receiver_id, message_data)
+
+async def handle_read_frame(user_info: dict, data: dict):
+    conversation_id = data.get("conversation_id")
+    message_id = data.get("message_id")
+    if not isinstance(conversation_id, int) or (message_id is not None and not isinstance(message_id, int)):
+        return
+    try:
+        receipt = await mark_conversation_read(conversation_id, user_info["user_id"], message_id)
+    except HTTPException:
+        return
+    except Exception as e:
+        logger.error(f"WebSocket read error: {str(e)}")
+        return
+    await publish_read_receipt(receipt)
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket, token: str = Query(...)):
     try:
         # Validate token
         payload = await decode_token(token)
-        user_id = payload.get("sub")
+        user_info = user_info_from_payload(payload)
+        user_id = user_info["user_id"]
         
         if not user_id:
             await websocket.close(code=1008, reason="Invalid token")
             return
         
-        await manager.connect(websocket, user_id)
+        # Utilisateur provisionné une fois par socket, pas à chaque message
+        await ensure_user(user_info)
+        
+        connection = await manager.connect(websocket, user_id)
         
         try:
             while True:
-                # Keep connection alive
-                await websocket.receive_text()
+                # Toute trame reçue (pong compris) prouve que le client est vivant
+                frame = await websocket.receive_text()
+                connection.touch()
+                await handle_client_frame(connection, user_info, frame)
         except WebSocketDisconnect:
-            manager.disconnect(user_id)
+            manager.disconnect(connection)
+        except RuntimeError:
+            # Socket fermée côté serveur (client lent évincé)
+            manager.disconnect(connection)
     except Exception as e:
         logger.error(f"WebSocket error: {str(e)}")
         await websocket.close(code=1011, reason=f"Internal error: {str(e)}")
\ No newline at end of file
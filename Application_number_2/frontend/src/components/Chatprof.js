@@ -4,6 +4,8 @@ import api from "../api";
 import { jwtDecode } from "jwt-decode";
 import "./Chat.css";
 
+const MESSAGES_PAGE_SIZE = 50;
+
 const Chatprof = () => {
   const [students, setStudents] = useState([]);
   const [conversations, setConversations] = useState([]);
@@ -14,10 +16,24 @@ const Chatprof = () => {
   const [error, setError] = useState("");
   const [userInfo, setUserInfo] = useState(null);
   const [wsConnection, setWsConnection] = useState(null);
+  const [onlineUsers, setOnlineUsers] = useState({});
   
   const messagesEndRef = useRef(null);
+  const pendingAcks = useRef({});
+  const [hasOlderMessages, setHasOlderMessages] = useState(false);
+  const loadingOlderRef = useRef(false);
   const navigate = useNavigate();
 
+  // État en ligne des interlocuteurs, ensuite tenu à jour par les événements "presence"
+  const fetchPresence = async () => {
+    try {
+      const response = await api.get("/presence");
+      setOnlineUsers(Object.fromEntries(response.data.map(status => [status.user_id, status.online])));
+    } catch (err) {
+      console.error("Error fetching presence:", err);
+    }
+  };
+
   // Check authentication and get user info
   useEffect(() => {
     const token = localStorage.getItem("access_token");
@@ -56,11 +72,56 @@ const Chatprof = () => {
 
     ws.onopen = () => {
       console.log("WebSocket connected");
+      // Rattrape les changements de présence manqués pendant la déconnexion
+      fetchPresence();
     };
 
     ws.onmessage = (event) => {
       const data = JSON.parse(event.data);
       
+      // Heartbeat du serveur : répondre pour ne pas être considéré comme inactif
+      if (data.type === "ping") {
+        ws.send(JSON.stringify({ type: "pong" }));
+        return;
+      }
+      
+      // Réponse à un message envoyé sur la socket
+      if (data.type === "ack" || data.type === "error") {
+        const pending = pendingAcks.current[data.client_msg_id];
+        if (pending) {
+          delete pendingAcks.current[data.client_msg_id];
+          if (data.type === "ack") {
+            pending.resolve(data.data);
+          } else {
+            pending.reject(new Error(data.detail));
+          }
+        }
+        return;
+      }
+      
+      // Changement de présence d'un ou plusieurs interlocuteurs
+      if (data.type === "presence") {
+        setOnlineUsers(prev => {
+          const next = { ...prev };
+          data.data.forEach(status => { next[status.user_id] = status.online; });
+          return next;
+        });
+        return;
+      }
+      
+      // Accusé de lecture : nos messages jusqu'à last_read_message_id ont été lus
+      if (data.type === "read") {
+        const receipt = data.data;
+        if (selectedConversation && receipt.conversation_id === selectedConversation.conversation_id) {
+          setMessages(prevMessages => prevMessages.map(msg =>
+            msg.sender_id !== receipt.reader_id && msg.message_id <= receipt.last_read_message_id
+              ? { ...msg, is_read: true }
+              : msg
+          ));
+        }
+        return;
+      }
+      
       if (data.type === "new_message") {
         // Handle incoming message
         const newMsg = data.data;
@@ -68,6 +129,12 @@ const Chatprof = () => {
         // If this message belongs to the currently selected conversation
         if (selectedConversation && newMsg.conversation_id === selectedConversation.conversation_id) {
           setMessages(prevMessages => [...prevMessages, newMsg]);
+          // Déjà affiché : avancer le curseur de lecture (accusé de lecture pour l'expéditeur)
+          ws.send(JSON.stringify({
+            type: "read",
+            conversation_id: newMsg.conversation_id,
+            message_id: newMsg.message_id
+          }));
         }
         
         // Update conversation list to show new message
@@ -140,8 +207,12 @@ const Chatprof = () => {
 
     const fetchMessages = async () => {
       try {
-        const response = await api.get(`/conversations/${selectedConversation.conversation_id}/messages`);
+        // Dernière page seulement, les plus anciennes sont chargées en remontant
+        const response = await api.get(`/conversations/${selectedConversation.conversation_id}/messages`, {
+          params: { limit: MESSAGES_PAGE_SIZE }
+        });
         setMessages(response.data);
+        setHasOlderMessages(response.data.length === MESSAGES_PAGE_SIZE);
         
         // Mark conversation as read in our UI
         setConversations(prevConversations => {
@@ -160,11 +231,37 @@ const Chatprof = () => {
     fetchMessages();
   }, [selectedConversation]);
 
-  // Scroll to bottom when messages change
+  // Scroll to bottom when messages change (not when older messages are prepended)
   useEffect(() => {
+    if (loadingOlderRef.current) {
+      loadingOlderRef.current = false;
+      return;
+    }
     messagesEndRef.current?.scrollIntoView({ behavior: "smooth" });
   }, [messages]);
 
+  // Load the previous page when scrolled to the top
+  const handleMessagesScroll = async (e) => {
+    if (e.currentTarget.scrollTop > 0 || !hasOlderMessages || loadingOlderRef.current) return;
+    if (!selectedConversation?.conversation_id || messages.length === 0) return;
+
+    loadingOlderRef.current = true;
+    try {
+      const response = await api.get(`/conversations/${selectedConversation.conversation_id}/messages`, {
+        params: { before: messages[0].message_id, limit: MESSAGES_PAGE_SIZE }
+      });
+      setHasOlderMessages(response.data.length === MESSAGES_PAGE_SIZE);
+      if (response.data.length > 0) {
+        setMessages(prev => [...response.data, ...prev]);
+      } else {
+        loadingOlderRef.current = false;
+      }
+    } catch (err) {
+      loadingOlderRef.current = false;
+      console.error("Error fetching older messages:", err);
+    }
+  };
+
   const handleStudentSelect = (student) => {
     // Find existing conversation or create a placeholder
     const existingConversation = conversations.find(
@@ -193,21 +290,43 @@ const Chatprof = () => {
     setSelectedConversation(conversation);
   };
 
+  // Envoi par la WebSocket si elle est ouverte, sinon (ou sans accusé à temps) par POST /messages.
+  // Le même client_msg_id est réutilisé, le serveur ne crée donc jamais de doublon.
+  const sendMessage = async (payload) => {
+    if (wsConnection && wsConnection.readyState === WebSocket.OPEN) {
+      try {
+        return await new Promise((resolve, reject) => {
+          const timer = setTimeout(() => {
+            delete pendingAcks.current[payload.client_msg_id];
+            reject(new Error("ack timeout"));
+          }, 5000);
+          pendingAcks.current[payload.client_msg_id] = {
+            resolve: (value) => { clearTimeout(timer); resolve(value); },
+            reject: (err) => { clearTimeout(timer); reject(err); }
+          };
+          wsConnection.send(JSON.stringify({ type: "send", ...payload }));
+        });
+      } catch (err) {
+        console.warn("WebSocket send failed, falling back to HTTP:", err);
+      }
+    }
+    const response = await api.post("/messages", payload);
+    return response.data;
+  };
+
   const handleSendMessage = async (e) => {
     e.preventDefault();
     
     if (!newMessage.trim() || !selectedConversation) return;
     
     try {
-      // Send message to API
-      const response = await api.post("/messages", {
+      // Send message (WebSocket, or API as a fallback)
+      const sentMessage = await sendMessage({
         receiver_id: selectedConversation.student_id,
-        message_text: newMessage
+        message_text: newMessage,
+        client_msg_id: crypto.randomUUID()
       });
       
-      // Add message to the local state
-      const sentMessage = response.data;
-      
       // If this is a new conversation, update with the real conversation_id
       if (!selectedConversation.conversation_id) {
         setSelectedConversation(prev => ({
@@ -279,7 +398,10 @@ const Chatprof = () => {
               onClick={() => handleConversationSelect(conv)}
             >
               <div className="conversation-info">
-                <div className="conversation-name">{conv.student_username}</div>
+                <div className="conversation-name">
+                  <span className={`presence-dot ${onlineUsers[conv.student_id] ? 'online' : ''}`} />
+                  {conv.student_username}
+                </div>
                 <div className="conversation-preview">
                   {conv.last_message && conv.last_message.length > 30
                     ? `${conv.last_message.substring(0, 27)}...`
@@ -319,9 +441,12 @@ const Chatprof = () => {
           <>
             <div className="chat-header">
               <h2>{selectedConversation.student_username}</h2>
+              <div className="presence-status">
+                {onlineUsers[selectedConversation.student_id] ? "En ligne" : "Hors ligne"}
+              </div>
             </div>
             
-            <div className="messages-container">
+            <div className="messages-container" onScroll={handleMessagesScroll}>
               {messages.length === 0 ? (
                 <div className="no-messages">
                   Envoyez un message pour démarrer la conversation